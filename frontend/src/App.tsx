@@ -4,7 +4,7 @@ import { Input } from "./components/ui/input";
 import { Card, CardContent, CardHeader, CardTitle, CardFooter } from "./components/ui/card";
 import { Badge } from "./components/ui/badge";
 
-type Citation = { filename: string; url: string };
+type Citation = { filename: string; url: string; section?: string };
 type Meta = {
   duration_seconds: number;
   duration_ms: number;
@@ -24,6 +24,14 @@ type AskResponse = {
   meta?: Meta;
 };
 
+// Human-readable labels for /ask/stream status frames
+const STATUS_LABELS: Record<string, string> = {
+  queued: "Queued…",
+  in_progress: "Thinking…",
+  searching_files: "Searching the help docs…",
+  writing: "Writing…",
+};
+
 // Using Vite dev proxy from vite.config.ts, so relative paths are fine in dev
 const API_BASE = "";
 
@@ -32,16 +40,16 @@ export default function App() {
   const [busy, setBusy] = React.useState(false);
   const [question, setQuestion] = React.useState("");
   const [messages, setMessages] = React.useState<
-    { role: "user" | "assistant"; text: string; citations?: Citation[]; metaLine?: string; metaCached?: boolean }[]
+    { role: "user" | "assistant"; text: string; citations?: Citation[]; metaLine?: string; metaCached?: boolean; status?: string }[]
   >([]);
 
-  async function setup(recreate = false) {
+  async function setup(recreate = false, incremental = false) {
     setBusy(true);
     try {
       const res = await fetch(`${API_BASE}/setup`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ recreate }),
+        body: JSON.stringify({ recreate, incremental }),
       });
       if (!res.ok) {
         const err = await res.text().catch(() => "");
@@ -93,7 +101,19 @@ export default function App() {
             else if (line.startsWith("data:")) data += line.slice(5).trim();
           }
           if (!event) continue;
-          if (event === "delta") {
+          if (event === "status") {
+            let payload: any = {};
+            try { payload = JSON.parse(data); } catch {}
+            const status = STATUS_LABELS[payload?.status] || "";
+            setMessages((m) => {
+              const copy = [...m];
+              const last = copy[copy.length - 1];
+              if (last && last.role === "assistant") {
+                last.status = status;
+              }
+              return copy;
+            });
+          } else if (event === "delta") {
             let payload: any;
             try { payload = JSON.parse(data); } catch { payload = { text: data }; }
             const chunk = payload?.text ?? "";
@@ -163,7 +183,7 @@ export default function App() {
               <Button disabled={busy} onClick={() => setup(false)}>
                 Setup
               </Button>
-              <Button disabled={busy} variant="outline" onClick={() => setup(true)}>
+              <Button disabled={busy} variant="outline" onClick={() => setup(false, true)}>
                 Reindex
               </Button>
             </div>
@@ -184,20 +204,26 @@ export default function App() {
                     {m.role === "user" ? "You" : "Assistant"}
                   </div>
                   <div className="whitespace-pre-wrap">{m.text}</div>
+                  {!m.text && m.status && (
+                    <div className="text-xs text-muted-foreground italic">{m.status}</div>
+                  )}
 
-                  {/* Sources highlighted but NOT clickable */}
+                  {/* Sources link to the pre-rendered guide, at the cited section when known */}
                   {m.citations && m.citations.length > 0 && (
                     <div className="mt-2 text-xs text-muted-foreground">
                       Sources:
                       <span className="ml-1">
                         {m.citations.map((c, idx) => (
-                          <span
+                          <a
                             key={`${c.filename}-${idx}`}
-                            className="inline-flex items-center rounded-full border px-2.5 py-0.5 text-xs font-semibold bg-accent/40 text-muted-foreground mr-1"
-                            title={c.filename}
+                            href={`${API_BASE}${c.url}`}
+                            target="_blank"
+                            rel="noreferrer"
+                            className="inline-flex items-center rounded-full border px-2.5 py-0.5 text-xs font-semibold bg-accent/40 text-muted-foreground mr-1 hover:underline"
+                            title={c.section ? `${c.filename} › ${c.section}` : c.filename}
                           >
                             {c.filename}
-                          </span>
+                          </a>
                         ))}
                       </span>
                     </div>
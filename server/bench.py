@@ -0,0 +1,315 @@
+"""
+Load and latency benchmark for the ERP Help Assistant API.
+
+By default it starts server/fake_openai.py and the API (with its state, caches and
+search index in a temp dir) on free local ports, so it costs nothing and never
+touches the real OpenAI account. Point --app-url/--fake-url at running servers to
+benchmark those instead.
+
+    python server/bench.py --profile all --requests 200 --concurrency 1,8,32 --hit-ratio 0.5
+
+For every profile and concurrency level it reports requests, errors, RPS,
+p50/p95/p99 latency, time to first SSE byte and first answer delta (stream), and
+the upstream calls the run made, by endpoint.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+import httpx
+
+SERVER_DIR = Path(__file__).resolve().parent
+
+QUESTIONS = [
+    "How do I create a sales order?",
+    "How do I receive a purchase order?",
+    "How do I issue parts to a work order?",
+    "How do I print a pick list?",
+    "How do I set up a new customer?",
+    "How do I run an inventory cycle count?",
+    "How do I close a work order?",
+    "How do I add a part revision?",
+    "How do I invoice a shipment?",
+    "How do I schedule production?",
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value * 1000.0, 1)
+
+
+async def _wait_ready(url: str, timeout_s: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout_s
+    async with httpx.AsyncClient(timeout=2.0) as http:
+        while time.monotonic() < deadline:
+            try:
+                if (await http.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout_s:.0f}s")
+
+
+def _spawn(args: List[str], env: Dict[str, str], log_path: Path) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen([sys.executable, *args], env=env, cwd=str(SERVER_DIR),
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+# ---------------------------
+# Load generation
+# ---------------------------
+
+def _questions(n: int, hit_ratio: float, hot: List[str], seed: int) -> List[str]:
+    # hit_ratio of the requests repeat an already-answered question; the rest are unique
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        if hot and rng.random() < hit_ratio:
+            out.append(rng.choice(hot))
+        else:
+            out.append(f"{rng.choice(QUESTIONS)[:-1]} (run {seed}, item {i})?")
+    return out
+
+
+async def _ask(http: httpx.AsyncClient, url: str, question: str, mode: Optional[str]) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    resp = await http.post(f"{url}/ask", json={"question": question, "mode": mode})
+    sample: Dict[str, Any] = {"latency": time.perf_counter() - t0, "status": resp.status_code}
+    if resp.status_code == 200:
+        sample["cached"] = bool(resp.json().get("meta", {}).get("cached"))
+    return sample
+
+
+async def _ask_stream(http: httpx.AsyncClient, url: str, question: str, mode: Optional[str]) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    sample: Dict[str, Any] = {"status": 0}
+    event = ""
+    async with http.stream("POST", f"{url}/ask/stream", json={"question": question, "mode": mode}) as resp:
+        sample["status"] = resp.status_code
+        async for line in resp.aiter_lines():
+            if "ttfb" not in sample:
+                sample["ttfb"] = time.perf_counter() - t0
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                if event == "delta" and "first_delta" not in sample:
+                    sample["first_delta"] = time.perf_counter() - t0
+                elif event == "done":
+                    try:
+                        sample["cached"] = bool(json.loads(line[5:]).get("meta", {}).get("cached"))
+                    except ValueError:
+                        pass
+                elif event == "error":
+                    # The stream opened with 200 but the answer failed
+                    sample["status"] = 599
+    sample["latency"] = time.perf_counter() - t0
+    return sample
+
+
+async def _setup(http: httpx.AsyncClient, url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    resp = await http.post(f"{url}/setup", json=body)
+    return {"latency": time.perf_counter() - t0, "status": resp.status_code}
+
+
+async def _run_level(http: httpx.AsyncClient, app_url: str, fake_url: Optional[str], profile: str,
+                     questions: List[str], concurrency: int, mode: Optional[str],
+                     setup_body: Dict[str, Any]) -> Dict[str, Any]:
+    if fake_url:
+        await http.post(f"{fake_url}/_reset")
+    sem = asyncio.Semaphore(concurrency)
+    samples: List[Dict[str, Any]] = []
+
+    async def one(question: str) -> None:
+        async with sem:
+            try:
+                if profile == "ask":
+                    samples.append(await _ask(http, app_url, question, mode))
+                elif profile == "stream":
+                    samples.append(await _ask_stream(http, app_url, question, mode))
+                else:
+                    samples.append(await _setup(http, app_url, setup_body))
+            except httpx.HTTPError as exc:
+                samples.append({"status": 0, "error": type(exc).__name__})
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(q) for q in questions))
+    wall = time.perf_counter() - t0
+
+    ok = [s for s in samples if s.get("status") == 200]
+    latencies = [s["latency"] for s in ok]
+    result: Dict[str, Any] = {
+        "profile": profile,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "rejected_503": sum(1 for s in samples if s.get("status") == 503),
+        "cached": sum(1 for s in ok if s.get("cached")),
+        "wall_s": round(wall, 3),
+        "rps": round(len(ok) / wall, 2) if wall else None,
+        "p50_ms": _ms(_percentile(latencies, 50)),
+        "p95_ms": _ms(_percentile(latencies, 95)),
+        "p99_ms": _ms(_percentile(latencies, 99)),
+    }
+    if profile == "stream":
+        ttfb = [s["ttfb"] for s in ok if "ttfb" in s]
+        first = [s["first_delta"] for s in ok if "first_delta" in s]
+        result.update({
+            "ttfb_p50_ms": _ms(_percentile(ttfb, 50)),
+            "ttfb_p95_ms": _ms(_percentile(ttfb, 95)),
+            "first_delta_p50_ms": _ms(_percentile(first, 50)),
+            "first_delta_p95_ms": _ms(_percentile(first, 95)),
+        })
+    if fake_url:
+        stats = (await http.get(f"{fake_url}/_stats")).json()
+        result["upstream_calls"] = stats["total"]
+        result["upstream"] = stats["calls"]
+    return result
+
+
+def _print_row(r: Dict[str, Any]) -> None:
+    def fmt(v: Any) -> str:
+        return "-" if v is None else str(v)
+
+    line = (f"{r['profile']:<7}c={r['concurrency']:<4}n={r['requests']:<5}err={r['errors']:<4}"
+            f"cached={r['cached']:<5}rps={fmt(r['rps']):<8}"
+            f"p50={fmt(r['p50_ms'])}ms p95={fmt(r['p95_ms'])}ms p99={fmt(r['p99_ms'])}ms")
+    if r["profile"] == "stream":
+        line += (f" ttfb p50/p95={fmt(r['ttfb_p50_ms'])}/{fmt(r['ttfb_p95_ms'])}ms"
+                 f" first-delta p50/p95={fmt(r['first_delta_p50_ms'])}/{fmt(r['first_delta_p95_ms'])}ms")
+    if "upstream_calls" in r:
+        top = sorted(r["upstream"].items(), key=lambda kv: -kv[1])[:4]
+        line += f" upstream={r['upstream_calls']} (" + ", ".join(f"{k}={v}" for k, v in top) + ")"
+    print(line, flush=True)
+
+
+async def _bench(args: argparse.Namespace, app_url: str, fake_url: Optional[str]) -> List[Dict[str, Any]]:
+    profiles = ["ask", "stream", "setup"] if args.profile == "all" else [args.profile]
+    levels = [int(c) for c in str(args.concurrency).split(",") if c.strip()]
+    limits = httpx.Limits(max_connections=max(levels) + 8, max_keepalive_connections=max(levels) + 8)
+    results: List[Dict[str, Any]] = []
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as http:
+        resp = await http.post(f"{app_url}/setup", json={"recreate": False})
+        resp.raise_for_status()
+
+        # The hot set is answered once up front so hit_ratio of each level is served from cache
+        hot = [f"{q[:-1]} (hot {i})?" for i, q in enumerate(QUESTIONS)][:max(1, args.hot_set)]
+        if args.hit_ratio > 0:
+            await asyncio.gather(*(_ask(http, app_url, q, args.mode) for q in hot))
+
+        for profile in profiles:
+            for level in levels:
+                if profile == "setup":
+                    n = args.setup_requests
+                    setup_body = {"recreate": False, "incremental": True}
+                    questions = [""] * n
+                else:
+                    setup_body = {}
+                    questions = _questions(args.requests, args.hit_ratio, hot, seed=len(results) + 1)
+                result = await _run_level(http, app_url, fake_url, profile, questions, level, args.mode, setup_body)
+                result["hit_ratio"] = args.hit_ratio if profile != "setup" else None
+                results.append(result)
+                _print_row(result)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark /ask, /ask/stream and /setup against a local OpenAI stand-in")
+    parser.add_argument("--profile", choices=["ask", "stream", "setup", "all"], default="all")
+    parser.add_argument("--requests", type=int, default=100, help="requests per ask/stream level")
+    parser.add_argument("--setup-requests", type=int, default=5, help="requests per setup level")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated sweep")
+    parser.add_argument("--hit-ratio", type=float, default=0.0, help="share of requests for an already-cached question")
+    parser.add_argument("--hot-set", type=int, default=10, help="distinct cached questions")
+    parser.add_argument("--mode", choices=["assistant", "fast"], default=None)
+    parser.add_argument("--timeout", type=float, default=180.0)
+    parser.add_argument("--json", dest="json_out", default=None, help="write results to this file")
+    parser.add_argument("--app-url", default=None, help="benchmark a running API instead of starting one")
+    parser.add_argument("--fake-url", default=None, help="running fake_openai.py, for upstream call counts")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VAL",
+                        help="extra env for the spawned API, e.g. ASK_MAX_CONCURRENCY=8")
+    parser.add_argument("--run-latency", type=float, default=2.0, help="fake run duration in seconds")
+    parser.add_argument("--run-jitter", type=float, default=0.5)
+    parser.add_argument("--prompt-tokens", type=int, default=3000)
+    parser.add_argument("--completion-tokens", type=int, default=250)
+    args = parser.parse_args()
+
+    procs: List[subprocess.Popen] = []
+    workdir = tempfile.TemporaryDirectory(prefix="erp-bench-")
+    app_url, fake_url = args.app_url, args.fake_url
+    try:
+        if not fake_url and not app_url:
+            port = _free_port()
+            env = dict(os.environ,
+                       FAKE_RUN_LATENCY_SECONDS=str(args.run_latency),
+                       FAKE_RUN_JITTER_SECONDS=str(args.run_jitter),
+                       FAKE_PROMPT_TOKENS=str(args.prompt_tokens),
+                       FAKE_COMPLETION_TOKENS=str(args.completion_tokens))
+            procs.append(_spawn(["-m", "uvicorn", "fake_openai:app", "--port", str(port), "--log-level", "warning"],
+                                env, Path(workdir.name) / "fake_openai.log"))
+            fake_url = f"http://127.0.0.1:{port}"
+            asyncio.run(_wait_ready(f"{fake_url}/_stats"))
+        if not app_url:
+            port = _free_port()
+            env = dict(os.environ,
+                       OPENAI_API_KEY="bench",
+                       OPENAI_BASE_URL=f"{fake_url}/v1",
+                       STATE_DIR=workdir.name,
+                       ANSWER_CACHE_BACKEND="memory",
+                       OPENAI_RPM_LIMIT="0",
+                       OPENAI_TPM_LIMIT="0",
+                       # The synthetic misses are near-duplicates of each other; keep --hit-ratio exact
+                       SEMANTIC_CACHE_ENABLED="false",
+                       # Warm-up runs would be counted as upstream calls of the first level
+                       WARMUP_AFTER_SETUP="false",
+                       WARMUP_ON_STARTUP="false")
+            for item in args.app_env:
+                key, _, value = item.partition("=")
+                env[key] = value
+            procs.append(_spawn(["-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                                env, Path(workdir.name) / "app.log"))
+            app_url = f"http://127.0.0.1:{port}"
+            asyncio.run(_wait_ready(f"{app_url}/health"))
+
+        results = asyncio.run(_bench(args, app_url.rstrip("/"), fake_url.rstrip("/") if fake_url else None))
+        if args.json_out:
+            Path(args.json_out).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
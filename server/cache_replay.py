@@ -0,0 +1,234 @@
+"""
+Replay a question log through the answer cache to size it from real traffic.
+
+Reads timestamped questions (NDJSON, one object per line with "ts" and "question";
+the QUERY_LOG_PATH log has exactly that shape) and replays them, offline and in
+timestamp order, through AnswerCache with the server's own key normalization,
+once for every combination of cache size, TTL and eviction policy. No model is
+called. For each combination it reports the hit ratio, peak memory, and what the
+replayed traffic would have cost with and without the cache.
+
+    python server/cache_replay.py query_log.ndjson --sizes 100,500,2000 --ttls 3600,86400,604800
+
+Per-answer cost and size come from the log: the cost of the run that answered a
+question (cost_usd on its uncached lines, or on cached lines written since the
+cache recorded it) and its size as a cache entry (bytes). Questions the log never
+saw answered use the median of the measured ones, or --cost-usd/--bytes when
+nothing was measured. A stale hit (served past the TTL) is counted as a hit that
+pays for one refresh run.
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+# The replay never calls the API or touches the persistent cache and query log
+os.environ.setdefault("OPENAI_API_KEY", "replay")
+os.environ["ANSWER_CACHE_BACKEND"] = "memory"
+os.environ["QUERY_LOG_PATH"] = ""
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import main  # noqa: E402
+
+
+def _parse_ts(value: Any) -> Optional[float]:
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+            except ValueError:
+                return None
+    return None
+
+
+def load_log(paths: List[str]) -> List[Dict[str, Any]]:
+    events: List[Dict[str, Any]] = []
+    skipped = 0
+    for path in paths:
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    skipped += 1
+                    continue
+                ts = _parse_ts(rec.get("ts"))
+                question = rec.get("question")
+                if ts is None or not isinstance(question, str) or not question.strip():
+                    skipped += 1
+                    continue
+                rec["ts"] = ts
+                events.append(rec)
+    if skipped:
+        print(f"skipped {skipped} unreadable line(s)", file=sys.stderr)
+    events.sort(key=lambda r: r["ts"])
+    return events
+
+
+def _key(rec: Dict[str, Any]) -> str:
+    # The mode stands in for the docs scope: assistant and fast answers are cached apart
+    return main._cache_key(rec["question"], rec.get("model") or main.MODEL, rec.get("mode") or main.ANSWER_MODE)
+
+
+def measure(events: List[Dict[str, Any]], default_cost: float,
+            default_bytes: int) -> Tuple[Dict[str, Tuple[float, int]], Dict[str, Any]]:
+    """Cost and cache-entry size per cache key, from what the log recorded (keys each event)."""
+    costs: Dict[str, float] = {}
+    sizes: Dict[str, int] = {}
+    for rec in events:
+        key = rec["key"] = _key(rec)
+        cost = rec.get("cost_usd")
+        if isinstance(cost, (int, float)) and cost > 0:
+            costs[key] = float(cost)
+        size = rec.get("bytes")
+        if isinstance(size, int) and size > 0:
+            sizes[key] = size
+    cost_fallback = statistics.median(costs.values()) if costs else default_cost
+    size_fallback = int(statistics.median(sizes.values())) if sizes else default_bytes
+    per_key = {}
+    for rec in events:
+        key = rec["key"]
+        per_key[key] = (costs.get(key, cost_fallback), sizes.get(key, size_fallback))
+    summary = {
+        "measured_costs": len(costs),
+        "measured_sizes": len(sizes),
+        "median_cost_usd": round(cost_fallback, 6),
+        "median_bytes": size_fallback,
+    }
+    return per_key, summary
+
+
+def _value(cost: float, size: int) -> Dict[str, Any]:
+    # A stand-in answer whose serialized size matches the measured one
+    base = {"answer": "", "citations": [], "cost_usd": cost}
+    pad = max(0, size - len(json.dumps(base)))
+    return {"answer": "x" * pad, "citations": [], "cost_usd": cost}
+
+
+def simulate(events: List[Dict[str, Any]], per_key: Dict[str, Tuple[float, int]], max_entries: int,
+             ttl_s: int, policy: str, max_bytes: int, stale_s: int, stale_min_hits: int) -> Dict[str, Any]:
+    cache = main.AnswerCache(max_entries, ttl_s, max_bytes, stale_s, stale_min_hits, policy)
+    now = [events[0]["ts"] if events else 0.0]
+    cache.clock = lambda: now[0]
+    hits = stale_hits = misses = 0
+    spent = baseline = 0.0
+    peak_entries = peak_bytes = 0
+    for rec in events:
+        now[0] = rec["ts"]
+        key = rec["key"]
+        cost, size = per_key[key]
+        baseline += cost
+        value, stale = cache.lookup(key)
+        if value is not None and not stale:
+            hits += 1
+            continue
+        if value is not None:
+            # Served stale while one background run refreshes it
+            stale_hits += 1
+        else:
+            misses += 1
+        spent += cost
+        cache.set(key, _value(cost, size))
+        entries, nbytes = cache.size()
+        peak_entries = max(peak_entries, entries)
+        peak_bytes = max(peak_bytes, nbytes)
+    total = len(events)
+    return {
+        "max_entries": max_entries,
+        "ttl_seconds": ttl_s,
+        "policy": policy,
+        "requests": total,
+        "hits": hits,
+        "stale_hits": stale_hits,
+        "misses": misses,
+        "hit_ratio": round((hits + stale_hits) / total, 4) if total else 0.0,
+        "peak_entries": peak_entries,
+        "peak_bytes": peak_bytes,
+        "evicted": cache.counters["evicted"],
+        "rejected": cache.counters["rejected"],
+        "cost_usd": round(spent, 4),
+        "saved_usd": round(baseline - spent, 4),
+        "uncached_cost_usd": round(baseline, 4),
+    }
+
+
+def _ints(text: str) -> List[int]:
+    return sorted({int(float(v)) for v in text.split(",") if v.strip()})
+
+
+def _fmt_bytes(n: int) -> str:
+    value = float(n)
+    for unit in ("B", "KiB", "MiB"):
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GiB"
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Replay a question log through the answer cache")
+    parser.add_argument("logs", nargs="+", help="NDJSON files with ts and question per line")
+    parser.add_argument("--sizes", default=f"100,500,{main.ANSWER_CACHE_MAX_ENTRIES},2000,10000",
+                        help="ANSWER_CACHE_MAX_ENTRIES values to try")
+    parser.add_argument("--ttls", default=f"3600,{main.ANSWER_CACHE_TTL_SECONDS},604800",
+                        help="ANSWER_CACHE_TTL_SECONDS values to try")
+    parser.add_argument("--policies", default="cost,lfu,lru", help="ANSWER_CACHE_POLICY values to try")
+    parser.add_argument("--max-bytes", type=int, default=main.ANSWER_CACHE_MAX_BYTES)
+    parser.add_argument("--stale-seconds", type=int, default=main.ANSWER_CACHE_STALE_SECONDS)
+    parser.add_argument("--stale-min-hits", type=int, default=main.ANSWER_CACHE_STALE_MIN_HITS)
+    parser.add_argument("--cost-usd", type=float, default=0.0005, help="per-answer cost when the log has none")
+    parser.add_argument("--bytes", type=int, default=1500, help="per-answer size when the log has none")
+    parser.add_argument("--json", dest="json_out", default=None, help="write all results to this file")
+    args = parser.parse_args()
+
+    events = load_log(args.logs)
+    if not events:
+        sys.exit("No replayable lines (need ts and question).")
+    per_key, measured = measure(events, args.cost_usd, args.bytes)
+    span_h = (events[-1]["ts"] - events[0]["ts"]) / 3600.0
+    print(f"{len(events)} requests, {len(per_key)} distinct questions over {span_h:.1f} h; "
+          f"median cost ${measured['median_cost_usd']}, median size {measured['median_bytes']} B "
+          f"({measured['measured_costs']} costs, {measured['measured_sizes']} sizes measured)")
+
+    results = []
+    for policy in [p.strip().lower() for p in args.policies.split(",") if p.strip()]:
+        for ttl in _ints(args.ttls):
+            for size in _ints(args.sizes):
+                results.append(simulate(events, per_key, size, ttl, policy, args.max_bytes,
+                                        args.stale_seconds, args.stale_min_hits))
+
+    print(f"{'policy':<7}{'entries':>8}{'ttl_s':>9}{'hit%':>8}{'stale':>7}{'peak mem':>11}"
+          f"{'evicted':>9}{'cost $':>10}{'saved $':>10}")
+    for r in results:
+        print(f"{r['policy']:<7}{r['max_entries']:>8}{r['ttl_seconds']:>9}{100 * r['hit_ratio']:>7.1f}%"
+              f"{r['stale_hits']:>7}{_fmt_bytes(r['peak_bytes']):>11}{r['evicted']:>9}"
+              f"{r['cost_usd']:>10.4f}{r['saved_usd']:>10.4f}")
+
+    # Smallest cache that keeps 99% of the best savings
+    best = max(r["saved_usd"] for r in results)
+    enough = [r for r in results if r["saved_usd"] >= 0.99 * best]
+    pick = min(enough, key=lambda r: (r["peak_bytes"], r["max_entries"], -r["saved_usd"]))
+    print(f"\nsmallest within 1% of the best savings: ANSWER_CACHE_POLICY={pick['policy']} "
+          f"ANSWER_CACHE_MAX_ENTRIES={pick['max_entries']} ANSWER_CACHE_TTL_SECONDS={pick['ttl_seconds']} "
+          f"(hit ratio {100 * pick['hit_ratio']:.1f}%, peak {_fmt_bytes(pick['peak_bytes'])}, "
+          f"saves ${pick['saved_usd']:.4f} of ${pick['uncached_cost_usd']:.4f})")
+
+    if args.json_out:
+        Path(args.json_out).write_text(json.dumps({"measured": measured, "results": results}, indent=2),
+                                       encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,479 @@
+"""
+Local stand-in for the OpenAI endpoints the ERP Help Assistant uses.
+
+Covers files, vector stores (files and file batches), assistants, threads,
+messages, runs (polled and streamed) and streaming chat completions, with
+configurable run latency and token usage. Point the server at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1. Every call is counted; GET /_stats
+returns the counts and POST /_reset clears them. POST /_outage {"error_ratio": 1.0}
+makes that fraction of API calls fail with a 503 until it is set back to 0.
+
+    python server/fake_openai.py --port 8900 --run-latency 2.0
+"""
+
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import Counter
+from typing import Dict, Any, AsyncIterator, List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+# ---------------------------
+# Configuration (env, so uvicorn workers and the benchmark can set it)
+# ---------------------------
+
+RUN_LATENCY_SECONDS = float(os.getenv("FAKE_RUN_LATENCY_SECONDS", "2.0"))
+RUN_JITTER_SECONDS = float(os.getenv("FAKE_RUN_JITTER_SECONDS", "0.5"))
+RUN_QUEUE_SECONDS = float(os.getenv("FAKE_RUN_QUEUE_SECONDS", "0.2"))
+API_LATENCY_SECONDS = float(os.getenv("FAKE_API_LATENCY_SECONDS", "0.03"))
+PROMPT_TOKENS = int(os.getenv("FAKE_PROMPT_TOKENS", "3000"))
+COMPLETION_TOKENS = int(os.getenv("FAKE_COMPLETION_TOKENS", "250"))
+STREAM_DELTAS = int(os.getenv("FAKE_STREAM_DELTAS", "20"))
+# Fraction of run/chat creations answered with 429, to exercise retries
+RATE_LIMIT_RATIO = float(os.getenv("FAKE_RATE_LIMIT_RATIO", "0"))
+# Fraction of all API calls answered with a 5xx, to exercise the circuit breaker (POST /_outage changes it)
+OUTAGE: Dict[str, Any] = {"error_ratio": float(os.getenv("FAKE_ERROR_RATIO", "0")), "status": 503}
+
+app = FastAPI(title="Fake OpenAI")
+
+_ids = itertools.count(1)
+CALLS: Counter = Counter()
+FILES: Dict[str, Dict[str, Any]] = {}
+STORES: Dict[str, Dict[str, Any]] = {}
+STORE_FILES: Dict[str, Dict[str, Dict[str, Any]]] = {}
+ASSISTANTS: Dict[str, Dict[str, Any]] = {}
+THREADS: Dict[str, List[Dict[str, Any]]] = {}
+RUNS: Dict[str, Dict[str, Any]] = {}
+BATCHES: Dict[str, Dict[str, Any]] = {}
+
+
+def _id(prefix: str) -> str:
+    return f"{prefix}_fake{next(_ids):06d}"
+
+
+def _now() -> int:
+    return int(time.time())
+
+
+def _list(data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": False,
+    }
+
+
+async def _api_call(name: str) -> None:
+    CALLS[name] += 1
+    if API_LATENCY_SECONDS:
+        await asyncio.sleep(API_LATENCY_SECONDS)
+
+
+def _maybe_rate_limit() -> None:
+    if RATE_LIMIT_RATIO and random.random() < RATE_LIMIT_RATIO:
+        CALLS["429"] += 1
+        raise HTTPException(status_code=429, detail="Rate limit reached (fake)",
+                            headers={"retry-after-ms": "200"})
+
+
+def _usage() -> Dict[str, int]:
+    return {"prompt_tokens": PROMPT_TOKENS, "completion_tokens": COMPLETION_TOKENS,
+            "total_tokens": PROMPT_TOKENS + COMPLETION_TOKENS}
+
+
+# ---------------------------
+# Bookkeeping
+# ---------------------------
+
+@app.get("/_stats")
+def stats() -> Dict[str, Any]:
+    return {"calls": dict(CALLS), "total": sum(v for k, v in CALLS.items() if not k.isdigit())}
+
+
+@app.post("/_reset")
+def reset() -> Dict[str, str]:
+    CALLS.clear()
+    return {"status": "ok"}
+
+
+@app.post("/_outage")
+async def outage(request: Request) -> Dict[str, Any]:
+    body = await request.json()
+    OUTAGE.update({k: body[k] for k in ("error_ratio", "status") if k in body})
+    return dict(OUTAGE)
+
+
+@app.middleware("http")
+async def _inject_errors(request: Request, call_next: Any) -> Any:
+    if request.url.path.startswith("/v1/") and OUTAGE["error_ratio"] and random.random() < OUTAGE["error_ratio"]:
+        CALLS[str(OUTAGE["status"])] += 1
+        return JSONResponse({"error": {"message": "Upstream unavailable (fake)", "type": "server_error"}},
+                            status_code=OUTAGE["status"])
+    return await call_next(request)
+
+
+# ---------------------------
+# Files and vector stores
+# ---------------------------
+
+@app.post("/v1/files")
+async def files_create(request: Request) -> Dict[str, Any]:
+    await _api_call("files.create")
+    body = await request.body()
+    # Multipart is not parsed; the file name is all we need
+    m = re.search(rb'filename="([^"]+)"', body)
+    fo = {
+        "id": _id("file"),
+        "object": "file",
+        "bytes": len(body),
+        "created_at": _now(),
+        "filename": m.group(1).decode("utf-8", "replace") if m else "upload.md",
+        "purpose": "assistants",
+        "status": "processed",
+    }
+    FILES[fo["id"]] = fo
+    return fo
+
+
+@app.get("/v1/files")
+async def files_list() -> Dict[str, Any]:
+    await _api_call("files.list")
+    return _list(list(FILES.values()))
+
+
+@app.get("/v1/files/{file_id}")
+async def files_retrieve(file_id: str) -> Dict[str, Any]:
+    await _api_call("files.retrieve")
+    if file_id not in FILES:
+        raise HTTPException(status_code=404, detail="No such file")
+    return FILES[file_id]
+
+
+@app.delete("/v1/files/{file_id}")
+async def files_delete(file_id: str) -> Dict[str, Any]:
+    await _api_call("files.delete")
+    FILES.pop(file_id, None)
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+def _store_obj(store_id: str) -> Dict[str, Any]:
+    store = STORES[store_id]
+    n = len(STORE_FILES.get(store_id, {}))
+    return {**store, "file_counts": {"in_progress": 0, "completed": n, "failed": 0, "cancelled": 0, "total": n}}
+
+
+@app.post("/v1/vector_stores")
+async def vector_stores_create(request: Request) -> Dict[str, Any]:
+    await _api_call("vector_stores.create")
+    body = await request.json()
+    store_id = _id("vs")
+    STORES[store_id] = {"id": store_id, "object": "vector_store", "created_at": _now(),
+                        "name": body.get("name", ""), "status": "completed", "usage_bytes": 0,
+                        "metadata": {}}
+    STORE_FILES[store_id] = {}
+    return _store_obj(store_id)
+
+
+@app.get("/v1/vector_stores/{store_id}")
+async def vector_stores_retrieve(store_id: str) -> Dict[str, Any]:
+    await _api_call("vector_stores.retrieve")
+    if store_id not in STORES:
+        raise HTTPException(status_code=404, detail="No such vector store")
+    return _store_obj(store_id)
+
+
+@app.delete("/v1/vector_stores/{store_id}")
+async def vector_stores_delete(store_id: str) -> Dict[str, Any]:
+    await _api_call("vector_stores.delete")
+    STORES.pop(store_id, None)
+    STORE_FILES.pop(store_id, None)
+    return {"id": store_id, "object": "vector_store.deleted", "deleted": True}
+
+
+@app.post("/v1/vector_stores/{store_id}/file_batches")
+async def file_batches_create(store_id: str, request: Request) -> Dict[str, Any]:
+    await _api_call("vector_stores.file_batches.create")
+    if store_id not in STORES:
+        raise HTTPException(status_code=404, detail="No such vector store")
+    body = await request.json()
+    for fid in body.get("file_ids", []):
+        STORE_FILES[store_id][fid] = {"id": fid, "object": "vector_store.file", "vector_store_id": store_id,
+                                      "status": "completed", "created_at": _now(), "usage_bytes": 0,
+                                      "last_error": None}
+    n = len(body.get("file_ids", []))
+    # Indexed at once, so create_and_poll's first poll sees it completed
+    batch = {"id": _id("vsfb"), "object": "vector_store.files_batch", "vector_store_id": store_id,
+             "created_at": _now(), "status": "completed",
+             "file_counts": {"in_progress": 0, "completed": n, "failed": 0, "cancelled": 0, "total": n}}
+    BATCHES[batch["id"]] = batch
+    return batch
+
+
+@app.get("/v1/vector_stores/{store_id}/file_batches/{batch_id}")
+async def file_batches_retrieve(store_id: str, batch_id: str) -> Dict[str, Any]:
+    await _api_call("vector_stores.file_batches.retrieve")
+    if batch_id not in BATCHES:
+        raise HTTPException(status_code=404, detail="No such file batch")
+    return BATCHES[batch_id]
+
+
+@app.get("/v1/vector_stores/{store_id}/files")
+async def vector_store_files_list(store_id: str) -> Dict[str, Any]:
+    await _api_call("vector_stores.files.list")
+    return _list(list(STORE_FILES.get(store_id, {}).values()))
+
+
+@app.delete("/v1/vector_stores/{store_id}/files/{file_id}")
+async def vector_store_files_delete(store_id: str, file_id: str) -> Dict[str, Any]:
+    await _api_call("vector_stores.files.delete")
+    if file_id not in STORE_FILES.get(store_id, {}):
+        raise HTTPException(status_code=404, detail="No such vector store file")
+    del STORE_FILES[store_id][file_id]
+    return {"id": file_id, "object": "vector_store.file.deleted", "deleted": True}
+
+
+# ---------------------------
+# Assistants, threads, messages
+# ---------------------------
+
+@app.post("/v1/assistants")
+async def assistants_create(request: Request) -> Dict[str, Any]:
+    await _api_call("assistants.create")
+    body = await request.json()
+    asst = {"id": _id("asst"), "object": "assistant", "created_at": _now(), "name": body.get("name"),
+            "model": body.get("model", ""), "instructions": body.get("instructions", ""),
+            "tools": body.get("tools", []), "tool_resources": body.get("tool_resources", {}), "metadata": {}}
+    ASSISTANTS[asst["id"]] = asst
+    return asst
+
+
+@app.get("/v1/assistants/{assistant_id}")
+async def assistants_retrieve(assistant_id: str) -> Dict[str, Any]:
+    await _api_call("assistants.retrieve")
+    if assistant_id not in ASSISTANTS:
+        raise HTTPException(status_code=404, detail="No such assistant")
+    return ASSISTANTS[assistant_id]
+
+
+@app.delete("/v1/assistants/{assistant_id}")
+async def assistants_delete(assistant_id: str) -> Dict[str, Any]:
+    await _api_call("assistants.delete")
+    ASSISTANTS.pop(assistant_id, None)
+    return {"id": assistant_id, "object": "assistant.deleted", "deleted": True}
+
+
+@app.post("/v1/threads")
+async def threads_create(request: Request) -> Dict[str, Any]:
+    await _api_call("threads.create")
+    body = await request.json() if await request.body() else {}
+    thread_id = _id("thread")
+    THREADS[thread_id] = [_message(thread_id, m.get("role", "user"), str(m.get("content", "")))
+                          for m in body.get("messages", [])]
+    return {"id": thread_id, "object": "thread", "created_at": _now(), "metadata": {}}
+
+
+def _message(thread_id: str, role: str, text: str, annotations: Optional[List[Dict[str, Any]]] = None,
+             run_id: Optional[str] = None) -> Dict[str, Any]:
+    return {"id": _id("msg"), "object": "thread.message", "created_at": _now(), "thread_id": thread_id,
+            "role": role, "status": "completed", "run_id": run_id, "assistant_id": None, "attachments": [],
+            "metadata": {}, "content": [{"type": "text", "text": {"value": text, "annotations": annotations or []}}]}
+
+
+@app.post("/v1/threads/{thread_id}/messages")
+async def messages_create(thread_id: str, request: Request) -> Dict[str, Any]:
+    await _api_call("threads.messages.create")
+    if thread_id not in THREADS:
+        raise HTTPException(status_code=404, detail="No such thread")
+    body = await request.json()
+    msg = _message(thread_id, body.get("role", "user"), str(body.get("content", "")))
+    THREADS[thread_id].append(msg)
+    return msg
+
+
+@app.get("/v1/threads/{thread_id}/messages")
+async def messages_list(thread_id: str) -> Dict[str, Any]:
+    await _api_call("threads.messages.list")
+    _finish_runs(thread_id)
+    return _list(list(reversed(THREADS.get(thread_id, []))))
+
+
+# ---------------------------
+# Runs
+# ---------------------------
+
+def _answer_for(thread_id: str) -> Dict[str, Any]:
+    # Echo the question and cite the first uploaded guide, like a file_search answer would
+    question = next((m["content"][0]["text"]["value"] for m in reversed(THREADS.get(thread_id, []))
+                     if m["role"] == "user"), "")
+    text = f"Fake answer for: {question}. Open the menu, choose the module and follow the steps. 【4:0†source】"
+    file_id = next(iter(FILES), None)
+    annotations = []
+    if file_id:
+        marker = "【4:0†source】"
+        start = text.index(marker)
+        annotations.append({"type": "file_citation", "text": marker, "start_index": start,
+                            "end_index": start + len(marker), "file_citation": {"file_id": file_id}})
+    return {"text": text, "annotations": annotations}
+
+
+def _run_obj(run: Dict[str, Any]) -> Dict[str, Any]:
+    elapsed = time.time() - run["t0"]
+    if run["status"] not in ("cancelled",):
+        if elapsed >= run["duration"]:
+            run["status"] = "completed"
+        elif elapsed >= RUN_QUEUE_SECONDS:
+            run["status"] = "in_progress"
+    done = run["status"] == "completed"
+    return {
+        "id": run["id"], "object": "thread.run", "created_at": int(run["t0"]), "thread_id": run["thread_id"],
+        "assistant_id": run["assistant_id"], "status": run["status"], "model": "fake", "instructions": "",
+        "tools": [{"type": "file_search"}], "metadata": {}, "last_error": None, "required_action": None,
+        "started_at": int(run["t0"] + RUN_QUEUE_SECONDS) if elapsed >= RUN_QUEUE_SECONDS else None,
+        "completed_at": int(run["t0"] + run["duration"]) if done else None,
+        "cancelled_at": None, "failed_at": None, "expires_at": None, "incomplete_details": None,
+        "usage": _usage() if done else None, "parallel_tool_calls": True,
+        "response_format": "auto", "tool_choice": "auto", "truncation_strategy": None,
+    }
+
+
+def _finish_runs(thread_id: str) -> None:
+    # Completed runs leave their answer on the thread
+    for run in RUNS.values():
+        if run["thread_id"] == thread_id and not run["answered"] and _run_obj(run)["status"] == "completed":
+            run["answered"] = True
+            answer = _answer_for(thread_id)
+            THREADS[thread_id].append(_message(thread_id, "assistant", answer["text"], answer["annotations"],
+                                               run_id=run["id"]))
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _run_events(run: Dict[str, Any]) -> AsyncIterator[str]:
+    yield _sse("thread.run.created", _run_obj(run))
+    yield _sse("thread.run.queued", _run_obj(run))
+    await asyncio.sleep(RUN_QUEUE_SECONDS)
+    yield _sse("thread.run.in_progress", _run_obj(run))
+    answer = _answer_for(run["thread_id"])
+    msg = _message(run["thread_id"], "assistant", answer["text"], answer["annotations"], run_id=run["id"])
+    yield _sse("thread.message.created", {**msg, "status": "in_progress", "content": []})
+    text = answer["text"]
+    step = max(1, len(text) // max(1, STREAM_DELTAS))
+    pieces = [text[i:i + step] for i in range(0, len(text), step)]
+    pause = max(0.0, run["duration"] - RUN_QUEUE_SECONDS) / max(1, len(pieces))
+    for i, piece in enumerate(pieces):
+        await asyncio.sleep(pause)
+        content = {"index": 0, "type": "text", "text": {"value": piece, "annotations": []}}
+        if i == len(pieces) - 1:
+            content["text"]["annotations"] = [dict(a, index=0) for a in answer["annotations"]]
+        yield _sse("thread.message.delta", {"id": msg["id"], "object": "thread.message.delta",
+                                            "delta": {"content": [content]}})
+    THREADS[run["thread_id"]].append(msg)
+    run["answered"] = True
+    yield _sse("thread.message.completed", msg)
+    run["duration"] = min(run["duration"], time.time() - run["t0"])
+    yield _sse("thread.run.completed", _run_obj(run))
+    yield "event: done\ndata: [DONE]\n\n"
+
+
+@app.post("/v1/threads/{thread_id}/runs")
+async def runs_create(thread_id: str, request: Request) -> Any:
+    await _api_call("threads.runs.create")
+    _maybe_rate_limit()
+    if thread_id not in THREADS:
+        raise HTTPException(status_code=404, detail="No such thread")
+    body = await request.json()
+    duration = max(RUN_QUEUE_SECONDS, random.gauss(RUN_LATENCY_SECONDS, RUN_JITTER_SECONDS))
+    run = {"id": _id("run"), "thread_id": thread_id, "assistant_id": body.get("assistant_id", ""),
+           "t0": time.time(), "duration": duration, "status": "queued", "answered": False}
+    RUNS[run["id"]] = run
+    if body.get("stream"):
+        return StreamingResponse(_run_events(run), media_type="text/event-stream")
+    return _run_obj(run)
+
+
+@app.get("/v1/threads/{thread_id}/runs/{run_id}")
+async def runs_retrieve(thread_id: str, run_id: str) -> Dict[str, Any]:
+    await _api_call("threads.runs.retrieve")
+    if run_id not in RUNS:
+        raise HTTPException(status_code=404, detail="No such run")
+    obj = _run_obj(RUNS[run_id])
+    _finish_runs(thread_id)
+    return obj
+
+
+@app.post("/v1/threads/{thread_id}/runs/{run_id}/cancel")
+async def runs_cancel(thread_id: str, run_id: str) -> Dict[str, Any]:
+    await _api_call("threads.runs.cancel")
+    if run_id not in RUNS:
+        raise HTTPException(status_code=404, detail="No such run")
+    RUNS[run_id]["status"] = "cancelled"
+    return _run_obj(RUNS[run_id])
+
+
+# ---------------------------
+# Chat completions (fast mode)
+# ---------------------------
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request) -> Any:
+    await _api_call("chat.completions.create")
+    _maybe_rate_limit()
+    body = await request.json()
+    question = str(body.get("messages", [{}])[-1].get("content", ""))[-200:]
+    text = f"Fake answer for: {question.split('Question:')[-1].strip()}. Follow the steps in the guide [1]."
+    completion_id = _id("chatcmpl")
+    duration = max(0.0, random.gauss(RUN_LATENCY_SECONDS, RUN_JITTER_SECONDS)) / 2
+
+    def chunk(delta: Dict[str, Any], finish: Optional[str] = None, usage: Any = None) -> str:
+        payload = {"id": completion_id, "object": "chat.completion.chunk", "created": _now(), "model": "fake",
+                   "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish}]}
+        if usage:
+            payload["usage"] = usage
+        return f"data: {json.dumps(payload)}\n\n"
+
+    async def events() -> AsyncIterator[str]:
+        step = max(1, len(text) // max(1, STREAM_DELTAS))
+        pieces = [text[i:i + step] for i in range(0, len(text), step)]
+        yield chunk({"role": "assistant", "content": ""})
+        for piece in pieces:
+            await asyncio.sleep(duration / max(1, len(pieces)))
+            yield chunk({"content": piece})
+        yield chunk({}, finish="stop")
+        yield chunk({}, usage=_usage())
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI API")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--run-latency", type=float, default=RUN_LATENCY_SECONDS)
+    parser.add_argument("--run-jitter", type=float, default=RUN_JITTER_SECONDS)
+    parser.add_argument("--queue-latency", type=float, default=RUN_QUEUE_SECONDS)
+    parser.add_argument("--api-latency", type=float, default=API_LATENCY_SECONDS)
+    parser.add_argument("--prompt-tokens", type=int, default=PROMPT_TOKENS)
+    parser.add_argument("--completion-tokens", type=int, default=COMPLETION_TOKENS)
+    parser.add_argument("--rate-limit-ratio", type=float, default=RATE_LIMIT_RATIO)
+    parser.add_argument("--error-ratio", type=float, default=OUTAGE["error_ratio"])
+    args = parser.parse_args()
+    RUN_LATENCY_SECONDS, RUN_JITTER_SECONDS = args.run_latency, args.run_jitter
+    RUN_QUEUE_SECONDS, API_LATENCY_SECONDS = args.queue_latency, args.api_latency
+    PROMPT_TOKENS, COMPLETION_TOKENS = args.prompt_tokens, args.completion_tokens
+    RATE_LIMIT_RATIO = args.rate_limit_ratio
+    OUTAGE["error_ratio"] = args.error_ratio
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -1,17 +1,36 @@
 import os
+import re
+import asyncio
 import json
+import math
+import calendar
+import gzip
+import html
 import time
+import heapq
+import random
+import itertools
+import sqlite3
+import hashlib
+import threading
+import contextvars
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Set
+from typing import Dict, Any, AsyncIterator, Callable, List, Optional, Set, Tuple
 
+import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import ORJSONResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from collections import OrderedDict
-from openai import OpenAI, APIConnectionError, APIStatusError
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, field_validator
+from collections import OrderedDict, deque
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError, APIStatusError, NotFoundError
+try:
+    import brotli  # optional: /docs then also serves Brotli (Content-Encoding: br)
+except ImportError:
+    brotli = None
 
 # Load environment variables
 load_dotenv()
@@ -19,7 +38,8 @@ load_dotenv()
 # Constants and paths
 BASE_DIR = Path(__file__).resolve().parent.parent
 HELP_DOCS_DIR = BASE_DIR / "help_docs"
-STATE_DIR = Path(__file__).resolve().parent
+# Where the assistant state, answer cache and search index live (the benchmark points this at a temp dir)
+STATE_DIR = Path(os.getenv("STATE_DIR", str(Path(__file__).resolve().parent)))
 STATE_FILE = STATE_DIR / "assistant_state.json"
 
 # Ensure help docs exist
@@ -29,7 +49,41 @@ if not HELP_DOCS_DIR.exists():
 # Initialize OpenAI client (requires OPENAI_API_KEY in environment)
 if not os.getenv("OPENAI_API_KEY"):
     raise RuntimeError("OPENAI_API_KEY is not set. Create a .env file or export the variable in your shell.")
-client = OpenAI()
+# One shared async client: every request multiplexes over the same connection pool
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "50"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+# Client-side rate limits for MODEL (0 = unlimited); set them to your organization's tier
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+# 429s and connection failures (and timeouts/5xx on idempotent calls) are retried by _openai()
+# with jittered exponential backoff
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_RETRY_BASE_SECONDS = float(os.getenv("OPENAI_RETRY_BASE_SECONDS", "0.5"))
+OPENAI_RETRY_MAX_SECONDS = float(os.getenv("OPENAI_RETRY_MAX_SECONDS", "20"))
+# Circuit breaker: OpenAI calls fail fast for BREAKER_OPEN_SECONDS once BREAKER_ERROR_RATIO of the attempts
+# in the last BREAKER_WINDOW_SECONDS (at least BREAKER_MIN_CALLS of them), or BREAKER_CONSECUTIVE_FAILURES
+# in a row, hit a 5xx, timeout or connection error. Meanwhile cached answers up to BREAKER_STALE_SECONDS
+# past their TTL are served, marked stale.
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "true").lower() in ("1", "true", "yes")
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "30"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATIO = float(os.getenv("BREAKER_ERROR_RATIO", "0.5"))
+BREAKER_CONSECUTIVE_FAILURES = int(os.getenv("BREAKER_CONSECUTIVE_FAILURES", "5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+BREAKER_STALE_SECONDS = int(os.getenv("BREAKER_STALE_SECONDS", str(7 * 86400)))
+client = AsyncOpenAI(
+    timeout=OPENAI_TIMEOUT_SECONDS,
+    # Retries go through the rate scheduler instead
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=30.0,
+        ),
+    ),
+)
 MODEL = os.getenv("ASSISTANT_MODEL", "gpt-4o-nano")
 
 # Approximate 2025 pricing per 1M tokens (input, output)
@@ -41,47 +95,563 @@ _input_ppm, _output_ppm = _PRICES.get(MODEL, _PRICES["gpt-4o-mini"])
 INPUT_PRICE_PER_TOKEN = _input_ppm / 1_000_000
 OUTPUT_PRICE_PER_TOKEN = _output_ppm / 1_000_000
 
+# Answer mode: "assistant" (Assistants API + file_search) or "fast" (local retrieval + one chat call)
+ANSWER_MODE = os.getenv("ANSWER_MODE", "assistant").lower()
+FAST_CONTEXT_TOKEN_BUDGET = int(os.getenv("FAST_CONTEXT_TOKEN_BUDGET", "2500"))
+FAST_CONTEXT_MAX_SECTIONS = int(os.getenv("FAST_CONTEXT_MAX_SECTIONS", "8"))
+
+# Per-module stores: /setup can also build a vector store + assistant per guide (or per group of
+# guides, "Name=Guide,Guide;..." with guides named by the part after " - ") and a local router sends
+# each question to the one or two modules its BM25 section hits concentrate on, or to the combined
+# store when they are spread out (top module below ROUTING_MIN_SHARE of the score, top two below
+# ROUTING_PAIR_SHARE) or weaker than ROUTING_MIN_SCORE.
+MODULE_STORES = os.getenv("MODULE_STORES", "false").lower() in ("1", "true", "yes")
+MODULE_GROUPS = os.getenv("MODULE_GROUPS", "")
+ROUTING_MIN_SHARE = float(os.getenv("ROUTING_MIN_SHARE", "0.5"))
+ROUTING_PAIR_SHARE = float(os.getenv("ROUTING_PAIR_SHARE", "0.7"))
+ROUTING_MIN_SCORE = float(os.getenv("ROUTING_MIN_SCORE", "5.0"))
+ROUTING_TOP_SECTIONS = int(os.getenv("ROUTING_TOP_SECTIONS", "8"))
+
+# Run limits; /ask/stream also sends an SSE comment when the run is quiet this long
+RUN_TIMEOUT_SECONDS = float(os.getenv("RUN_TIMEOUT_SECONDS", "120"))
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("STREAM_KEEPALIVE_SECONDS", "10"))
+
+# Follow-ups on a reused thread_id: each run sees only the recent conversation, either the turns
+# that fit in CONVERSATION_WINDOW_TOKENS ("window") or the last CONVERSATION_MAX_TURNS ("turns").
+# Once a thread's history passes CONVERSATION_ROLLOVER_TOKENS (0 = never) the next question moves
+# to a fresh thread seeded with the last CONVERSATION_CARRYOVER_TURNS turns, answers clipped to
+# CONVERSATION_CARRYOVER_TOKENS in total.
+CONVERSATION_POLICY = os.getenv("CONVERSATION_POLICY", "window").lower()
+CONVERSATION_WINDOW_TOKENS = int(os.getenv("CONVERSATION_WINDOW_TOKENS", "2000"))
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "6"))
+CONVERSATION_ROLLOVER_TOKENS = int(os.getenv("CONVERSATION_ROLLOVER_TOKENS", "8000"))
+CONVERSATION_CARRYOVER_TURNS = int(os.getenv("CONVERSATION_CARRYOVER_TURNS", "2"))
+CONVERSATION_CARRYOVER_TOKENS = int(os.getenv("CONVERSATION_CARRYOVER_TOKENS", "400"))
+CONVERSATION_MAX_THREADS = int(os.getenv("CONVERSATION_MAX_THREADS", "10000"))
+
+# Run polling: first poll early, then poll at the observed run-duration quantiles, then back off.
+# RUN_TRANSPORT=stream makes /ask consume the run event stream instead of polling at all.
+RUN_TRANSPORT = os.getenv("RUN_TRANSPORT", "poll").lower()
+POLL_FIRST_DELAY_SECONDS = float(os.getenv("POLL_FIRST_DELAY_SECONDS", "0.3"))
+POLL_MIN_INTERVAL_SECONDS = float(os.getenv("POLL_MIN_INTERVAL_SECONDS", "0.15"))
+POLL_MAX_INTERVAL_SECONDS = float(os.getenv("POLL_MAX_INTERVAL_SECONDS", "2.0"))
+# A runs.retrieve slower than this gets a second, hedged request; first answer wins
+POLL_HEDGE_AFTER_SECONDS = float(os.getenv("POLL_HEDGE_AFTER_SECONDS", "1.0"))
+
+# /ask/batch: questions per request, and how many uncached answers run at once
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "64"))
+
+# Include the per-stage meta.timings breakdown in every answer (requests can also ask with "timings": true)
+META_TIMINGS = os.getenv("META_TIMINGS", "false").lower() in ("1", "true", "yes")
+
+# Admission control: answers (cache misses) running at once per endpoint, and how many more may
+# wait, for how long, before getting a 503 with Retry-After. BATCH_MAX_ACTIVE counts whole batches.
+ASK_MAX_CONCURRENCY = int(os.getenv("ASK_MAX_CONCURRENCY", "32"))
+ASK_STREAM_MAX_CONCURRENCY = int(os.getenv("ASK_STREAM_MAX_CONCURRENCY", "64"))
+BATCH_MAX_ACTIVE = int(os.getenv("BATCH_MAX_ACTIVE", "2"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+# Cache-only mode while OpenAI is throttling us or this many calls wait in the rate scheduler
+DEGRADE_WHEN_SATURATED = os.getenv("DEGRADE_WHEN_SATURATED", "true").lower() in ("1", "true", "yes")
+DEGRADE_RATE_QUEUE_DEPTH = int(os.getenv("DEGRADE_RATE_QUEUE_DEPTH", "100"))
+# Usage ledger: answers, cache hits, tokens and cost per UTC day, model and endpoint, appended to a
+# sqlite file shared by all workers every USAGE_LEDGER_FLUSH_SECONDS
+USAGE_LEDGER_PATH = Path(os.getenv("USAGE_LEDGER_PATH", str(STATE_DIR / "usage_ledger.sqlite3")))
+USAGE_LEDGER_FLUSH_SECONDS = float(os.getenv("USAGE_LEDGER_FLUSH_SECONDS", "10"))
+# Spend caps in USD per UTC day and calendar month (0 = none). Past BUDGET_EXTEND_TTL_AT of a cap cached
+# answers stay fresh BUDGET_TTL_MULTIPLIER times longer; past BUDGET_SEMANTIC_AT near-duplicates down to
+# BUDGET_SEMANTIC_THRESHOLD are reused; at the cap, questions the cache cannot answer get a 429.
+BUDGET_DAILY_USD = float(os.getenv("BUDGET_DAILY_USD", "0"))
+BUDGET_MONTHLY_USD = float(os.getenv("BUDGET_MONTHLY_USD", "0"))
+BUDGET_EXTEND_TTL_AT = float(os.getenv("BUDGET_EXTEND_TTL_AT", "0.7"))
+BUDGET_SEMANTIC_AT = float(os.getenv("BUDGET_SEMANTIC_AT", "0.9"))
+BUDGET_TTL_MULTIPLIER = float(os.getenv("BUDGET_TTL_MULTIPLIER", "4"))
+BUDGET_SEMANTIC_THRESHOLD = float(os.getenv("BUDGET_SEMANTIC_THRESHOLD", "0.75"))
+
+# Assistant/vector store existence is re-checked in the background at most this often
+STATE_REVALIDATE_SECONDS = float(os.getenv("STATE_REVALIDATE_SECONDS", "300"))
+# A failed background rebuild of a missing assistant/vector store is retried no sooner than this
+REBUILD_RETRY_SECONDS = float(os.getenv("REBUILD_RETRY_SECONDS", "30"))
+
+ASSISTANT_INSTRUCTIONS = (
+    "You are an ERP help center assistant. Answer strictly from the provided help documentation. "
+    "If the docs do not contain the answer, respond with: Not covered in our docs. "
+    "Provide step-by-step guidance and list the exact menu paths users should click. "
+    "Always include source citations indicating the document title and section. "
+    "Do not invent steps or features. Keep answers concise, 1–2 short paragraphs unless a numbered list of steps is necessary."
+)
+
 # Answer cache settings (to avoid re-paying for identical answers)
 ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))  # 24h
 ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+# Memory budget for serialized answers (0 = bounded by entry count only)
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Stale-while-revalidate: an expired answer requested at least ANSWER_CACHE_STALE_MIN_HITS
+# times recently is still served for this long past its TTL while one background run refreshes it
+ANSWER_CACHE_STALE_SECONDS = int(os.getenv("ANSWER_CACHE_STALE_SECONDS", "86400"))
+ANSWER_CACHE_STALE_MIN_HITS = int(os.getenv("ANSWER_CACHE_STALE_MIN_HITS", "2"))
+# Eviction: "cost" (frequency x cost / size), "lfu" (frequency / size) or "lru"
+ANSWER_CACHE_POLICY = os.getenv("ANSWER_CACHE_POLICY", "cost").lower()
+# "sqlite" persists answers across restarts and shares them between workers; "memory" is per-process
+ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND", "sqlite").lower()
+ANSWER_CACHE_PATH = Path(os.getenv("ANSWER_CACHE_PATH", str(STATE_DIR / "answer_cache.sqlite3")))
+# Near-duplicate tier: reuse an answer when a cached question is this similar (cosine, 0..1)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "50000"))
+# Append every answered /ask, /ask/stream and /ask/batch question (NDJSON) here, for replaying
+# through server/cache_replay.py; empty disables the log. Lines are buffered and appended every
+# QUERY_LOG_FLUSH_SECONDS (and at shutdown)
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH", "")
+QUERY_LOG_FLUSH_SECONDS = float(os.getenv("QUERY_LOG_FLUSH_SECONDS", "1"))
+# Cache warm-up: canonical questions (one per line) answered ahead of users, WARMUP_CONCURRENCY at a time,
+# after /setup and at startup. Startup warm-up defaults on only for the per-process memory cache;
+# the sqlite cache survives restarts.
+WARMUP_QUESTIONS_FILE = Path(os.getenv("WARMUP_QUESTIONS_FILE", str(Path(__file__).resolve().parent / "warmup_questions.txt")))
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+WARMUP_AFTER_SETUP = os.getenv("WARMUP_AFTER_SETUP", "true").lower() in ("1", "true", "yes")
+WARMUP_ON_STARTUP = os.getenv(
+    "WARMUP_ON_STARTUP", "true" if ANSWER_CACHE_BACKEND == "memory" else "false"
+).lower() in ("1", "true", "yes")
+# What a reindex does with answers that cite nothing (e.g. "Not covered in our docs"):
+# "evict" drops them whenever any document changed, "keep" leaves them to the TTL
+ANSWER_CACHE_UNCITED_POLICY = os.getenv("ANSWER_CACHE_UNCITED_POLICY", "evict").lower()
+
+
+class FrequencySketch:
+    """Count-min sketch of recent request frequency (TinyLFU).
+
+    Small saturating counters over a few hashed rows; every `sample` increments
+    all counters are halved so popularity from last week fades.
+    """
 
-class AnswerCache:
-    def __init__(self, max_entries: int, ttl_seconds: int):
+    _DEPTH = 4
+    _MAX_COUNT = 15
+
+    def __init__(self, capacity: int):
+        width = 64
+        while width < 4 * max(capacity, 1):
+            width *= 2
+        self.mask = width - 1
+        self.rows = [[0] * width for _ in range(self._DEPTH)]
+        self.sample = 10 * width
+        self.additions = 0
+        self._lock = threading.Lock()
+
+    def _indexes(self, key: str) -> List[int]:
+        h = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest(), "little")
+        return [(h >> (32 * i)) & self.mask for i in range(self._DEPTH)]
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            for row, i in zip(self.rows, self._indexes(key)):
+                if row[i] < self._MAX_COUNT:
+                    row[i] += 1
+            self.additions += 1
+            if self.additions >= self.sample:
+                for row in self.rows:
+                    for i, c in enumerate(row):
+                        row[i] = c >> 1
+                self.additions //= 2
+
+    def estimate(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+
+class AnswerCacheBackend(ABC):
+    """Interface for ANSWER_CACHE, plus the admission/eviction policy both backends share.
+
+    Size is bounded by entry count and by bytes of serialized answer. When full,
+    the victim is the lowest-value entry among the least recently used few, where
+    value = request frequency x recompute cost (cost_usd) / size, and a new answer is
+    only admitted if it is worth at least as much as that victim (TinyLFU-style).
+    Expired entries that are still requested often are served stale for up to
+    `stale_seconds` past the TTL while the caller refreshes them.
+    """
+
+    # How many LRU-tail entries compete for eviction
+    _SAMPLE = 8
+    # Keeps free answers (cost 0) comparable by frequency and size
+    _COST_FLOOR_USD = 1e-5
+
+    def __init__(self, max_entries: int, ttl_seconds: int, max_bytes: int = 0,
+                 stale_seconds: int = 0, stale_min_hits: int = 2, policy: str = "cost"):
+        if policy not in ("cost", "lfu", "lru"):
+            raise RuntimeError(f"Unknown ANSWER_CACHE_POLICY: {policy}. Use 'cost', 'lfu' or 'lru'.")
         self.max = max_entries
         self.ttl = ttl_seconds
+        # Added to the TTL while the spend budget is tight (see SpendBudget)
+        self.ttl_extension_s = 0
+        # While OpenAI is down (see CircuitBreaker), any answer this recently expired is served stale
+        self.outage_stale_s = 0
+        self.max_bytes = max_bytes
+        self.stale_s = stale_seconds
+        self.stale_min_hits = stale_min_hits
+        self.policy = policy
+        self.sketch = FrequencySketch(max_entries)
+        # Wall clock; server/cache_replay.py substitutes the timestamps of a query log
+        self.clock: Callable[[], float] = time.time
+        self.counters: Dict[str, int] = {"sets": 0, "rejected": 0, "evicted": 0, "expired": 0}
+
+    def _score(self, key: str, cost: float, size: int) -> float:
+        if self.policy == "lru":
+            # Every entry ties, so the victim is the least recently used and nothing is refused
+            return 0.0
+        if self.policy == "lfu":
+            return max(self.sketch.estimate(key), 1) / max(size, 1)
+        return max(self.sketch.estimate(key), 1) * (cost + self._COST_FLOOR_USD) / max(size, 1)
+
+    def _ttl(self) -> float:
+        return self.ttl + self.ttl_extension_s
+
+    def _serve_stale(self, key: str, age: float) -> bool:
+        if age <= self._ttl() + self.outage_stale_s:
+            return True
+        return age <= self._ttl() + self.stale_s and self.sketch.estimate(key) >= self.stale_min_hits
+
+    @staticmethod
+    def _entry_size_cost(value: Dict[str, Any]) -> Tuple[str, int, float]:
+        blob = json.dumps(value)
+        return blob, len(blob.encode("utf-8")), float(value.get("cost_usd") or 0.0)
+
+    @abstractmethod
+    def lookup(self, key: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        # Returns (value, stale); stale values are past their TTL and should be refreshed
+        ...
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value, stale = self.lookup(key)
+        return None if stale else value
+
+    @abstractmethod
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+    def warm(self) -> int:
+        # Load persisted entries (if any); returns how many are live
+        return 0
+
+    @abstractmethod
+    def keys(self) -> List[str]:
+        ...
+
+    @abstractmethod
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        # Live (or servable stale) entries, without refreshing their LRU position
+        ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def rename(self, old_key: str, new_key: str) -> bool:
+        # Moves an entry as it is (age, size and cost), bypassing admission; False when
+        # there is nothing to move or new_key already holds an answer (old_key is dropped)
+        ...
+
+    @abstractmethod
+    def size(self) -> Tuple[int, int]:
+        # (entries, bytes)
+        ...
+
+    def stats(self) -> Dict[str, Any]:
+        entries, nbytes = self.size()
+        return {
+            "entries": entries,
+            "bytes": nbytes,
+            "max_entries": self.max,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "stale_seconds": self.stale_s,
+            **self.counters,
+        }
+
+
+class AnswerCache(AnswerCacheBackend):
+    def __init__(self, max_entries: int, ttl_seconds: int, max_bytes: int = 0,
+                 stale_seconds: int = 0, stale_min_hits: int = 2, policy: str = "cost"):
+        super().__init__(max_entries, ttl_seconds, max_bytes, stale_seconds, stale_min_hits, policy)
         self.data: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.bytes = 0
+
+    def _over(self, extra_entries: int = 0, extra_bytes: int = 0) -> bool:
+        if len(self.data) + extra_entries > self.max:
+            return True
+        return bool(self.max_bytes) and self.bytes + extra_bytes > self.max_bytes
+
+    def _victim(self, exclude: str = "") -> Optional[str]:
+        sample = itertools.islice(((k, v) for k, v in self.data.items() if k != exclude), self._SAMPLE)
+        best = min(sample, key=lambda kv: self._score(kv[0], kv[1]["cost"], kv[1]["size"]), default=None)
+        return best[0] if best else None
+
+    def _remove(self, key: str) -> None:
+        item = self.data.pop(key, None)
+        if item:
+            self.bytes -= item["size"]
 
     def _evict_if_needed(self) -> None:
-        while len(self.data) > self.max:
-            self.data.popitem(last=False)
+        while self.data and self._over():
+            self._remove(self._victim())  # type: ignore[arg-type]
+            self.counters["evicted"] += 1
 
-    def get(self, key: str) -> Optional[Dict[str, Any]]:
-        now = time.time()
+    def lookup(self, key: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        self.sketch.add(key)
         item = self.data.get(key)
         if not item:
-            return None
-        if now - item["ts"] > self.ttl:
-            try:
-                del self.data[key]
-            except Exception:
-                pass
-            return None
+            return None, False
+        age = self.clock() - item["ts"]
+        stale = age > self._ttl()
+        if stale and not self._serve_stale(key, age):
+            self._remove(key)
+            self.counters["expired"] += 1
+            return None, False
         # refresh LRU
         self.data.move_to_end(key, last=True)
-        return item["value"]
+        return item["value"], stale
 
     def set(self, key: str, value: Dict[str, Any]) -> None:
-        now = time.time()
-        if key in self.data:
-            try:
-                del self.data[key]
-            except Exception:
-                pass
-        self.data[key] = {"ts": now, "value": value}
+        # Admission is decided first: a refused update keeps the answer already cached
+        _, size, cost = self._entry_size_cost(value)
+        if self.max_bytes and size > self.max_bytes:
+            self.counters["rejected"] += 1
+            return
+        old = self.data.get(key)
+        if self._over(0 if old else 1, size - (old["size"] if old else 0)):
+            victim = self._victim(exclude=key)
+            if victim is not None:
+                v = self.data[victim]
+                if self._score(key, cost, size) < self._score(victim, v["cost"], v["size"]):
+                    self.counters["rejected"] += 1
+                    return
+        self._remove(key)
+        self.data[key] = {"ts": self.clock(), "value": value, "size": size, "cost": cost}
+        self.bytes += size
+        self.counters["sets"] += 1
         self._evict_if_needed()
 
     def clear(self) -> None:
         self.data.clear()
+        self.bytes = 0
+
+    def warm(self) -> int:
+        return len(self.data)
+
+    def keys(self) -> List[str]:
+        return list(self.data.keys())
+
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        now = self.clock()
+        return [(k, item["value"]) for k, item in self.data.items() if now - item["ts"] <= self._ttl() + self.stale_s]
+
+    def delete(self, key: str) -> None:
+        self._remove(key)
+
+    def rename(self, old_key: str, new_key: str) -> bool:
+        item = self.data.pop(old_key, None)
+        if item is None:
+            return False
+        if new_key in self.data:
+            self.bytes -= item["size"]
+            return False
+        self.data[new_key] = item
+        return True
+
+    def size(self) -> Tuple[int, int]:
+        return len(self.data), self.bytes
+
+
+class SQLiteAnswerCache(AnswerCacheBackend):
+    """On-disk answer cache shared by every worker process.
+
+    WAL mode lets readers in other workers proceed while one writes. `ts` drives
+    the TTL and `atime` the LRU order; hits only rewrite `atime` once per
+    second per key to keep write contention between workers low. Each set()
+    is one IMMEDIATE transaction, so workers cannot overshoot the bounds
+    together, and triggers keep the entry and byte totals in `answers_meta`.
+    The frequency sketch and counters are per process.
+    """
+
+    _TOUCH_GRANULARITY_S = 1.0
+
+    def __init__(self, path: Path, max_entries: int, ttl_seconds: int, max_bytes: int = 0,
+                 stale_seconds: int = 0, stale_min_hits: int = 2, policy: str = "cost"):
+        super().__init__(max_entries, ttl_seconds, max_bytes, stale_seconds, stale_min_hits, policy)
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, ts REAL NOT NULL, atime REAL NOT NULL,"
+            " size INTEGER NOT NULL DEFAULT 0, cost REAL NOT NULL DEFAULT 0)"
+        )
+        # Tables created before entries were sized and costed
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(answers)")}
+        if "size" not in columns:
+            conn.execute("ALTER TABLE answers ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE answers SET size = length(CAST(value AS BLOB))")
+        if "cost" not in columns:
+            conn.execute("ALTER TABLE answers ADD COLUMN cost REAL NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS answers_atime ON answers(atime)")
+        # Running totals, so admission and eviction do not scan the table
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers_meta ("
+            " id INTEGER PRIMARY KEY CHECK (id = 1), entries INTEGER NOT NULL, bytes INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE TRIGGER IF NOT EXISTS answers_ins AFTER INSERT ON answers BEGIN"
+                     " UPDATE answers_meta SET entries = entries + 1, bytes = bytes + NEW.size; END")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS answers_del AFTER DELETE ON answers BEGIN"
+                     " UPDATE answers_meta SET entries = entries - 1, bytes = bytes - OLD.size; END")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS answers_upd AFTER UPDATE OF size ON answers BEGIN"
+                     " UPDATE answers_meta SET bytes = bytes - OLD.size + NEW.size; END")
+        with self._transaction(conn):
+            conn.execute("INSERT OR IGNORE INTO answers_meta SELECT 1, COUNT(*), COALESCE(SUM(size), 0) FROM answers")
+
+    @staticmethod
+    @contextmanager
+    def _transaction(conn: sqlite3.Connection) -> Any:
+        # Takes the write lock up front: the checks and the writes see the same table
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread, and never reuse one inherited across a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(str(self.path), timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size=67108864")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def lookup(self, key: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        self.sketch.add(key)
+        now = self.clock()
+        conn = self._conn()
+        row = conn.execute("SELECT value, ts, atime FROM answers WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None, False
+        value, ts, atime = row
+        age = now - ts
+        stale = age > self._ttl()
+        if stale and not self._serve_stale(key, age):
+            conn.execute("DELETE FROM answers WHERE key = ? AND ts = ?", (key, ts))
+            self.counters["expired"] += 1
+            return None, False
+        # refresh LRU
+        if now - atime > self._TOUCH_GRANULARITY_S:
+            conn.execute("UPDATE answers SET atime = ? WHERE key = ?", (now, key))
+        return json.loads(value), stale
+
+    def _over(self, conn: sqlite3.Connection, extra_entries: int = 0, extra_bytes: int = 0) -> bool:
+        count, nbytes = conn.execute("SELECT entries, bytes FROM answers_meta").fetchone()
+        if count + extra_entries > self.max:
+            return True
+        return bool(self.max_bytes) and nbytes + extra_bytes > self.max_bytes
+
+    def _victim(self, conn: sqlite3.Connection, exclude: str = "") -> Optional[Tuple[str, float]]:
+        rows = conn.execute(
+            "SELECT key, cost, size FROM answers WHERE key != ? ORDER BY atime ASC LIMIT ?", (exclude, self._SAMPLE)
+        ).fetchall()
+        scored = [(self._score(k, cost, size), k) for k, cost, size in rows]
+        if not scored:
+            return None
+        score, key = min(scored)
+        return key, score
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        now = self.clock()
+        blob, size, cost = self._entry_size_cost(value)
+        if self.max_bytes and size > self.max_bytes:
+            self.counters["rejected"] += 1
+            return
+        conn = self._conn()
+        with self._transaction(conn):
+            # Admission is decided first: a refused update keeps the answer already cached
+            old = conn.execute("SELECT size FROM answers WHERE key = ?", (key,)).fetchone()
+            if self._over(conn, 0 if old else 1, size - (old[0] if old else 0)):
+                victim = self._victim(conn, exclude=key)
+                if victim is not None and self._score(key, cost, size) < victim[1]:
+                    self.counters["rejected"] += 1
+                    return
+            conn.execute(
+                "INSERT INTO answers (key, value, ts, atime, size, cost) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET value = excluded.value, ts = excluded.ts, atime = excluded.atime,"
+                " size = excluded.size, cost = excluded.cost",
+                (key, blob, now, now, size, cost),
+            )
+            self.counters["sets"] += 1
+            self._evict_if_needed(conn)
+
+    def _evict_if_needed(self, conn: sqlite3.Connection) -> None:
+        while self._over(conn):
+            victim = self._victim(conn)
+            if victim is None:
+                return
+            conn.execute("DELETE FROM answers WHERE key = ?", (victim[0],))
+            self.counters["evicted"] += 1
+
+    def clear(self) -> None:
+        self._conn().execute("DELETE FROM answers")
+
+    def warm(self) -> int:
+        # Drop what expired (beyond the stale window) while we were down, re-apply the size
+        # bounds, and pull the remaining pages into the OS cache so the first lookups do not touch disk
+        conn = self._conn()
+        with self._transaction(conn):
+            conn.execute("DELETE FROM answers WHERE ts < ?", (self.clock() - self._ttl() - self.stale_s,))
+            self._evict_if_needed(conn)
+        count, _ = conn.execute("SELECT COUNT(*), SUM(length(value)) FROM answers").fetchone()
+        return count
+
+    def keys(self) -> List[str]:
+        return [k for (k,) in self._conn().execute("SELECT key FROM answers ORDER BY atime ASC")]
+
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        rows = self._conn().execute(
+            "SELECT key, value FROM answers WHERE ts >= ? ORDER BY atime ASC",
+            (self.clock() - self._ttl() - self.stale_s,),
+        )
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def delete(self, key: str) -> None:
+        self._conn().execute("DELETE FROM answers WHERE key = ?", (key,))
+
+    def rename(self, old_key: str, new_key: str) -> bool:
+        conn = self._conn()
+        with self._transaction(conn):
+            if conn.execute("SELECT 1 FROM answers WHERE key = ?", (new_key,)).fetchone():
+                conn.execute("DELETE FROM answers WHERE key = ?", (old_key,))
+                return False
+            return conn.execute("UPDATE answers SET key = ? WHERE key = ?", (new_key, old_key)).rowcount > 0
+
+    def size(self) -> Tuple[int, int]:
+        count, nbytes = self._conn().execute("SELECT entries, bytes FROM answers_meta").fetchone()
+        return count, nbytes
+
+
+def _make_answer_cache() -> AnswerCacheBackend:
+    policy = dict(max_bytes=ANSWER_CACHE_MAX_BYTES, stale_seconds=ANSWER_CACHE_STALE_SECONDS,
+                  stale_min_hits=ANSWER_CACHE_STALE_MIN_HITS, policy=ANSWER_CACHE_POLICY)
+    if ANSWER_CACHE_BACKEND == "sqlite":
+        return SQLiteAnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS, **policy)
+    if ANSWER_CACHE_BACKEND == "memory":
+        return AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS, **policy)
+    raise RuntimeError(f"Unknown ANSWER_CACHE_BACKEND: {ANSWER_CACHE_BACKEND}. Use 'sqlite' or 'memory'.")
+
 
 def _normalize_question(q: str) -> str:
     # trim, lowercase, collapse inner whitespace
@@ -90,10 +660,409 @@ def _normalize_question(q: str) -> str:
 def _cache_key(question: str, model: str, vector_store_id: str) -> str:
     return f"{model}|{vector_store_id}|{_normalize_question(question)}"
 
-ANSWER_CACHE = AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS)
+
+def _stem(token: str) -> str:
+    # Light suffix stripping so "orders"/"ordering"/"ordered" and "bom"/"boms" share a feature
+    if len(token) > 5 and token.endswith("ing"):
+        return token[:-3]
+    if len(token) > 4 and token.endswith("ed"):
+        return token[:-2]
+    if len(token) > 4 and token.endswith(("sses", "xes", "ches", "shes", "zes")):
+        return token[:-2]
+    if len(token) > 2 and token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    return token
+
+
+def _same_order(a: Tuple[str, ...], b: Tuple[str, ...]) -> bool:
+    """Whether two token sequences name the same entities in the same order.
+
+    Bag-of-words cosine cannot tell "move stock to WIP" from "move WIP to
+    stock", so a near-duplicate must also list its shared terms in the same
+    order, and mention exactly the same numbers and codes.
+    """
+    shared = set(a) & set(b)
+    if {t for t in a if any(ch.isdigit() for ch in t)} != {t for t in b if any(ch.isdigit() for ch in t)}:
+        return False
+    return list(dict.fromkeys(t for t in a if t in shared)) == list(dict.fromkeys(t for t in b if t in shared))
+
+
+class SemanticCache:
+    """Nearest cached question by TF-IDF cosine, partitioned by model and docs index.
+
+    Vectors are sparse {feature: tf} over stemmed words and adjacent word
+    pairs, so word order counts. An inverted index limits scoring to entries
+    that share one of the query's rarest features: any entry sharing none of
+    them cannot reach the threshold. Lookups take well under a millisecond
+    typically and a few milliseconds at worst with tens of thousands of
+    entries. The index only maps questions to exact cache keys; answers, TTL
+    and LRU stay with ANSWER_CACHE.
+    """
+
+    # Upper bound on how many entries are scored exactly per lookup
+    _MAX_CANDIDATES = 256
+
+    def __init__(self, threshold: float, max_entries: int):
+        self.threshold = threshold
+        self.max = max_entries
+        # scope ("model|store") -> feature -> {cache_key: tf}
+        self.postings: Dict[str, Dict[str, Dict[str, int]]] = {}
+        # cache_key -> (scope, {feature: tf}, stemmed tokens in order)
+        self.vectors: "OrderedDict[str, Tuple[str, Dict[str, int], Tuple[str, ...]]]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _split_key(key: str) -> Tuple[str, str]:
+        model, store, question = key.split("|", 2)
+        return f"{model}|{store}", question
+
+    @staticmethod
+    def _vectorize(question: str) -> Tuple[Dict[str, int], Tuple[str, ...]]:
+        tokens = tuple(_stem(t) for t in _tokenize(question))
+        tf: Dict[str, int] = {}
+        for t in tokens:
+            tf[t] = tf.get(t, 0) + 1
+        for a, b in zip(tokens, tokens[1:]):
+            pair = f"{a} {b}"
+            tf[pair] = tf.get(pair, 0) + 1
+        return tf, tokens
+
+    def _idf(self, scope_postings: Dict[str, Dict[str, int]], term: str, n: int) -> float:
+        return math.log(1 + n / (1 + len(scope_postings.get(term, ()))))
+
+    def add(self, key: str) -> None:
+        scope, question = self._split_key(key)
+        vec, tokens = self._vectorize(question)
+        if not vec:
+            return
+        with self._lock:
+            self._remove_locked(key)
+            self.vectors[key] = (scope, vec, tokens)
+            self.sizes[scope] = self.sizes.get(scope, 0) + 1
+            postings = self.postings.setdefault(scope, {})
+            for t, c in vec.items():
+                postings.setdefault(t, {})[key] = c
+            while len(self.vectors) > self.max:
+                self._remove_locked(next(iter(self.vectors)))
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            self._remove_locked(key)
+
+    def _remove_locked(self, key: str) -> None:
+        entry = self.vectors.pop(key, None)
+        if entry is None:
+            return
+        scope, vec, _ = entry
+        self.sizes[scope] -= 1
+        postings = self.postings.get(scope, {})
+        for t in vec:
+            plist = postings.get(t)
+            if plist is not None:
+                plist.pop(key, None)
+                if not plist:
+                    del postings[t]
+
+    def nearest(self, key: str, threshold: Optional[float] = None) -> Optional[Tuple[str, float]]:
+        threshold = threshold or self.threshold
+        scope, question = self._split_key(key)
+        qvec, qtokens = self._vectorize(question)
+        with self._lock:
+            postings = self.postings.get(scope)
+            if not qvec or not postings:
+                return None
+            n = self.sizes.get(scope, 0)
+            idf = {t: self._idf(postings, t, n) for t in qvec}
+            qweights = {t: c * idf[t] for t, c in qvec.items()}
+            qnorm2 = sum(w * w for w in qweights.values())
+            # Prefix filter: an entry sharing none of a set of query features can score
+            # at most |rest of q| / |q|, so once the rest is below the threshold only
+            # entries in the postings of that set can match. Rarest features first.
+            candidates: Set[str] = set()
+            rest2 = qnorm2
+            for t in sorted(qweights, key=lambda t: len(postings.get(t, ()))):
+                if rest2 < (threshold ** 2) * qnorm2:
+                    break
+                rest2 -= qweights[t] ** 2
+                plist = postings.get(t)
+                if not plist:
+                    continue
+                if len(candidates) + len(plist) > self._MAX_CANDIDATES:
+                    # Too common to score exhaustively; keep what the rarer features found
+                    if candidates:
+                        break
+                    candidates.update(itertools.islice(plist, self._MAX_CANDIDATES))
+                    break
+                candidates.update(plist)
+            if not candidates:
+                return None
+            qnorm = math.sqrt(qnorm2)
+            # Cosine is roughly bounded by sqrt(|q| / |d|): skip entries with far more features
+            max_terms = int(len(qvec) / (threshold ** 2)) + 1
+            best: Optional[Tuple[str, float]] = None
+            for cand in candidates:
+                if cand == key:
+                    continue
+                _, dvec, dtokens = self.vectors[cand]
+                if len(dvec) > max_terms:
+                    continue
+                dot = 0.0
+                dnorm = 0.0
+                for t, c in dvec.items():
+                    w = idf.get(t)
+                    if w is None:
+                        w = idf[t] = self._idf(postings, t, n)
+                    w *= c
+                    dnorm += w * w
+                    qw = qweights.get(t)
+                    if qw is not None:
+                        dot += w * qw
+                if dot <= 0.0:
+                    continue
+                sim = dot / (qnorm * math.sqrt(dnorm))
+                if sim >= threshold and (best is None or sim > best[1]) and _same_order(qtokens, dtokens):
+                    best = (cand, sim)
+        return best
+
+    def clear(self) -> None:
+        with self._lock:
+            self.postings.clear()
+            self.vectors.clear()
+            self.sizes.clear()
+
+    def warm(self, keys: List[str]) -> None:
+        for key in keys:
+            self.add(key)
+
+
+ANSWER_CACHE = _make_answer_cache()
+# Per-process lookup outcomes for /cache/stats (the backends count sets and evictions)
+CACHE_STATS: Dict[str, int] = {"hits": 0, "stale_hits": 0, "semantic_hits": 0, "misses": 0, "revalidations": 0}
+SEMANTIC_CACHE = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES)
+
+
+def _cache_lookup(cache_key: str) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    """Exact lookup first, then the near-duplicate tier.
+
+    Returns the cached value (or None) and extra meta describing the hit; a
+    stale hit (past its TTL, served while a refresh runs) is marked stale=True.
+    """
+    with _stage("cache_lookup"):
+        # Also applies the budget's longer TTL before the lookup
+        budget_stage = BUDGET.stage()
+        value, stale = ANSWER_CACHE.lookup(cache_key)
+        if value is not None:
+            CACHE_STATS["stale_hits" if stale else "hits"] += 1
+            return value, ({"stale": True} if stale else {})
+        threshold = BUDGET_SEMANTIC_THRESHOLD if budget_stage >= 2 else None
+        match = SEMANTIC_CACHE.nearest(cache_key, threshold) if SEMANTIC_CACHE_ENABLED else None
+        if match is None:
+            CACHE_STATS["misses"] += 1
+            return None, {}
+        near_key, similarity = match
+        value = ANSWER_CACHE.get(near_key)
+        if value is None:
+            # Evicted or expired behind our back
+            SEMANTIC_CACHE.remove(near_key)
+            CACHE_STATS["misses"] += 1
+            return None, {}
+        CACHE_STATS["semantic_hits"] += 1
+        return value, {
+            "cache_tier": "semantic",
+            "similarity": round(similarity, 4),
+            "matched_question": SemanticCache._split_key(near_key)[1],
+        }
+
+
+def _manifest_hashes(state: Dict[str, Any]) -> Dict[str, str]:
+    return {f["filename"]: f.get("sha256", "") for f in state.get("files", []) if f.get("filename")}
+
+
+def _source_hashes(citations: List[Dict[str, Any]]) -> Optional[Dict[str, str]]:
+    # Content hash of every cited document, as uploaded; None when one is unknown
+    manifest = _manifest_hashes(STATE.get())
+    sources: Dict[str, str] = {}
+    for c in citations:
+        sha = manifest.get(c.get("filename", ""))
+        if not sha:
+            return None
+        sources[c["filename"]] = sha
+    return sources
+
+
+def _cache_store(cache_key: str, value: Dict[str, Any]) -> None:
+    value = dict(value, sources=_source_hashes(value.get("citations") or []))
+    ANSWER_CACHE.set(cache_key, value)
+    if SEMANTIC_CACHE_ENABLED:
+        SEMANTIC_CACHE.add(cache_key)
+
+
+class QueryLog:
+    """NDJSON log of answered questions, for sizing the cache with server/cache_replay.py.
+
+    record() only appends a line to an in-memory buffer, so logging never blocks the
+    event loop or fails a request. flush() appends the buffer to the file from a
+    worker thread, every QUERY_LOG_FLUSH_SECONDS and at shutdown; lines it could not
+    write are kept for the next flush, up to MAX_PENDING (the oldest are dropped).
+    """
+
+    MAX_PENDING = 10000
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pending: "deque[str]" = deque()
+        self._lock = asyncio.Lock()
+        self.counters: Dict[str, int] = {"flushes": 0, "lines": 0, "errors": 0, "dropped": 0}
+
+    def record(self, record: Dict[str, Any]) -> None:
+        self.pending.append(json.dumps(record) + "\n")
+        while len(self.pending) > self.MAX_PENDING:
+            self.pending.popleft()
+            self.counters["dropped"] += 1
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self.pending:
+                return
+            batch = list(self.pending)
+            self.pending.clear()
+            try:
+                await asyncio.to_thread(self._append, batch)
+                self.counters["flushes"] += 1
+                self.counters["lines"] += len(batch)
+            except Exception:
+                # Keep the lines (ahead of any recorded meanwhile) for the next flush
+                self.counters["errors"] += 1
+                self.pending.extendleft(reversed(batch))
+                while len(self.pending) > self.MAX_PENDING:
+                    self.pending.popleft()
+                    self.counters["dropped"] += 1
+
+    def _append(self, lines: List[str]) -> None:
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write("".join(lines))
+
+    async def run(self, interval_s: float) -> None:
+        while True:
+            await asyncio.sleep(interval_s)
+            await self.flush()
+
+
+QUERY_LOG = QueryLog(QUERY_LOG_PATH)
+
+
+def _log_query(endpoint: str, question: str, mode: str, resp: Dict[str, Any],
+               cost_usd: Optional[float] = None) -> None:
+    # One line per answered question: when, what, and what it cost (or cost, when it was cached)
+    if not QUERY_LOG_PATH:
+        return
+    try:
+        meta = resp.get("meta") or {}
+        QUERY_LOG.record({
+            "ts": round(time.time(), 3),
+            "endpoint": endpoint,
+            "question": question,
+            "mode": mode,
+            "model": meta.get("model", MODEL),
+            "cached": bool(meta.get("cached")),
+            "cache_tier": meta.get("cache_tier", "exact") if meta.get("cached") else None,
+            "cost_usd": meta.get("cost_usd", 0.0) if cost_usd is None else cost_usd,
+            # Size of the answer as a cache entry
+            "bytes": len(json.dumps({"answer": resp.get("answer", ""),
+                                     "citations": resp.get("citations") or []}).encode("utf-8")),
+        })
+    except Exception:
+        # The log is best effort; it never fails the answer it describes
+        pass
+
+
+def _invalidate_answer_cache(old_state: Dict[str, Any], new_state: Dict[str, Any]) -> Dict[str, int]:
+    """Drop cached answers whose cited documents changed between two indexed states.
+
+    Entries that cited nothing follow ANSWER_CACHE_UNCITED_POLICY; entries without a
+    recorded source list are treated as stale. When the vector store was rebuilt,
+    surviving entries are moved under the new store's cache keys.
+    """
+    old_store = old_state.get("vector_store_id")
+    new_store = new_state.get("vector_store_id")
+    current = _manifest_hashes(new_state)
+    docs_changed = _manifest_hashes(old_state) != current
+    stats = {"kept": 0, "evicted": 0, "moved": 0}
+    if not old_store:
+        return stats
+    for key, value in ANSWER_CACHE.items():
+        model, store, question = key.split("|", 2)
+        if store != old_store:
+            continue
+        sources = value.get("sources")
+        if sources is None:
+            stale = True
+        elif sources:
+            stale = any(current.get(fn) != sha for fn, sha in sources.items())
+        else:
+            stale = docs_changed and ANSWER_CACHE_UNCITED_POLICY != "keep"
+        if stale:
+            ANSWER_CACHE.delete(key)
+            SEMANTIC_CACHE.remove(key)
+            stats["evicted"] += 1
+        elif new_store and new_store != old_store:
+            # Moved as is: a re-set would restart the TTL and could be refused admission
+            new_key = _cache_key(question, model, new_store)
+            SEMANTIC_CACHE.remove(key)
+            if not ANSWER_CACHE.rename(key, new_key):
+                stats["evicted"] += 1
+                continue
+            if SEMANTIC_CACHE_ENABLED:
+                SEMANTIC_CACHE.add(new_key)
+            stats["moved"] += 1
+        else:
+            stats["kept"] += 1
+    return stats
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    # Load (or build) the local search index once so the first /search is fast
+    try:
+        _get_search_index()
+    except Exception:
+        pass
+    # Render and compress the guides for /docs
+    try:
+        await asyncio.to_thread(DOCS.refresh)
+    except Exception:
+        pass
+    # Load the state once; the first get() inside the loop also schedules revalidation
+    STATE.get()
+    try:
+        ANSWER_CACHE.warm()
+        if SEMANTIC_CACHE_ENABLED:
+            SEMANTIC_CACHE.warm(ANSWER_CACHE.keys())
+    except Exception:
+        pass
+    # Spend so far today and this month (all workers) for the budget, then flush in the background
+    try:
+        await LEDGER.flush()
+    except Exception:
+        pass
+    ledger_task = asyncio.get_running_loop().create_task(LEDGER.run(USAGE_LEDGER_FLUSH_SECONDS))
+    query_log_task = (asyncio.get_running_loop().create_task(QUERY_LOG.run(QUERY_LOG_FLUSH_SECONDS))
+                      if QUERY_LOG_PATH else None)
+    if WARMUP_ON_STARTUP and "vector_store_id" in STATE.get():
+        _schedule_warmup()
+    yield
+    if _WARMUP["task"] is not None:
+        _WARMUP["task"].cancel()
+    ledger_task.cancel()
+    await LEDGER.flush()
+    if query_log_task is not None:
+        query_log_task.cancel()
+        await QUERY_LOG.flush()
+    await client.close()
+
 
 # FastAPI app
-app = FastAPI(title="ERP Help Center Assistant", default_response_class=ORJSONResponse)
+app = FastAPI(title="ERP Help Center Assistant", default_response_class=ORJSONResponse, lifespan=_lifespan)
 
 # CORS - adjust origins as needed
 app.add_middleware(
@@ -104,225 +1073,2834 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Serve raw docs for clickable citations
-app.mount("/docs", StaticFiles(directory=str(HELP_DOCS_DIR), html=True), name="docs")
+
+# ---------------------------
+# Models
+# ---------------------------
+
+class SetupRequest(BaseModel):
+    recreate: Optional[bool] = False
+    incremental: Optional[bool] = False
+    # Re-answer the warm-up questions in the background; defaults to WARMUP_AFTER_SETUP
+    warmup: Optional[bool] = None
+    # Build a vector store + assistant per module for routing; defaults to MODULE_STORES
+    modules: Optional[bool] = None
+
+
+class WarmupRequest(BaseModel):
+    # Defaults to the questions in WARMUP_QUESTIONS_FILE
+    questions: Optional[List[str]] = None
+    mode: Optional[str] = None
+    concurrency: Optional[int] = None
+    # Re-answer questions that are already cached
+    force: Optional[bool] = False
+    # Answer before responding (otherwise poll GET /warmup)
+    wait: Optional[bool] = False
+
+
+class SetupResponse(BaseModel):
+    assistant_id: str
+    vector_store_id: str
+    files_indexed: int
+    files: List[Dict[str, str]]
+    changes: Optional[Dict[str, List[str]]] = None
+    timings_ms: Optional[Dict[str, int]] = None
+    cache: Optional[Dict[str, int]] = None
+    warmup: Optional[Dict[str, Any]] = None
+    # module -> guides in its store, when per-module stores are built
+    modules: Optional[Dict[str, List[str]]] = None
+
+
+# thread_id of answers that ran on no thread of the caller's (cache hits, coalesced followers, fast mode)
+_PLACEHOLDER_THREAD_IDS = frozenset({"cached", "coalesced", "fast"})
+
+
+class AskRequest(BaseModel):
+    question: str
+    thread_id: Optional[str] = None
+    # "assistant" or "fast"; defaults to ANSWER_MODE
+    mode: Optional[str] = None
+    # Add a per-stage meta.timings breakdown (ms); defaults to META_TIMINGS
+    timings: Optional[bool] = None
+
+    @field_validator("thread_id")
+    @classmethod
+    def _no_placeholder_thread(cls, v: Optional[str]) -> Optional[str]:
+        # A follow-up on a placeholder starts a new conversation instead of failing upstream
+        return None if v in _PLACEHOLDER_THREAD_IDS else v
+
+
+class BatchAskRequest(BaseModel):
+    questions: List[str]
+    mode: Optional[str] = None
+    # "ndjson" (default) or "sse"
+    format: Optional[str] = None
+    # Uncached answers in flight at once; defaults to BATCH_CONCURRENCY
+    concurrency: Optional[int] = None
+
+
+class AskResponse(BaseModel):
+    answer: str
+    citations: List[Dict[str, str]]
+    thread_id: str
+    run_id: str
+    assistant_id: str
+    meta: Dict[str, Any]
+
+
+class SearchResponse(BaseModel):
+    query: str
+    results: List[Dict[str, Any]]
+    meta: Dict[str, Any]
+
+
+# ---------------------------
+# State helpers
+# ---------------------------
+
+def _load_state() -> Dict[str, Any]:
+    if STATE_FILE.exists():
+        try:
+            return json.loads(STATE_FILE.read_text(encoding="utf-8"))
+        except Exception:
+            return {}
+    return {}
+
+
+def _save_state(state: Dict[str, Any]) -> None:
+    STATE_FILE.write_text(json.dumps(state, indent=2), encoding="utf-8")
+
+
+class StateManager:
+    """In-memory copy of assistant_state.json for the request path.
+
+    The file is re-read only when its mtime changes (checked at most once per
+    second), and the assistant and vector store are re-validated in the
+    background every STATE_REVALIDATE_SECONDS. Once the store is confirmed
+    missing (404) it is recreated by one background task behind a lock;
+    requests never wait for it (they answer from the local index meanwhile).
+    """
+
+    _STAT_INTERVAL_S = 1.0
+
+    def __init__(self, path: Path, revalidate_s: float):
+        self.path = path
+        self.revalidate_s = revalidate_s
+        self._state: Dict[str, Any] = {}
+        self._mtime_ns: Optional[int] = None
+        self._checked_at = 0.0
+        self._validated_at = 0.0
+        self._missing = False
+        # Module stores found missing; the router sends their questions to the combined store
+        self.missing_modules: Set[str] = set()
+        self._revalidation: Optional["asyncio.Task[None]"] = None
+        self._rebuild: Optional["asyncio.Task[None]"] = None
+        self._rebuild_failed_at = 0.0
+        self._recreate_lock = asyncio.Lock()
+
+    def _refresh_from_disk(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._checked_at < self._STAT_INTERVAL_S:
+            return
+        self._checked_at = now
+        try:
+            mtime_ns = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        if mtime_ns == self._mtime_ns and not force:
+            return
+        old = self._state
+        self._state = _load_state()
+        self._mtime_ns = mtime_ns
+        _remember_file_names(self._state.get("files", []))
+        if (old.get("assistant_id"), old.get("vector_store_id")) != (
+            self._state.get("assistant_id"), self._state.get("vector_store_id")
+        ):
+            # New resources (e.g. another worker ran /setup): trust them until revalidated
+            self._missing = False
+            self._validated_at = 0.0
+
+    def get(self) -> Dict[str, Any]:
+        # Returns a copy: callers may update it for the duration of one request
+        self._refresh_from_disk()
+        self._maybe_revalidate()
+        return dict(self._state)
+
+    def save(self, state: Dict[str, Any]) -> None:
+        _save_state(state)
+        self._state = dict(state)
+        self._refresh_from_disk(force=True)
+        self._missing = False
+        self.missing_modules = set()
+        self._validated_at = time.monotonic()
+
+    def mark_validated(self) -> None:
+        self._missing = False
+        self._validated_at = time.monotonic()
+
+    def _maybe_revalidate(self) -> None:
+        if "vector_store_id" not in self._state:
+            return
+        if time.monotonic() - self._validated_at < self.revalidate_s:
+            return
+        if self._revalidation is not None and not self._revalidation.done():
+            return
+        try:
+            self._revalidation = asyncio.get_running_loop().create_task(self._revalidate())
+        except RuntimeError:
+            # No running loop (called from sync code); the next async caller will schedule it
+            pass
+
+    async def _revalidate(self) -> None:
+        _PRIORITY.set(RateScheduler.BACKGROUND)
+        state = self._state
+        try:
+            await asyncio.gather(
+                _openai(client.beta.assistants.retrieve, assistant_id=state["assistant_id"]),
+                _openai(client.vector_stores.retrieve, vector_store_id=state["vector_store_id"]),
+            )
+        except NotFoundError:
+            if state is self._state:
+                self._missing = True
+            return
+        except Exception:
+            # Transient upstream trouble says nothing about the resources; retry next interval
+            self._validated_at = time.monotonic() - self.revalidate_s / 2
+            return
+        modules = state.get("modules") or {}
+        if modules:
+            results = await asyncio.gather(*(
+                asyncio.gather(
+                    _openai(client.beta.assistants.retrieve, assistant_id=m["assistant_id"]),
+                    _openai(client.vector_stores.retrieve, vector_store_id=m["vector_store_id"]),
+                )
+                for m in modules.values()
+            ), return_exceptions=True)
+            if state is self._state:
+                self.missing_modules = {n for n, r in zip(modules, results) if isinstance(r, NotFoundError)}
+        if state is self._state:
+            self.mark_validated()
+
+    def rebuilding(self) -> bool:
+        """True while the resources are confirmed missing; starts (at most one) background rebuild."""
+        if not self._missing:
+            return False
+        idle = self._rebuild is None or self._rebuild.done()
+        if idle and time.monotonic() - self._rebuild_failed_at >= REBUILD_RETRY_SECONDS:
+            self._rebuild = asyncio.get_running_loop().create_task(self._rebuild_resources())
+        return True
+
+    async def _rebuild_resources(self) -> None:
+        _PRIORITY.set(RateScheduler.BACKGROUND)
+        try:
+            async with self._recreate_lock:
+                if self._missing:
+                    old_state = dict(self._state)
+                    state = await _create_or_get_assistant_and_vector_store(recreate=True)
+                    if MODULE_STORES:
+                        state, _ = await _sync_module_stores(state, True)
+                    # Carry the still-valid cached answers over to the new store's keys
+                    _invalidate_answer_cache(old_state, state)
+        except Exception:
+            # Likely the same upstream trouble; the next request after REBUILD_RETRY_SECONDS tries again
+            self._rebuild_failed_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "missing": self._missing,
+            "rebuilding": self._rebuild is not None and not self._rebuild.done(),
+            "missing_modules": sorted(self.missing_modules),
+        }
+
+
+STATE = StateManager(STATE_FILE, STATE_REVALIDATE_SECONDS)
+
+
+def _list_markdown_files() -> List[Path]:
+    files: List[Path] = []
+    for p in sorted(HELP_DOCS_DIR.glob("*.md")):
+        files.append(p)
+    return files
+
+
+# ---------------------------
+# Local retrieval (section-level BM25)
+# ---------------------------
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i if in into is it of on or so that the "
+    "then this to what when where which with you your".split()
+)
+
+
+def _tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def _slugify(heading: str) -> str:
+    # GitHub-style anchor: lowercase, drop punctuation, spaces -> dashes
+    slug = re.sub(r"[^\w\- ]", "", heading.strip().lower())
+    return re.sub(r"\s", "-", slug)
+
+
+def _unique_slug(heading: str, seen_slugs: Dict[str, int]) -> str:
+    # Repeated headings get -1, -2, ... like GitHub; the section index and /docs pages share this
+    slug = _slugify(heading)
+    if slug in seen_slugs:
+        seen_slugs[slug] += 1
+        return f"{slug}-{seen_slugs[slug]}"
+    seen_slugs[slug] = 0
+    return slug
+
+
+def _split_sections(path: Path) -> List[Dict[str, Any]]:
+    """Split a Markdown guide into heading-delimited sections.
+
+    Each section carries its heading trail (parent headings) so that a hit on
+    a short "#### For revisions" block still knows it lives under "How to create a BOM".
+    """
+    sections: List[Dict[str, Any]] = []
+    trail: List[str] = []
+    seen_slugs: Dict[str, int] = {}
+    current: Optional[Dict[str, Any]] = None
+    lines: List[str] = []
+
+    def _flush() -> None:
+        body = "\n".join(lines).strip()
+        if current is None:
+            # Text before the first heading is indexed as a headless section
+            if body:
+                sections.append({"filename": path.name, "heading": "", "trail": [], "anchor": "",
+                                 "level": 0, "text": body})
+            return
+        current["text"] = body
+        sections.append(current)
+
+    for line in path.read_text(encoding="utf-8").splitlines():
+        m = _HEADING_RE.match(line)
+        if not m:
+            lines.append(line)
+            continue
+        _flush()
+        level = len(m.group(1))
+        heading = m.group(2)
+        trail = trail[: level - 1] + [""] * max(0, level - 1 - len(trail)) + [heading]
+        slug = _unique_slug(heading, seen_slugs)
+        current = {
+            "filename": path.name,
+            "heading": heading,
+            "trail": [h for h in trail if h],
+            "anchor": slug,
+            "level": level,
+        }
+        lines = []
+
+    _flush()
+    return sections
+
+
+def _corpus_signature(md_files: List[Path]) -> List[List[Any]]:
+    # Cheap staleness check: name, size and mtime of every guide
+    sig: List[List[Any]] = []
+    for p in md_files:
+        st = p.stat()
+        sig.append([p.name, st.st_size, st.st_mtime_ns])
+    return sig
+
+
+class SearchIndex:
+    def __init__(self, sections: List[Dict[str, Any]], signature: List[List[Any]],
+                 k1: float = 1.5, b: float = 0.75):
+        self.sections = sections
+        self.signature = signature
+        self.k1 = k1
+        self.b = b
+        # term -> [[section_idx, tf], ...]
+        self.postings: Dict[str, List[List[int]]] = {}
+        self.doc_len: List[int] = []
+        for idx, sec in enumerate(sections):
+            # Index the heading trail with the body; the section's own heading counts twice
+            tokens = _tokenize(" ".join(sec["trail"]) + " " + sec["text"]) + _tokenize(sec["heading"])
+            self.doc_len.append(len(tokens))
+            tf: Dict[str, int] = {}
+            for t in tokens:
+                tf[t] = tf.get(t, 0) + 1
+            for t, c in tf.items():
+                self.postings.setdefault(t, []).append([idx, c])
+        n = len(sections)
+        self.avgdl = (sum(self.doc_len) / n) if n else 0.0
+        self.idf: Dict[str, float] = {
+            t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()
+        }
+
+    @classmethod
+    def build(cls, md_files: List[Path]) -> "SearchIndex":
+        sections: List[Dict[str, Any]] = []
+        for p in md_files:
+            sections.extend(_split_sections(p))
+        return cls(sections, _corpus_signature(md_files))
+
+    def search(self, query: str, k: int = 5, filenames: Optional[Set[str]] = None) -> List[Dict[str, Any]]:
+        scores: Dict[int, float] = {}
+        avgdl = self.avgdl or 1.0
+        for t in set(_tokenize(query)):
+            postings = self.postings.get(t)
+            if not postings:
+                continue
+            idf = self.idf[t]
+            for idx, tf in postings:
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[idx] / avgdl)
+                scores[idx] = scores.get(idx, 0.0) + idf * tf * (self.k1 + 1) / norm
+        if filenames is not None:
+            scores = {idx: sc for idx, sc in scores.items() if self.sections[idx]["filename"] in filenames}
+        top = heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+        return [dict(self.sections[idx], score=round(score, 4)) for idx, score in top]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": SEARCH_INDEX_VERSION,
+            "signature": self.signature,
+            "k1": self.k1,
+            "b": self.b,
+            "sections": self.sections,
+            "postings": self.postings,
+            "doc_len": self.doc_len,
+            "avgdl": self.avgdl,
+            "idf": self.idf,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "SearchIndex":
+        obj = cls.__new__(cls)
+        obj.sections = d["sections"]
+        obj.signature = d["signature"]
+        obj.k1 = d["k1"]
+        obj.b = d["b"]
+        obj.postings = d["postings"]
+        obj.doc_len = d["doc_len"]
+        obj.avgdl = d["avgdl"]
+        obj.idf = d["idf"]
+        return obj
+
+
+SEARCH_INDEX_FILE = STATE_DIR / "search_index.json"
+SEARCH_INDEX_VERSION = 1
+_SEARCH_INDEX: Optional[SearchIndex] = None
+_SEARCH_INDEX_LOCK = threading.Lock()
+
+
+def _build_search_index() -> SearchIndex:
+    index = SearchIndex.build(_list_markdown_files())
+    try:
+        SEARCH_INDEX_FILE.write_text(json.dumps(index.to_dict()), encoding="utf-8")
+    except Exception:
+        # Persisting is an optimization; an in-memory index is still usable
+        pass
+    return index
+
+
+def _load_search_index() -> Optional[SearchIndex]:
+    if not SEARCH_INDEX_FILE.exists():
+        return None
+    try:
+        d = json.loads(SEARCH_INDEX_FILE.read_text(encoding="utf-8"))
+        if d.get("version") != SEARCH_INDEX_VERSION:
+            return None
+        return SearchIndex.from_dict(d)
+    except Exception:
+        return None
+
+
+def _get_search_index(rebuild: bool = False) -> SearchIndex:
+    global _SEARCH_INDEX
+    signature = _corpus_signature(_list_markdown_files())
+    index = _SEARCH_INDEX
+    if not rebuild and index is not None and index.signature == signature:
+        return index
+    with _SEARCH_INDEX_LOCK:
+        index = _SEARCH_INDEX
+        if not rebuild and index is not None and index.signature == signature:
+            return index
+        index = None if rebuild else _load_search_index()
+        if index is None or index.signature != signature:
+            index = _build_search_index()
+        _SEARCH_INDEX = index
+        return index
+
+
+# ---------------------------
+# Docs serving (pre-rendered, precompressed)
+# ---------------------------
+
+# /docs serves the guides from memory: each one as Markdown (/docs/<file>.md) and as an HTML page
+# with heading anchors (/docs/<file>.html), rendered and compressed once at startup and on reindex.
+# Browsers may reuse a page for DOCS_CACHE_MAX_AGE_SECONDS, then revalidate it with its ETag (304).
+DOCS_CACHE_MAX_AGE_SECONDS = int(os.getenv("DOCS_CACHE_MAX_AGE_SECONDS", "300"))
+# Edits to help_docs without a reindex are noticed at most this late (0 = only on startup and reindex)
+DOCS_RECHECK_SECONDS = float(os.getenv("DOCS_RECHECK_SECONDS", "30"))
+
+_LIST_ITEM_RE = re.compile(r"^( *)([-*+]|\d+[.)])\s+(.*)$")
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_INLINE_RE = re.compile(r"`([^`]+)`|\*\*(.+?)\*\*|__(.+?)__|\*(\S(?:.*?\S)?)\*|\[([^\]]+)\]\(([^)\s]+)\)")
+_DOC_PAGE = """<!doctype html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<style>
+body {{ font: 15px/1.6 system-ui, -apple-system, "Segoe UI", sans-serif; color: #1f2328; margin: 0; }}
+main {{ max-width: 52rem; margin: 0 auto; padding: 1.5rem 1rem 4rem; }}
+h1, h2, h3, h4, h5, h6 {{ line-height: 1.25; margin: 1.6em 0 0.5em; scroll-margin-top: 1rem; }}
+h1 a, h2 a, h3 a, h4 a, h5 a, h6 a {{ color: inherit; text-decoration: none; }}
+:target {{ background: #fff8c5; }}
+ul, ol {{ padding-left: 1.6em; }}
+code {{ background: #f6f8fa; border-radius: 4px; padding: 0.1em 0.3em; }}
+pre code {{ display: block; padding: 0.8em; overflow-x: auto; }}
+</style>
+</head>
+<body><main>
+{body}
+</main></body>
+</html>
+"""
+
+
+def _render_inline(text: str) -> str:
+    out: List[str] = []
+    pos = 0
+    for m in _INLINE_RE.finditer(text):
+        out.append(html.escape(text[pos:m.start()]))
+        code, strong, strong2, em, label, href = m.groups()
+        if code is not None:
+            out.append(f"<code>{html.escape(code)}</code>")
+        elif strong or strong2:
+            out.append(f"<strong>{_render_inline(strong or strong2)}</strong>")
+        elif em:
+            out.append(f"<em>{_render_inline(em)}</em>")
+        else:
+            if href.lower().startswith(("javascript:", "data:", "vbscript:")):
+                href = "#"
+            out.append(f'<a href="{html.escape(href)}">{_render_inline(label)}</a>')
+        pos = m.end()
+    out.append(html.escape(text[pos:]))
+    return "".join(out)
+
+
+def _render_markdown(text: str) -> str:
+    """Render a help guide to HTML: headings, nested lists, paragraphs, fenced code, emphasis and links.
+
+    Headings get the same ids as the section index's anchors, so citation URLs
+    (/docs/<file>.html#<anchor>) land on the cited section.
+    """
+    out: List[str] = []
+    seen_slugs: Dict[str, int] = {}
+    para: List[str] = []
+    lists: List[Tuple[int, str]] = []  # open lists, innermost last: (indent, "ul" | "ol")
+    fence: Optional[List[str]] = None
+
+    def close_para() -> None:
+        if para:
+            out.append(f"<p>{_render_inline(' '.join(para))}</p>")
+            para.clear()
+
+    def close_lists(indent: int = -1) -> None:
+        while lists and lists[-1][0] > indent:
+            out.append(f"</li></{lists.pop()[1]}>")
+
+    for raw in text.splitlines():
+        line = raw.expandtabs(4)
+        if fence is not None:
+            if _FENCE_RE.match(line):
+                out.append(f"<pre><code>{html.escape(chr(10).join(fence))}</code></pre>")
+                fence = None
+            else:
+                fence.append(raw)
+            continue
+        if _FENCE_RE.match(line):
+            close_para()
+            close_lists()
+            fence = []
+            continue
+        m = _HEADING_RE.match(raw)
+        if m:
+            close_para()
+            close_lists()
+            level = len(m.group(1))
+            anchor = html.escape(_unique_slug(m.group(2), seen_slugs))
+            out.append(f'<h{level} id="{anchor}"><a href="#{anchor}">{_render_inline(m.group(2))}</a></h{level}>')
+            continue
+        if not line.strip():
+            close_para()
+            continue
+        item = _LIST_ITEM_RE.match(line)
+        if item:
+            close_para()
+            indent = len(item.group(1))
+            tag = "ol" if item.group(2)[0].isdigit() else "ul"
+            if lists and indent > lists[-1][0]:
+                out.append(f"<{tag}><li>")
+                lists.append((indent, tag))
+            else:
+                close_lists(indent)
+                if lists:
+                    out.append("</li><li>")
+                else:
+                    out.append(f"<{tag}><li>")
+                    lists.append((indent, tag))
+            out.append(_render_inline(item.group(3)))
+        elif lists and line.startswith(" "):
+            # Indented continuation of the current list item
+            out.append(" " + _render_inline(line.strip()))
+        else:
+            close_lists()
+            para.append(line.strip())
+    if fence is not None:
+        out.append(f"<pre><code>{html.escape(chr(10).join(fence))}</code></pre>")
+    close_para()
+    close_lists()
+    return "\n".join(out)
+
+
+def _doc_variants(body: bytes, media_type: str) -> Dict[str, Any]:
+    # Identity plus every encoding that actually saves bytes, compressed once at the highest levels
+    bodies = {"identity": body}
+    gz = gzip.compress(body, compresslevel=9, mtime=0)
+    if len(gz) < len(body):
+        bodies["gzip"] = gz
+    if brotli is not None:
+        br = brotli.compress(body, quality=11)
+        if len(br) < len(body):
+            bodies["br"] = br
+    return {"media_type": media_type, "etag": hashlib.sha256(body).hexdigest()[:20], "bodies": bodies}
+
+
+def _doc_url(filename: str, anchor: str = "") -> str:
+    # Guides link to their pre-rendered page; anything else (e.g. an unknown file id) as-is
+    name = filename[:-3] + ".html" if filename.endswith(".md") else filename
+    return f"/docs/{name}" + (f"#{anchor}" if anchor else "")
+
+
+class DocsStore:
+    """The guides as /docs serves them, rendered and compressed in memory.
+
+    Each guide has two representations (Markdown and the HTML page), each held in
+    identity, gzip and (with the brotli package installed) Brotli encodings plus a
+    strong ETag, so a request is a dict lookup and never touches the disk.
+    """
+
+    def __init__(self) -> None:
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        self.signature: Optional[List[List[Any]]] = None
+        self.checked_at = 0.0
+        self.build_ms = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> bool:
+        """Rebuild when the guides changed on disk (or always with force); True if rebuilt."""
+        with self._lock:
+            md_files = _list_markdown_files()
+            signature = _corpus_signature(md_files)
+            self.checked_at = time.time()
+            if not force and signature == self.signature:
+                return False
+            start = time.perf_counter()
+            docs: Dict[str, Dict[str, Any]] = {}
+            for path in md_files:
+                raw = path.read_bytes()
+                text = raw.decode("utf-8")
+                page = _DOC_PAGE.format(title=html.escape(path.stem), body=_render_markdown(text))
+                docs[path.name] = _doc_variants(raw, "text/markdown; charset=utf-8")
+                docs[_doc_url(path.name)[len("/docs/"):]] = _doc_variants(page.encode("utf-8"), "text/html; charset=utf-8")
+            self.docs = docs
+            self.signature = signature
+            self.build_ms = int((time.perf_counter() - start) * 1000)
+            return True
+
+    async def get(self, name: str) -> Optional[Dict[str, Any]]:
+        due = DOCS_RECHECK_SECONDS > 0 and time.time() - self.checked_at >= DOCS_RECHECK_SECONDS
+        if self.signature is None or due:
+            await asyncio.to_thread(self.refresh)
+        return self.docs.get(name)
+
+    def stats(self) -> Dict[str, Any]:
+        # Bytes a client accepting each encoding would download for every document
+        sizes = {enc: 0 for enc in ("identity", "gzip") + (("br",) if brotli is not None else ())}
+        for doc in self.docs.values():
+            for enc in sizes:
+                sizes[enc] += len(doc["bodies"].get(enc, doc["bodies"]["identity"]))
+        return {"documents": len(self.docs), "bytes": sizes, "build_ms": self.build_ms, "brotli": brotli is not None}
+
+
+DOCS = DocsStore()
+
+
+def _accepted_encoding(accept_encoding: str, available: Dict[str, bytes]) -> str:
+    # Brotli, then gzip, when the client accepts them (q > 0); identity otherwise
+    qs: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qs[name.strip()] = q
+    for enc in ("br", "gzip"):
+        if enc in available and qs.get(enc, qs.get("*", 0.0)) > 0:
+            return enc
+    return "identity"
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # Weak comparison (as If-None-Match specifies): any encoding of the same content matches
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"').split("-")[0] == etag:
+            return True
+    return False
+
+
+# ---------------------------
+# OpenAI rate limiting
+# ---------------------------
+
+# Scheduling priority of the current request; background tasks inherit it unless they set their own
+_PRIORITY: "contextvars.ContextVar[int]" = contextvars.ContextVar("openai_priority", default=1)
+
+
+class RateScheduler:
+    """Client-side token buckets for OpenAI requests/min and tokens/min.
+
+    Every call waits for one request slot, and model calls also for their estimated
+    tokens, in priority order: interactive streams first, then /ask, then batch and
+    background work. Estimates are corrected once the real usage is known, and a
+    429 pauses every caller until the server's retry-after has passed.
+    """
+
+    INTERACTIVE, NORMAL, BACKGROUND = 0, 1, 2
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        # heap of (priority, seq, tokens, future)
+        self.waiters: List[Tuple[int, int, int, "asyncio.Future[None]"]] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Tokens a call uses beyond the text we can see (file_search chunks, output), learned per kind
+        self.overhead: Dict[str, float] = {"run": 8000.0, "chat": 500.0}
+        self.counters: Dict[str, int] = {"waits": 0, "wait_ms": 0, "retries": 0, "throttled": 0}
+
+    def _levels(self, now: float) -> Tuple[float, float]:
+        # (requests, tokens) in the buckets at `now`, without recording the refill
+        elapsed = now - self.updated
+        requests, tokens = self.requests, self.tokens
+        if self.rpm:
+            requests = min(float(self.rpm), requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            tokens = min(float(self.tpm), tokens + elapsed * self.tpm / 60.0)
+        return requests, tokens
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.requests, self.tokens = self._levels(now)
+        self.updated = now
+
+    def _wait_s(self, tokens: int) -> float:
+        wait = max(0.0, self.paused_until - time.monotonic())
+        if self.rpm and self.requests < 1:
+            wait = max(wait, (1 - self.requests) * 60.0 / self.rpm)
+        # A call larger than the whole bucket only waits for a full one
+        need = min(tokens, self.tpm)
+        if self.tpm and self.tokens < need:
+            wait = max(wait, (need - self.tokens) * 60.0 / self.tpm)
+        return wait
+
+    def _pump(self) -> None:
+        self._timer = None
+        self._refill()
+        while self.waiters:
+            _, _, tokens, fut = self.waiters[0]
+            if fut.done():
+                # Caller was cancelled while queued
+                heapq.heappop(self.waiters)
+                continue
+            wait = self._wait_s(tokens)
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._pump)
+                return
+            heapq.heappop(self.waiters)
+            self.requests -= 1
+            self.tokens -= tokens
+            fut.set_result(None)
+
+    async def acquire(self, tokens: int = 0) -> None:
+        if not self.rpm and not self.tpm and time.monotonic() >= self.paused_until:
+            return
+        fut: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (_PRIORITY.get(), next(self._seq), tokens, fut))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._pump()
+        if fut.done():
+            return
+        start = time.perf_counter()
+        self.counters["waits"] += 1
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # Granted just as the caller was cancelled: give the reservation back
+                self._refund(tokens)
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.counters["wait_ms"] += int(waited * 1000)
+            _record_stage("rate_limit_wait", waited)
+
+    def _refund(self, tokens: int) -> None:
+        self._refill()
+        if self.rpm:
+            self.requests = min(float(self.rpm), self.requests + 1)
+        if self.tpm:
+            self.tokens = min(float(self.tpm), self.tokens + tokens)
+        if self._timer is not None:
+            self._timer.cancel()
+        self._pump()
+
+    def estimate(self, kind: str, text: str) -> Tuple[int, int]:
+        # (tokens in the text we send, expected total tokens for the call)
+        visible = _estimate_tokens(text)
+        return visible, visible + int(self.overhead[kind])
+
+    def settle(self, kind: str, visible: int, estimated: int, usage: Any) -> None:
+        # Charge (or refund) the difference between the estimate and what the call really used
+        _, _, total = _usage_counts(usage)
+        if not total:
+            return
+        self._refill()
+        self.tokens = max(-float(self.tpm), self.tokens - (total - estimated))
+        self.overhead[kind] = 0.8 * self.overhead[kind] + 0.2 * max(0, total - visible)
+
+    def pause(self, seconds: float) -> None:
+        self.counters["throttled"] += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        # Read-only: the buckets only change on the event loop
+        now = time.monotonic()
+        requests, tokens = self._levels(now)
+        return {
+            "rpm_limit": self.rpm,
+            "tpm_limit": self.tpm,
+            "requests_available": round(requests, 2),
+            "tokens_available": int(tokens),
+            "queued": sum(1 for w in self.waiters if not w[3].done()),
+            "paused_for_s": round(max(0.0, self.paused_until - now), 3),
+            **self.counters,
+        }
+
+
+RATE = RateScheduler(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+
+_RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _retry_after_s(error: Exception) -> float:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return 0.0
+
+
+# Repeating these cannot create anything twice, so they are retried even when an attempt's outcome is unknown
+_IDEMPOTENT_CALLS = frozenset({"retrieve", "list", "delete", "cancel"})
+# Statuses that mean the request was turned away before any work was done
+_REJECTED_STATUS = {408, 409, 429}
+
+
+def _retryable(error: Exception, idempotent: bool) -> bool:
+    status = getattr(error, "status_code", None)
+    if status in _REJECTED_STATUS:
+        return True
+    if isinstance(error, APIConnectionError) and isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout)):
+        # Never reached the server
+        return True
+    # A timeout or 5xx may have happened after the server acted on the request
+    return idempotent and (status is None or status in _RETRY_STATUS)
+
+
+def _upstream_failure(error: Exception) -> bool:
+    # What the circuit breaker counts against OpenAI: 4xx (429 included) are answers, not outages
+    status = getattr(error, "status_code", None)
+    return status is None or status >= 500
+
+
+class CircuitOpenError(HTTPException):
+    def __init__(self, retry_after_s: int):
+        super().__init__(
+            status_code=503,
+            detail="OpenAI is failing; new questions are paused while it recovers. Retry shortly.",
+            headers={"Retry-After": str(retry_after_s)},
+        )
+
+
+class CircuitBreaker:
+    """Fails OpenAI calls fast while the upstream is having an incident.
+
+    Every attempt made by _openai() is recorded in a sliding window; 5xx responses,
+    timeouts and connection errors count as failures. The breaker opens when at
+    least `min_calls` attempts in the window saw `error_ratio` failures, or after
+    `consecutive` failures in a row. While open, calls raise CircuitOpenError (503)
+    without waiting on the network, and the answer cache serves recently expired
+    answers (marked stale). After `open_s` one probe call goes through: success
+    closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, enabled: bool, window_s: float, min_calls: int, error_ratio: float,
+                 consecutive: int, open_s: float, stale_s: int):
+        self.enabled = enabled
+        self.window_s = window_s
+        self.min_calls = min_calls
+        self.error_ratio = error_ratio
+        self.consecutive_limit = consecutive
+        self.open_s = open_s
+        self.stale_s = stale_s
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self.consecutive = 0
+        # (monotonic time, failed) per attempt in the window
+        self.window: "deque[Tuple[float, bool]]" = deque()
+        self.window_failures = 0
+        self.counters: Dict[str, int] = {"opened": 0, "rejected": 0, "failures": 0}
+
+    def is_open(self) -> bool:
+        # Open and still cooling down; once the cool-down is over a probe may go through
+        return self.state == "open" and time.monotonic() - self.opened_at < self.open_s
+
+    def retry_after_s(self) -> int:
+        return max(1, math.ceil(self.open_s - (time.monotonic() - self.opened_at)))
+
+    def reject(self) -> CircuitOpenError:
+        self.counters["rejected"] += 1
+        return CircuitOpenError(self.retry_after_s())
+
+    def allow(self) -> None:
+        if not self.enabled or self.state == "closed":
+            return
+        if self.state == "open" and not self.is_open():
+            self.state = "half_open"
+            self.probing = False
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return
+        raise self.reject()
+
+    def record(self, failed: Optional[bool]) -> None:
+        """Outcome of one attempt: True failed upstream, False succeeded, None no verdict (cancelled)."""
+        if not self.enabled:
+            return
+        if failed:
+            self.counters["failures"] += 1
+        if self.state == "half_open":
+            if failed is None:
+                self.probing = False
+            elif failed:
+                self._open()
+            else:
+                self._close()
+            return
+        if self.state == "open" or failed is None:
+            # A call that started before the breaker opened
+            return
+        now = time.monotonic()
+        self.window.append((now, failed))
+        self.window_failures += failed
+        while self.window and now - self.window[0][0] > self.window_s:
+            self.window_failures -= self.window.popleft()[1]
+        self.consecutive = self.consecutive + 1 if failed else 0
+        total = len(self.window)
+        if self.consecutive >= self.consecutive_limit or (
+            total >= self.min_calls and self.window_failures / total >= self.error_ratio
+        ):
+            self._open()
+
+    def _open(self) -> None:
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.probing = False
+        self.counters["opened"] += 1
+        ANSWER_CACHE.outage_stale_s = self.stale_s
+
+    def _close(self) -> None:
+        self.state = "closed"
+        self.probing = False
+        self.consecutive = 0
+        self.window.clear()
+        self.window_failures = 0
+        ANSWER_CACHE.outage_stale_s = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = len(self.window)
+        return {
+            "enabled": self.enabled,
+            "state": self.state,
+            "retry_after_s": self.retry_after_s() if self.is_open() else 0,
+            "window_calls": total,
+            "window_error_ratio": round(self.window_failures / total, 3) if total else 0.0,
+            "consecutive_failures": self.consecutive,
+            **self.counters,
+        }
+
+
+BREAKER = CircuitBreaker(BREAKER_ENABLED, BREAKER_WINDOW_SECONDS, BREAKER_MIN_CALLS, BREAKER_ERROR_RATIO,
+                         BREAKER_CONSECUTIVE_FAILURES, BREAKER_OPEN_SECONDS, BREAKER_STALE_SECONDS)
+
+
+async def _openai(call: Any, *args: Any, tokens: int = 0, idempotent: Optional[bool] = None, **kwargs: Any) -> Any:
+    """Make one OpenAI call through BREAKER and RATE, retrying what is safe to retry.
+
+    Rejections (408/409/429) and connection failures are retried for every call; timeouts
+    and 5xx only for idempotent ones (retrieve/list/delete/cancel, or idempotent=True), so
+    a create whose outcome is unknown is never repeated. Backoff is full-jitter
+    exponential, and never shorter than the server's retry-after.
+    """
+    if idempotent is None:
+        idempotent = getattr(call, "__name__", "") in _IDEMPOTENT_CALLS
+    attempt = 0
+    while True:
+        BREAKER.allow()
+        try:
+            # Tokens are charged once; a throttled attempt did not use them
+            await RATE.acquire(tokens if attempt == 0 else 0)
+            result = await call(*args, **kwargs)
+        except (APIConnectionError, APIStatusError) as e:
+            BREAKER.record(_upstream_failure(e))
+            status = getattr(e, "status_code", None)
+            if attempt >= OPENAI_MAX_RETRIES or not _retryable(e, idempotent):
+                raise
+            delay = random.uniform(0, min(OPENAI_RETRY_MAX_SECONDS, OPENAI_RETRY_BASE_SECONDS * 2 ** attempt))
+            retry_after = _retry_after_s(e)
+            if status == 429:
+                RATE.pause(max(retry_after, delay))
+            RATE.counters["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(max(delay, retry_after))
+            continue
+        except BaseException:
+            BREAKER.record(None)
+            raise
+        BREAKER.record(False)
+        return result
+
+
+# ---------------------------
+# OpenAI Assistants setup
+# ---------------------------
+
+async def _delete_previous_resources(state: Dict[str, Any]) -> None:
+    # Best-effort clean-up; ignore errors
+    await asyncio.gather(*(_delete_module_resources(m) for m in (state.get("modules") or {}).values()))
+    try:
+        if "assistant_id" in state:
+            await _openai(client.beta.assistants.delete, assistant_id=state["assistant_id"])
+    except Exception:
+        pass
+
+    try:
+        if "vector_store_id" in state:
+            await _openai(client.vector_stores.delete, vector_store_id=state["vector_store_id"])
+    except Exception:
+        pass
+
+    # Uploaded files outlive their vector store unless deleted explicitly
+    async def _delete_file(file_id: str) -> None:
+        try:
+            await _openai(client.files.delete, file_id)
+        except Exception:
+            pass
+
+    await asyncio.gather(*(_delete_file(f["file_id"]) for f in state.get("files", []) if f.get("file_id")))
+
+
+async def _create_or_get_assistant_and_vector_store(recreate: bool = False) -> Dict[str, Any]:
+    state = STATE.get()
+
+    if not recreate and "assistant_id" in state and "vector_store_id" in state:
+        # Validate they still exist by attempting a lightweight retrieve
+        try:
+            await asyncio.gather(
+                _openai(client.beta.assistants.retrieve, assistant_id=state["assistant_id"]),
+                _openai(client.vector_stores.retrieve, vector_store_id=state["vector_store_id"]),
+            )
+            STATE.mark_validated()
+            return state
+        except Exception:
+            # If retrieval fails, proceed to recreate them
+            pass
+
+    if recreate and state:
+        await _delete_previous_resources(state)
+        state = {}
+
+    # 1) Create a vector store
+    vector_store = await _openai(client.vector_stores.create, name="erp-help-docs")
+
+    # 2) Upload all Markdown files (concurrently, keeping each file id), then attach them in one batch
+    md_files = _list_markdown_files()
+    uploaded = await asyncio.gather(*(_upload_file(p) for p in md_files))
+    if uploaded:
+        await _openai(
+            client.vector_stores.file_batches.create_and_poll,
+            vector_store_id=vector_store.id,
+            file_ids=[f["file_id"] for f in uploaded],
+        )
+
+    # 3) Create the Assistant with File Search tool attached
+    assistant = await _openai(
+        client.beta.assistants.create,
+        name="ERP Help Assistant",
+        model=MODEL,
+        instructions=ASSISTANT_INSTRUCTIONS,
+        tools=[{"type": "file_search"}],
+        tool_resources={
+            "file_search": {
+                "vector_store_ids": [vector_store.id]
+            }
+        },
+    )
+
+    # Keep file id -> filename (and content hash) for citation lookup without a network call
+    new_state = {
+        "assistant_id": assistant.id,
+        "vector_store_id": vector_store.id,
+        "files": list(uploaded),
+    }
+    STATE.save(new_state)
+    return new_state
+
+
+def _file_sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+async def _upload_file(path: Path, sha256: Optional[str] = None) -> Dict[str, str]:
+    with open(str(path), "rb") as fh:
+        fo = await _openai(client.files.create, file=fh, purpose="assistants")
+    return {
+        "filename": path.name,
+        "path": f"/docs/{path.name}",
+        "file_id": fo.id,
+        "sha256": sha256 or _file_sha256(path),
+    }
+
+
+async def _sync_vector_store(state: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Bring the existing vector store in line with help_docs, touching only what changed.
+
+    The manifest in the state file (filename -> sha256/file_id) is diffed against the
+    local files; new and edited files are uploaded and attached in one batch, replaced
+    and deleted ones are detached from the store and their file objects removed.
+    """
+    vector_store_id = state["vector_store_id"]
+    timings: Dict[str, int] = {}
+
+    t0 = time.perf_counter()
+    local = {p.name: (p, _file_sha256(p)) for p in _list_markdown_files()}
+    manifest = {f["filename"]: f for f in state.get("files", []) if f.get("filename")}
+    added = sorted(n for n in local if n not in manifest)
+    changed = sorted(
+        n for n in local
+        if n in manifest and (manifest[n].get("sha256") != local[n][1] or not manifest[n].get("file_id"))
+    )
+    removed = sorted(n for n in manifest if n not in local)
+    unchanged = sorted(n for n in local if n in manifest and n not in changed)
+    timings["hash_ms"] = int((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    uploaded = await asyncio.gather(*(_upload_file(local[n][0], local[n][1]) for n in added + changed))
+    timings["upload_ms"] = int((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    if uploaded:
+        await _openai(
+            client.vector_stores.file_batches.create_and_poll,
+            vector_store_id=vector_store_id,
+            file_ids=[f["file_id"] for f in uploaded],
+        )
+    timings["attach_ms"] = int((time.perf_counter() - t0) * 1000)
+
+    files = [manifest[n] for n in unchanged] + list(uploaded)
+    files.sort(key=lambda f: f["filename"])
+
+    # Replaced and removed files, plus anything attached to the store that the manifest
+    # does not know about (e.g. left over from an interrupted sync)
+    t0 = time.perf_counter()
+    keep = {f["file_id"] for f in files}
+    stale = {manifest[n]["file_id"] for n in changed + removed if manifest[n].get("file_id")}
+    async for vf in await _openai(client.vector_stores.files.list, vector_store_id=vector_store_id):
+        if vf.id not in keep:
+            stale.add(vf.id)
+
+    async def _detach(file_id: str) -> None:
+        try:
+            await _openai(client.vector_stores.files.delete, file_id=file_id, vector_store_id=vector_store_id)
+        except NotFoundError:
+            pass
+        try:
+            await _openai(client.files.delete, file_id)
+        except Exception:
+            pass
+
+    await asyncio.gather(*(_detach(fid) for fid in stale))
+    timings["detach_ms"] = int((time.perf_counter() - t0) * 1000)
+
+    new_state = dict(state, files=files)
+    if added or changed or removed or stale:
+        STATE.save(new_state)
+    changes = {
+        "added": added,
+        "changed": changed,
+        "removed": removed,
+        "unchanged": unchanged,
+        "detached_file_ids": sorted(stale),
+    }
+    return new_state, {"changes": changes, "timings_ms": timings}
+
+
+# ---------------------------
+# Per-module vector stores and question routing
+# ---------------------------
+
+def _parse_module_groups(spec: str) -> Dict[str, str]:
+    # "Finance=AP,AR;Make=Production,Scheduling" -> {"ap": "Finance", "ar": "Finance", ...}
+    groups: Dict[str, str] = {}
+    for part in spec.split(";"):
+        name, _, guides = part.partition("=")
+        for guide in guides.split(","):
+            if name.strip() and guide.strip():
+                groups[guide.strip().lower()] = name.strip()
+    return groups
+
+
+_MODULE_GROUPS = _parse_module_groups(MODULE_GROUPS)
+
+
+def _module_name(filename: str) -> str:
+    # "Cetec Guides - AP.md" -> "AP", unless MODULE_GROUPS puts the guide in a group
+    guide = Path(filename).stem.rsplit(" - ", 1)[-1].strip()
+    return _MODULE_GROUPS.get(guide.lower(), guide)
+
+
+def _route_modules(question: str) -> Tuple[List[str], float]:
+    """Pick the module(s) a question is about from the local section index.
+
+    BM25 scores of the top sections (headings count double) are summed per module.
+    Returns the top module when it holds ROUTING_MIN_SHARE of the total, the top two
+    when together they hold ROUTING_PAIR_SHARE, and no module (use the combined
+    store) otherwise, with the share of the score the choice covers.
+    """
+    scores: Dict[str, float] = {}
+    for hit in _get_search_index().search(question, k=ROUTING_TOP_SECTIONS):
+        module = _module_name(hit["filename"])
+        scores[module] = scores.get(module, 0.0) + hit["score"]
+    if not scores:
+        return [], 0.0
+    total = sum(scores.values())
+    ranked = sorted(scores.items(), key=lambda kv: -kv[1])
+    share = ranked[0][1] / total
+    if ranked[0][1] < ROUTING_MIN_SCORE:
+        return [], round(share, 3)
+    if share >= ROUTING_MIN_SHARE:
+        return [ranked[0][0]], round(share, 3)
+    if len(ranked) > 1 and (ranked[0][1] + ranked[1][1]) / total >= ROUTING_PAIR_SHARE:
+        return [ranked[0][0], ranked[1][0]], round((ranked[0][1] + ranked[1][1]) / total, 3)
+    return [], round(share, 3)
+
+
+def _assistant_route(data: "AskRequest", state: Dict[str, Any]) -> Dict[str, Any]:
+    """Assistant, thread kwargs and meta for one question.
+
+    A routed question runs on its top module's assistant; a second module's store is
+    attached to the new thread, and file_search searches both. Questions the router
+    is unsure about, and follow-ups on an existing thread, use the combined store.
+    """
+    route: Dict[str, Any] = {
+        "assistant_id": state["assistant_id"],
+        "thread": {},
+        "meta": {"stores": [state["vector_store_id"]]},
+    }
+    modules = state.get("modules") or {}
+    if not modules:
+        return route
+    picked, confidence = ([], 0.0) if data.thread_id else _route_modules(data.question)
+    picked = [m for m in picked if m in modules and m not in STATE.missing_modules]
+    route["meta"].update(modules=picked, route_confidence=confidence)
+    if not picked:
+        return route
+    stores = [modules[m]["vector_store_id"] for m in picked]
+    route["assistant_id"] = modules[picked[0]]["assistant_id"]
+    route["meta"]["stores"] = stores
+    if len(stores) > 1:
+        route["thread"] = {"tool_resources": {"file_search": {"vector_store_ids": stores[1:]}}}
+    return route
+
+
+async def _delete_module_resources(module: Dict[str, Any]) -> None:
+    # Best-effort; the uploaded files belong to the combined store and are not deleted here
+    try:
+        if module.get("assistant_id"):
+            await _openai(client.beta.assistants.delete, assistant_id=module["assistant_id"])
+    except Exception:
+        pass
+    try:
+        if module.get("vector_store_id"):
+            await _openai(client.vector_stores.delete, vector_store_id=module["vector_store_id"])
+    except Exception:
+        pass
+
+
+async def _sync_module_stores(state: Dict[str, Any], enabled: bool) -> Tuple[Dict[str, Any], Dict[str, List[str]]]:
+    """Create, update or remove the per-module vector stores and assistants.
+
+    Module stores hold the combined store's uploaded files (a file can sit in several
+    stores), so keeping them in step only attaches and detaches; nothing is uploaded
+    twice. Returns the new state and module -> guides.
+    """
+    current: Dict[str, Dict[str, Any]] = dict(state.get("modules") or {})
+    desired: Dict[str, List[Dict[str, str]]] = {}
+    if enabled:
+        for f in state.get("files", []):
+            if f.get("file_id"):
+                desired.setdefault(_module_name(f["filename"]), []).append(f)
+
+    async def _build(name: str, files: List[Dict[str, str]], module: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        want = [f["file_id"] for f in files]
+        if module is None:
+            store = await _openai(client.vector_stores.create, name=f"erp-help-docs-{name}")
+            module, have = {"vector_store_id": store.id}, set()
+        else:
+            module, have = dict(module), set(module.get("file_ids", []))
+        attach = [fid for fid in want if fid not in have]
+        if attach:
+            await _openai(
+                client.vector_stores.file_batches.create_and_poll,
+                vector_store_id=module["vector_store_id"],
+                file_ids=attach,
+            )
+        for fid in have - set(want):
+            try:
+                await _openai(client.vector_stores.files.delete, file_id=fid,
+                              vector_store_id=module["vector_store_id"])
+            except NotFoundError:
+                pass
+        if not module.get("assistant_id"):
+            assistant = await _openai(
+                client.beta.assistants.create,
+                name=f"ERP Help Assistant ({name})",
+                model=MODEL,
+                instructions=ASSISTANT_INSTRUCTIONS,
+                tools=[{"type": "file_search"}],
+                tool_resources={"file_search": {"vector_store_ids": [module["vector_store_id"]]}},
+            )
+            module["assistant_id"] = assistant.id
+        module.update(filenames=sorted(f["filename"] for f in files), file_ids=want)
+        return module
+
+    async def _sync(name: str) -> Dict[str, Any]:
+        try:
+            return await _build(name, desired[name], current.get(name))
+        except NotFoundError:
+            # Deleted behind our back: start this module over
+            await _delete_module_resources(current.get(name) or {})
+            return await _build(name, desired[name], None)
+
+    await asyncio.gather(*(_delete_module_resources(m) for n, m in current.items() if n not in desired))
+    names = sorted(desired)
+    modules = dict(zip(names, await asyncio.gather(*(_sync(n) for n in names))))
+    new_state = dict(state)
+    if modules:
+        new_state["modules"] = modules
+    else:
+        new_state.pop("modules", None)
+    if new_state != state:
+        STATE.save(new_state)
+    return new_state, {name: m["filenames"] for name, m in modules.items()}
+
+
+# ---------------------------
+# Conversation memory (reused thread_id)
+# ---------------------------
+
+class ConversationMemory:
+    """Per-thread token accounting for follow-up questions on a reused thread.
+
+    Each turn (question + answer) is kept with its estimated tokens. plan() turns
+    that into a truncation_strategy for the next run, so a run re-reads only the
+    recent conversation, or into a rollover to a fresh thread seeded with a compact
+    carry-over once the whole history is over budget. Threads this process has not
+    seen (another worker, a restart) are loaded once from the thread's messages.
+    """
+
+    def __init__(self, max_threads: int):
+        self.max = max_threads
+        # thread_id -> [{"question", "answer", "tokens"}, ...], least recently used first
+        self.threads: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+
+    def known(self, thread_id: str) -> bool:
+        return thread_id in self.threads
+
+    def _turns(self, thread_id: str) -> List[Dict[str, Any]]:
+        turns = self.threads.setdefault(thread_id, [])
+        self.threads.move_to_end(thread_id)
+        while len(self.threads) > self.max:
+            self.threads.popitem(last=False)
+        return turns
+
+    @staticmethod
+    def _turn(question: str, answer: str) -> Dict[str, Any]:
+        # Only as much of the answer as a carry-over could use is kept
+        clip = CONVERSATION_CARRYOVER_TOKENS * 4
+        return {"question": question, "answer": answer[:clip],
+                "tokens": _estimate_tokens(question) + _estimate_tokens(answer)}
+
+    def record(self, thread_id: str, question: str, answer: str) -> None:
+        self._turns(thread_id).append(self._turn(question, answer))
+
+    def load(self, thread_id: str, messages: List[Tuple[str, str]]) -> None:
+        # (role, text) pairs, oldest first, as read back from the thread
+        turns: List[Dict[str, Any]] = []
+        question: Optional[str] = None
+        for role, text in messages:
+            if role == "user":
+                if question is not None:
+                    turns.append(self._turn(question, ""))
+                question = text
+            elif role == "assistant":
+                turns.append(self._turn(question or "", text))
+                question = None
+        self.threads[thread_id] = turns
+        self._turns(thread_id)
+
+    def fresh(self) -> Dict[str, Any]:
+        return {"rollover": False, "carry": [], "run": {}, "meta": {"context_tokens": 0, "context_turns": 0}}
+
+    def blind(self) -> Dict[str, Any]:
+        # History unknown (could not be read): keep the last CONVERSATION_MAX_TURNS turns
+        run = {"truncation_strategy": {"type": "last_messages", "last_messages": 2 * CONVERSATION_MAX_TURNS + 1}}
+        return {"rollover": False, "carry": [], "run": run, "meta": {"context_tokens": None, "context_turns": None}}
+
+    def plan(self, thread_id: str) -> Dict[str, Any]:
+        """How the next run on thread_id should see its history.
+
+        Returns run kwargs (truncation_strategy), meta (context_tokens, context_turns)
+        and, when the history is over CONVERSATION_ROLLOVER_TOKENS, rollover=True with
+        the carry-over messages for the new thread.
+        """
+        turns = self._turns(thread_id)
+        total = sum(t["tokens"] for t in turns)
+        if CONVERSATION_ROLLOVER_TOKENS and total > CONVERSATION_ROLLOVER_TOKENS:
+            carry: List[Dict[str, str]] = []
+            budget = CONVERSATION_CARRYOVER_TOKENS
+            recent = turns[-CONVERSATION_CARRYOVER_TURNS:] if CONVERSATION_CARRYOVER_TURNS > 0 else []
+            per_answer = max(1, budget // max(1, len(recent))) * 4
+            for t in recent:
+                carry.append({"role": "user", "content": t["question"]})
+                if t["answer"]:
+                    carry.append({"role": "assistant", "content": t["answer"][:per_answer]})
+            tokens = sum(_estimate_tokens(m["content"]) for m in carry)
+            return {"rollover": True, "carry": carry, "run": {},
+                    "meta": {"context_tokens": tokens, "context_turns": len(recent),
+                             "thread_rollover": True, "previous_thread_id": thread_id}}
+        if CONVERSATION_POLICY == "turns":
+            keep = min(len(turns), CONVERSATION_MAX_TURNS)
+        else:
+            keep, used = 0, 0
+            for t in reversed(turns):
+                if keep and used + t["tokens"] > CONVERSATION_WINDOW_TOKENS:
+                    break
+                keep, used = keep + 1, used + t["tokens"]
+        tokens = sum(t["tokens"] for t in turns[len(turns) - keep:]) if keep else 0
+        # Each kept turn is a user and an assistant message, plus the new question
+        run = {"truncation_strategy": {"type": "last_messages", "last_messages": 2 * keep + 1}}
+        return {"rollover": False, "carry": [], "run": run,
+                "meta": {"context_tokens": tokens, "context_turns": keep}}
+
+    def rollover(self, old_thread_id: str, new_thread_id: str, carry_turns: int) -> None:
+        turns = self.threads.pop(old_thread_id, [])
+        self.threads[new_thread_id] = turns[-carry_turns:] if carry_turns else []
+        self._turns(new_thread_id)
+
+
+MEMORY = ConversationMemory(CONVERSATION_MAX_THREADS)
+
+
+def _message_text(message: Any) -> str:
+    parts = []
+    for item in getattr(message, "content", None) or []:
+        if getattr(item, "type", "") == "text":
+            parts.append(item.text.value)
+    return "".join(parts)
+
+
+async def _open_thread(data: "AskRequest", route: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """The thread this question runs on, and the conversation-memory plan for the run.
+
+    New questions get a new thread. A reused thread_id keeps its thread unless its
+    history is over budget, in which case the question moves to a fresh thread
+    seeded with the carry-over (the response's thread_id is the one to use next).
+    """
+    if not data.thread_id:
+        plan = MEMORY.fresh()
+    else:
+        plan = None
+        if not MEMORY.known(data.thread_id):
+            try:
+                msgs = await _openai(client.beta.threads.messages.list, thread_id=data.thread_id,
+                                     order="desc", limit=100)
+                MEMORY.load(data.thread_id, [(m.role, _message_text(m)) for m in reversed(msgs.data)])
+            except NotFoundError:
+                raise
+            except Exception:
+                plan = MEMORY.blind()
+        plan = plan or MEMORY.plan(data.thread_id)
+        if not plan["rollover"]:
+            return data.thread_id, plan
+    kwargs = dict(route["thread"])
+    if plan["carry"]:
+        kwargs["messages"] = plan["carry"]
+    with _stage("thread_create"):
+        thread = await _openai(client.beta.threads.create, **kwargs)
+    if plan["rollover"]:
+        MEMORY.rollover(data.thread_id, thread.id, plan["meta"]["context_turns"])  # type: ignore[attr-defined]
+    return thread.id, plan  # type: ignore[attr-defined]
+
+
+class RunDurationStats:
+    """Rolling window of how long runs took, used to time polls."""
+
+    QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9, 0.95)
+
+    def __init__(self, window: int = 200, min_samples: int = 10):
+        self.samples: "deque[float]" = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def schedule(self) -> List[float]:
+        # Offsets (seconds since run creation) at which a run is most likely to have finished
+        if len(self.samples) < self.min_samples:
+            return []
+        ordered = sorted(self.samples)
+        n = len(ordered)
+        return sorted({round(ordered[min(n - 1, int(q * n))], 3) for q in self.QUANTILES})
+
+
+RUN_STATS = RunDurationStats()
+
+
+async def _hedged_retrieve(thread_id: str, run_id: str) -> Tuple[Any, bool]:
+    # runs.retrieve is idempotent, so a slow poll can safely be raced by a second one
+    def _retrieve() -> "asyncio.Task[Any]":
+        return asyncio.ensure_future(_openai(client.beta.threads.runs.retrieve, thread_id=thread_id, run_id=run_id))
+
+    tasks = [_retrieve()]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=POLL_HEDGE_AFTER_SECONDS)
+        if done:
+            return tasks[0].result(), False
+        tasks.append(_retrieve())
+        pending: Set["asyncio.Task[Any]"] = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), True
+        # Both failed: raise the first one's error
+        return tasks[0].result(), True
+    finally:
+        # The loser, or both when the caller is cancelled (client gone, run timeout)
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def _poll_run(thread_id: str, run_id: str, timeout_s: float = RUN_TIMEOUT_SECONDS) -> Dict[str, Any]:
+    start = time.perf_counter()
+    targets = [POLL_FIRST_DELAY_SECONDS] + [t for t in RUN_STATS.schedule() if t > POLL_FIRST_DELAY_SECONDS]
+    backoff = POLL_MIN_INTERVAL_SECONDS
+    last_poll = 0.0
+    polls = 0
+    hedges = 0
+
+    def _result(status: str, run: Any) -> Dict[str, Any]:
+        return {"status": status, "run": run, "polls": polls, "hedges": hedges,
+                "wasted_ms": 0, "duration_s": time.perf_counter() - start}
+
+    while True:
+        elapsed = time.perf_counter() - start
+        upcoming = [t for t in targets if t > elapsed + POLL_MIN_INTERVAL_SECONDS / 2]
+        if upcoming:
+            delay = upcoming[0] - elapsed
+        else:
+            backoff = min(max(backoff, elapsed - last_poll) * 1.5, POLL_MAX_INTERVAL_SECONDS)
+            delay = backoff
+        await asyncio.sleep(min(max(delay, POLL_MIN_INTERVAL_SECONDS if polls else 0.0), POLL_MAX_INTERVAL_SECONDS))
+
+        prev_poll = last_poll
+        run, hedged = await _hedged_retrieve(thread_id, run_id)
+        last_poll = time.perf_counter() - start
+        polls += 1
+        hedges += int(hedged)
+        status = run.status  # type: ignore[attr-defined]
+        if status in ("completed", "failed", "cancelled", "expired", "incomplete"):
+            result = _result(status, run)
+            # The run finished somewhere after the previous poll; completed_at (epoch
+            # seconds) narrows that down when the API provides it
+            gap = last_poll - prev_poll
+            wasted = gap / 2
+            completed_at = getattr(run, "completed_at", None) or getattr(run, "failed_at", None)
+            if completed_at:
+                wasted = min(gap, max(0.0, time.time() - float(completed_at)))
+            result["wasted_ms"] = int(wasted * 1000)
+            if status == "completed":
+                RUN_STATS.add(max(0.0, last_poll - wasted))
+            return result
+        if status in ("requires_action",):
+            # We are not using tools that require action; cancel such runs
+            try:
+                await _openai(client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run_id)
+            except Exception:
+                pass
+            return _result("cancelled", run)
+        if time.perf_counter() - start > timeout_s:
+            try:
+                await _openai(client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run_id)
+            except Exception:
+                pass
+            return _result("expired", run)
+
+
+async def _extract_answer_and_citations(thread_id: str) -> Dict[str, Any]:
+    with _stage("message_list"):
+        msgs = await _openai(client.beta.threads.messages.list, thread_id=thread_id, order="desc", limit=5)
+    answer_text = ""
+    file_ids: Set[str] = set()
+
+    # Find the latest assistant message
+    for m in msgs.data:
+        if m.role == "assistant":
+            # Message content may contain multiple items
+            for item in m.content:
+                if item.type == "text":
+                    # Collect text
+                    answer_text += item.text.value  # type: ignore[attr-defined]
+                    # Collect citations
+                    file_ids |= _annotation_file_ids(item.text.annotations)  # type: ignore[attr-defined]
+            break
+
+    answer_text = answer_text.strip()
+    return {"answer": answer_text, "citations": await _resolve_citations(file_ids, answer_text)}
+
+
+def _annotation_file_ids(annotations: Any) -> Set[str]:
+    file_ids: Set[str] = set()
+    for ann in annotations or []:
+        try:
+            if ann.type == "file_citation":
+                file_ids.add(ann.file_citation.file_id)  # type: ignore[attr-defined]
+        except Exception:
+            continue
+    return file_ids
+
+
+# file_id -> filename, seeded from the state file; bounded LRU for ids learned later
+CITATION_NAME_CACHE_MAX = int(os.getenv("CITATION_NAME_CACHE_MAX", "1024"))
+_FILE_NAMES: "OrderedDict[str, str]" = OrderedDict()
+# How many unknown citation ids are looked up (files.retrieve) at once
+CITATION_LOOKUP_CONCURRENCY = int(os.getenv("CITATION_LOOKUP_CONCURRENCY", "4"))
+_FILE_LOOKUPS = asyncio.Semaphore(max(1, CITATION_LOOKUP_CONCURRENCY))
+
+
+def _remember_file_names(files: List[Dict[str, str]]) -> None:
+    for f in files:
+        if f.get("file_id"):
+            _FILE_NAMES[f["file_id"]] = f["filename"]
+            _FILE_NAMES.move_to_end(f["file_id"])
+    while len(_FILE_NAMES) > CITATION_NAME_CACHE_MAX:
+        _FILE_NAMES.popitem(last=False)
+
+
+async def _fetch_file_names(file_ids: Set[str]) -> None:
+    # files.retrieve for just the unknown ids (a few at a time), never a listing of the whole org
+    missing = [fid for fid in file_ids if fid not in _FILE_NAMES]
+
+    async def _lookup(fid: str) -> Optional[Dict[str, str]]:
+        async with _FILE_LOOKUPS:
+            if fid in _FILE_NAMES:
+                return None
+            try:
+                fo = await _openai(client.files.retrieve, fid)
+            except NotFoundError:
+                # Ids the API does not know fall back to the id itself; do not look them up again
+                return {"file_id": fid, "filename": fid}
+            except Exception:
+                # Transient: cite the id this time and try again next time
+                return None
+            return {"file_id": fid, "filename": fo.filename or fid}
+
+    learned = await asyncio.gather(*(_lookup(fid) for fid in missing))
+    _remember_file_names([f for f in learned if f is not None])
+
+
+async def _resolve_citations(file_ids: Set[str], answer: str = "") -> List[Dict[str, str]]:
+    # Map file_ids to filenames from memory; only ids we have never seen cost a lookup.
+    # With the answer, each citation links to the section of its guide that best matches it.
+    if any(fid not in _FILE_NAMES for fid in file_ids):
+        with _stage("citation_lookup"):
+            await _fetch_file_names(file_ids)
+    citations: List[Dict[str, str]] = []
+    for fid in sorted(file_ids):
+        fn = _FILE_NAMES.get(fid, fid)
+        if fid in _FILE_NAMES:
+            _FILE_NAMES.move_to_end(fid)
+        citation = {"file_id": fid, "filename": fn, "url": _doc_url(fn)}
+        section = _best_section(fn, answer) if answer else None
+        if section is not None:
+            citation["section"] = section["heading"]
+            citation["url"] = _doc_url(fn, section["anchor"])
+        citations.append(citation)
+    return citations
+
+
+def _best_section(filename: str, answer: str) -> Optional[Dict[str, Any]]:
+    # file_search citations name a file, not a passage: the answer's best BM25 section in it stands in
+    try:
+        hits = _get_search_index().search(answer, k=1, filenames={filename})
+    except Exception:
+        return None
+    return hits[0] if hits and hits[0]["anchor"] else None
+
+
+# ---------------------------
+# Run event streaming
+# ---------------------------
+
+async def _aiter_with_keepalive(events: Any, interval_s: float) -> AsyncIterator[Any]:
+    """Iterate an async event stream, yielding None after each quiet interval.
+
+    The pending read is kept across quiet intervals (not cancelled), so the caller
+    can emit keep-alives and enforce a deadline while the upstream is silent.
+    """
+    it = events.__aiter__()
+    pending: Optional["asyncio.Future[Any]"] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=interval_s)
+            if not done:
+                yield None
+                continue
+            fut, pending = pending, None
+            try:
+                item = fut.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def _stream_status(event: str, data: Any) -> Optional[str]:
+    # Map run lifecycle events onto the coarse statuses shown to users
+    if event == "thread.run.queued":
+        return "queued"
+    if event == "thread.run.in_progress":
+        return "in_progress"
+    if event in ("thread.run.step.created", "thread.run.step.in_progress"):
+        details = getattr(data, "step_details", None)
+        if getattr(details, "type", "") == "tool_calls":
+            return "searching_files"
+        return "in_progress"
+    if event == "thread.message.created":
+        return "writing"
+    return None
+
+
+# ---------------------------
+# Metrics
+# ---------------------------
+
+class _Metric:
+    """One Prometheus counter or histogram family, keyed by label values."""
+
+    def __init__(self, name: str, help_text: str, kind: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> value (counter) or [bucket counts..., sum, count] (histogram)
+        self.series: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels.get(k, "")) for k in self.labels)
+        with self._lock:
+            self.series[key] = self.series.get(key, 0.0) + amount
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(k, "")) for k in self.labels)
+        with self._lock:
+            s = self.series.get(key)
+            if s is None:
+                s = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    @staticmethod
+    def _fmt_labels(pairs: List[Tuple[str, str]]) -> str:
+        if not pairs:
+            return ""
+        body = ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+        return "{" + body + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted(self.series.items())
+        for key, value in series:
+            pairs = list(zip(self.labels, key))
+            if self.kind == "counter":
+                lines.append(f"{self.name}{self._fmt_labels(pairs)} {value}")
+                continue
+            for bound, count in zip(self.buckets, value):
+                lines.append(f"{self.name}_bucket{self._fmt_labels(pairs + [('le', repr(float(bound)))])} {count}")
+            lines.append(f"{self.name}_bucket{self._fmt_labels(pairs + [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{self.name}_sum{self._fmt_labels(pairs)} {value[-2]}")
+            lines.append(f"{self.name}_count{self._fmt_labels(pairs)} {value[-1]}")
+        return lines
+
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 120.0)
+
+METRIC_ANSWER_SECONDS = _Metric(
+    "erp_answer_duration_seconds", "Time to produce an answer, by mode and how it was produced.",
+    "histogram", ("mode", "outcome"), _LATENCY_BUCKETS)
+METRIC_STAGE_SECONDS = _Metric(
+    "erp_stage_duration_seconds", "Time spent in each stage of answering a question.",
+    "histogram", ("stage",), _LATENCY_BUCKETS)
+METRIC_RUN_POLLS = _Metric(
+    "erp_run_polls", "runs.retrieve calls per polled run.", "histogram", (), (1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+METRIC_TOKENS = _Metric("erp_tokens_total", "Tokens used by answers, per model.", "counter", ("model", "kind"))
+METRIC_COST = _Metric("erp_cost_usd_total", "Estimated spend on answers, per model.", "counter", ("model",))
+
+# Per-request stage breakdown (ms) for meta.timings; None unless the request asked for it
+_TIMINGS: "contextvars.ContextVar[Optional[Dict[str, float]]]" = contextvars.ContextVar("timings", default=None)
+
+
+def _record_stage(stage: str, seconds: float) -> None:
+    METRIC_STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _TIMINGS.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds * 1000, 1)
+
+
+@contextmanager
+def _stage(stage: str) -> Any:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_stage(stage, time.perf_counter() - start)
+
+
+def _record_run_phases(run: Any) -> None:
+    # Queueing and execution as reported by the API (whole-second timestamps)
+    created, started = getattr(run, "created_at", None), getattr(run, "started_at", None)
+    finished = getattr(run, "completed_at", None) or getattr(run, "failed_at", None)
+    if isinstance(created, (int, float)) and isinstance(started, (int, float)) and started >= created:
+        _record_stage("run_queued", float(started - created))
+        if isinstance(finished, (int, float)) and finished >= started:
+            _record_stage("run_execution", float(finished - started))
+
+
+def _render_metrics() -> str:
+    lines: List[str] = []
+    for metric in (METRIC_ANSWER_SECONDS, METRIC_STAGE_SECONDS, METRIC_RUN_POLLS, METRIC_TOKENS, METRIC_COST):
+        lines += metric.render()
+
+    def scalar(name: str, kind: str, help_text: str, samples: List[Tuple[str, float]]) -> None:
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+        lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+    scalar("erp_cache_lookups_total", "counter", "Answer cache lookups by result.",
+           [(f'{{result="{k}"}}', v) for k, v in CACHE_STATS.items() if k != "revalidations"])
+    scalar("erp_cache_revalidations_total", "counter", "Background refreshes of stale cache entries.",
+           [("", CACHE_STATS["revalidations"])])
+    entries, nbytes = ANSWER_CACHE.size()
+    scalar("erp_cache_entries", "gauge", "Answers in the cache.", [("", entries)])
+    scalar("erp_cache_bytes", "gauge", "Serialized size of cached answers.", [("", nbytes)])
+    scalar("erp_cache_evictions_total", "counter", "Answers evicted or refused admission by the cache.",
+           [('{reason="evicted"}', ANSWER_CACHE.counters["evicted"]),
+            ('{reason="rejected"}', ANSWER_CACHE.counters["rejected"]),
+            ('{reason="expired"}', ANSWER_CACHE.counters["expired"])])
+    gates = (ASK_GATE, STREAM_GATE, BATCH_GATE)
+    scalar("erp_admission_active", "gauge", "Requests holding an admission slot.",
+           [(f'{{endpoint="{g.name}"}}', g.active) for g in gates])
+    scalar("erp_admission_queue_depth", "gauge", "Requests waiting for an admission slot.",
+           [(f'{{endpoint="{g.name}"}}', len(g.waiters)) for g in gates])
+    scalar("erp_admission_rejections_total", "counter", "Requests refused with 503.",
+           [(f'{{endpoint="{g.name}",reason="{r[len("rejected_"):]}"}}', v)
+            for g in gates for r, v in g.counters.items() if r.startswith("rejected_")])
+    scalar("erp_openai_retries_total", "counter", "OpenAI calls retried after 429/5xx/connection errors.",
+           [("", RATE.counters["retries"])])
+    scalar("erp_openai_throttled_total", "counter", "429 responses from OpenAI.", [("", RATE.counters["throttled"])])
+    scalar("erp_openai_queue_depth", "gauge", "OpenAI calls waiting in the rate scheduler.",
+           [("", sum(1 for w in RATE.waiters if not w[3].done()))])
+    scalar("erp_breaker_open", "gauge", "1 while the OpenAI circuit breaker is open or probing.",
+           [("", int(BREAKER.state != "closed"))])
+    scalar("erp_breaker_opened_total", "counter", "Times the OpenAI circuit breaker opened.",
+           [("", BREAKER.counters["opened"])])
+    scalar("erp_breaker_rejections_total", "counter", "Calls and questions refused while the breaker was open.",
+           [("", BREAKER.counters["rejected"])])
+    today, this_month = LEDGER.spent()
+    scalar("erp_spend_usd", "gauge", "Spend so far by all workers (UTC day and month), as this worker knows it.",
+           [('{window="day"}', round(today, 6)), ('{window="month"}', round(this_month, 6))])
+    scalar("erp_budget_stage", "gauge", "Spend budget stage: 0 normal, 1 longer TTL, 2 semantic, 3 cache only.",
+           [("", BUDGET.stage())])
+    scalar("erp_budget_rejections_total", "counter", "Uncached questions refused because the budget is spent.",
+           [("", BUDGET.counters["rejected"])])
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------
+# Usage ledger and spend budget
+# ---------------------------
+
+# The endpoint an answer is booked to in the ledger; background work sets its own
+_ENDPOINT: "contextvars.ContextVar[str]" = contextvars.ContextVar("usage_endpoint", default="other")
+
+
+def _utc_day(ts: Optional[float] = None) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+class UsageLedger:
+    """Append-only record of answers, cache hits, tokens and cost per UTC day, model and endpoint.
+
+    record() only adds to in-memory buckets. flush() appends them, one row per
+    bucket in a single transaction, to a sqlite file every worker shares, and then
+    re-reads today's and this month's spend across all workers; the budget adds
+    what this process has not flushed yet.
+    """
+
+    FIELDS = ("requests", "hits", "semantic_hits", "shared", "misses", "input_tokens", "output_tokens", "cost_usd")
+    # _build_meta outcome -> counter
+    _OUTCOMES = {"cache": "hits", "semantic": "semantic_hits", "shared": "shared", "answered": "misses"}
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.pending: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        # Spend (USD per UTC day) not yet in `flushed`: recorded since the last flush, and being written
+        self.unflushed_usd: Dict[str, float] = {}
+        self.flushing_usd: Dict[str, float] = {}
+        # Spend by all workers as of the last flush, and this month's before today (it no longer changes)
+        self.flushed: Dict[str, Tuple[str, float]] = {"day": ("", 0.0), "month": ("", 0.0)}
+        self._month_before: Tuple[str, float] = ("", 0.0)
+        self._lock = asyncio.Lock()
+        self.counters: Dict[str, int] = {"flushes": 0, "rows": 0, "errors": 0}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " ts REAL NOT NULL, day TEXT NOT NULL, model TEXT NOT NULL, endpoint TEXT NOT NULL,"
+            " requests INTEGER NOT NULL, hits INTEGER NOT NULL, semantic_hits INTEGER NOT NULL,"
+            " shared INTEGER NOT NULL, misses INTEGER NOT NULL, input_tokens INTEGER NOT NULL,"
+            " output_tokens INTEGER NOT NULL, cost_usd REAL NOT NULL)"
+        )
+        # Covers the budget's per-day sums
+        conn.execute("CREATE INDEX IF NOT EXISTS usage_day_cost ON usage(day, cost_usd)")
+        return conn
+
+    def record(self, endpoint: str, model: str, outcome: str, input_tokens: int, output_tokens: int,
+               cost_usd: float) -> None:
+        day = _utc_day()
+        bucket = self.pending.get((day, model, endpoint))
+        if bucket is None:
+            bucket = self.pending[(day, model, endpoint)] = dict.fromkeys(self.FIELDS, 0)
+        bucket["requests"] += 1
+        bucket[self._OUTCOMES.get(outcome, "misses")] += 1
+        bucket["input_tokens"] += input_tokens
+        bucket["output_tokens"] += output_tokens
+        bucket["cost_usd"] += cost_usd
+        if cost_usd:
+            self.unflushed_usd[day] = self.unflushed_usd.get(day, 0.0) + cost_usd
+
+    def spent(self) -> Tuple[float, float]:
+        """Today's and this month's spend in USD (UTC), by all workers as far as this one knows."""
+        day = _utc_day()
+        month = day[:7]
+        flushed_day, day_usd = self.flushed["day"]
+        flushed_month, month_usd = self.flushed["month"]
+        today = day_usd if flushed_day == day else 0.0
+        this_month = month_usd if flushed_month == month else 0.0
+        for pending in (self.unflushed_usd, self.flushing_usd):
+            for d, usd in pending.items():
+                if d == day:
+                    today += usd
+                if d.startswith(month):
+                    this_month += usd
+        return today, this_month
+
+    async def flush(self) -> None:
+        async with self._lock:
+            batch, self.pending = self.pending, {}
+            self.flushing_usd, self.unflushed_usd = self.unflushed_usd, {}
+            try:
+                self.flushed = await asyncio.to_thread(self._append, batch)
+                self.counters["flushes"] += 1
+                self.counters["rows"] += len(batch)
+            except Exception:
+                # Keep the deltas for the next flush
+                self.counters["errors"] += 1
+                for key, bucket in batch.items():
+                    merged = self.pending.setdefault(key, dict.fromkeys(self.FIELDS, 0))
+                    for field in self.FIELDS:
+                        merged[field] += bucket[field]
+                for d, usd in self.flushing_usd.items():
+                    self.unflushed_usd[d] = self.unflushed_usd.get(d, 0.0) + usd
+            finally:
+                self.flushing_usd = {}
+
+    def _append(self, batch: Dict[Tuple[str, str, str], Dict[str, Any]]) -> Dict[str, Tuple[str, float]]:
+        now = time.time()
+        day = _utc_day(now)
+        month = day[:7]
+        conn = self._conn()
+        try:
+            if batch:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(now, d, model, endpoint, *(bucket[f] for f in self.FIELDS))
+                     for (d, model, endpoint), bucket in batch.items()],
+                )
+                conn.execute("COMMIT")
+            if self._month_before[0] != day:
+                (before,) = conn.execute("SELECT COALESCE(SUM(cost_usd), 0) FROM usage WHERE day >= ? AND day < ?",
+                                         (f"{month}-01", day)).fetchone()
+                self._month_before = (day, before)
+            (today,) = conn.execute("SELECT COALESCE(SUM(cost_usd), 0) FROM usage WHERE day = ?", (day,)).fetchone()
+        finally:
+            conn.close()
+        return {"day": (day, today), "month": (month, self._month_before[1] + today)}
+
+    async def run(self, interval_s: float) -> None:
+        while True:
+            await asyncio.sleep(interval_s)
+            await self.flush()
+
+    def report(self, since_day: str, by: List[str]) -> Dict[str, Any]:
+        """Totals since `since_day` (inclusive), grouped by any of day, model and endpoint."""
+        sums = ", ".join(f"SUM({f})" for f in self.FIELDS)
+        group = f" GROUP BY {', '.join(by)} ORDER BY {', '.join(by)}" if by else ""
+        conn = self._conn()
+        try:
+            rows = conn.execute(f"SELECT {', '.join(by + [sums])} FROM usage WHERE day >= ?{group}",
+                                (since_day,)).fetchall()
+        finally:
+            conn.close()
+        out: List[Dict[str, Any]] = []
+        for row in rows:
+            item = dict(zip(by + list(self.FIELDS), row))
+            if item["requests"] is None:
+                continue
+            item["cost_usd"] = round(item["cost_usd"], 6)
+            item["tokens"] = item["input_tokens"] + item["output_tokens"]
+            out.append(item)
+        return {"since": since_day, "by": by, "rows": out}
+
+
+LEDGER = UsageLedger(USAGE_LEDGER_PATH)
+
+
+class SpendBudget:
+    """Tightens answering as spend nears the daily or monthly cap.
+
+    The stage follows the larger share of either cap already spent:
+      0 normal
+      1 (BUDGET_EXTEND_TTL_AT) cached answers stay fresh BUDGET_TTL_MULTIPLIER times
+        longer and are not refreshed; warm-up stops
+      2 (BUDGET_SEMANTIC_AT) near-duplicates down to BUDGET_SEMANTIC_THRESHOLD count as hits too
+      3 (the cap) questions the cache cannot answer get a 429 until the day or month turns over
+    """
+
+    STAGES = ("normal", "extend_ttl", "semantic", "cache_only")
+
+    def __init__(self, ledger: UsageLedger, daily_usd: float, monthly_usd: float):
+        self.ledger = ledger
+        self.daily_usd = daily_usd
+        self.monthly_usd = monthly_usd
+        self.current = 0
+        self.counters: Dict[str, int] = {"rejected": 0, "tightened": 0}
+
+    def _shares(self) -> Tuple[float, float]:
+        today, this_month = self.ledger.spent()
+        return (today / self.daily_usd if self.daily_usd > 0 else 0.0,
+                this_month / self.monthly_usd if self.monthly_usd > 0 else 0.0)
+
+    def stage(self) -> int:
+        used = max(self._shares())
+        if used >= 1.0:
+            stage = 3
+        elif used >= BUDGET_SEMANTIC_AT:
+            stage = 2
+        elif used >= BUDGET_EXTEND_TTL_AT:
+            stage = 1
+        else:
+            stage = 0
+        if stage != self.current:
+            if stage > self.current:
+                self.counters["tightened"] += 1
+            self.current = stage
+            ANSWER_CACHE.ttl_extension_s = ANSWER_CACHE.ttl * (BUDGET_TTL_MULTIPLIER - 1) if stage >= 1 else 0
+        return stage
+
+    def resets_in_s(self) -> int:
+        # Until the binding cap resets: the first of next month once the monthly cap is spent, else midnight (UTC)
+        now = time.time()
+        if self._shares()[1] < 1.0:
+            return max(1, int((int(now) // 86400 + 1) * 86400 - now))
+        t = time.gmtime(now)
+        year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 else (t.tm_year, t.tm_mon + 1)
+        next_month = calendar.timegm((year, month, 1, 0, 0, 0))
+        return max(1, int(next_month - now))
+
+    def reject(self) -> HTTPException:
+        self.counters["rejected"] += 1
+        return HTTPException(
+            status_code=429,
+            detail="Spend budget reached: only questions answered before can be served. Retry later.",
+            headers={"Retry-After": str(self.resets_in_s())},
+        )
+
+    def status(self) -> Dict[str, Any]:
+        today, this_month = self.ledger.spent()
+        stage = self.stage()
+        return {
+            "stage": self.STAGES[stage],
+            "level": stage,
+            "daily_usd": self.daily_usd,
+            "monthly_usd": self.monthly_usd,
+            "spent_today_usd": round(today, 6),
+            "spent_month_usd": round(this_month, 6),
+            "used": round(max(self._shares()), 4),
+            "resets_in_s": self.resets_in_s() if stage >= 3 else None,
+            **self.counters,
+        }
+
+
+BUDGET = SpendBudget(LEDGER, BUDGET_DAILY_USD, BUDGET_MONTHLY_USD)
+
+
+# ---------------------------
+# Accounting helpers
+# ---------------------------
+
+def _usage_counts(usage: Any) -> Tuple[int, int, int]:
+    input_tokens = 0
+    output_tokens = 0
+    total_tokens = 0
+    try:
+        if usage:
+            # Support different SDK field names
+            input_tokens = getattr(usage, "input_tokens", getattr(usage, "prompt_tokens", 0)) or 0
+            output_tokens = getattr(usage, "output_tokens", getattr(usage, "completion_tokens", 0)) or 0
+            total_tokens = getattr(usage, "total_tokens", (input_tokens + output_tokens)) or (input_tokens + output_tokens)
+    except Exception:
+        pass
+    return input_tokens, output_tokens, total_tokens
+
+
+def _build_meta(start_ts: float, citations: Optional[List[Dict[str, str]]], usage: Any = None,
+                cached: bool = False, **extra: Any) -> Dict[str, Any]:
+    input_tokens, output_tokens, total_tokens = _usage_counts(usage)
+    cost_usd = round(input_tokens * INPUT_PRICE_PER_TOKEN + output_tokens * OUTPUT_PRICE_PER_TOKEN, 6)
+    elapsed = time.perf_counter() - start_ts
+    meta = {
+        "duration_seconds": round(elapsed, 4),
+        "duration_ms": int(elapsed * 1000),
+        "tokens": {"input": input_tokens, "output": output_tokens, "total": total_tokens},
+        "cost_usd": cost_usd,
+        "chunks": len(citations or []),
+        "shots": 0,
+        "model": MODEL,
+        "cached": cached,
+    }
+    meta.update(extra)
+    if input_tokens or output_tokens:
+        METRIC_TOKENS.inc(input_tokens, model=MODEL, kind="input")
+        METRIC_TOKENS.inc(output_tokens, model=MODEL, kind="output")
+        METRIC_COST.inc(cost_usd, model=MODEL)
+    if cached:
+        outcome = "semantic" if extra.get("cache_tier") == "semantic" else "cache"
+    elif extra.get("coalesced") or extra.get("deduplicated"):
+        outcome = "shared"
+    else:
+        outcome = "answered"
+    METRIC_ANSWER_SECONDS.observe(elapsed, mode=str(extra.get("mode", "")), outcome=outcome)
+    LEDGER.record(_ENDPOINT.get(), MODEL, outcome, input_tokens, output_tokens, cost_usd)
+    timings = _TIMINGS.get()
+    if timings is not None:
+        meta["timings"] = dict(timings)
+    return meta
+
+
+# ---------------------------
+# Fast answer mode (local retrieval + one chat-completions call)
+# ---------------------------
+
+_CITE_MARK_RE = re.compile(r"\[(\d{1,2})\]")
+
+
+def _resolve_mode(requested: Optional[str]) -> str:
+    mode = (requested or ANSWER_MODE).strip().lower()
+    if mode not in ("assistant", "fast"):
+        raise HTTPException(status_code=400, detail=f"Unknown answer mode: {mode}. Use 'assistant' or 'fast'.")
+    return mode
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prose; good enough for budgeting
+    return len(text) // 4 + 1
+
+
+def _fast_cache_scope() -> str:
+    # Stands in for the vector store id in the cache key: changes whenever a guide changes
+    sig = json.dumps(_get_search_index().signature)
+    return "local-" + hashlib.sha1(sig.encode("utf-8")).hexdigest()[:12]
+
+
+def _build_fast_context(question: str) -> Tuple[str, List[Dict[str, Any]]]:
+    hits = _get_search_index().search(question, k=FAST_CONTEXT_MAX_SECTIONS)
+    blocks: List[str] = []
+    used: List[Dict[str, Any]] = []
+    spent = 0
+    for sec in hits:
+        title = " > ".join([sec["filename"][:-3]] + sec["trail"])
+        block = f"[{len(used) + 1}] {title}\n{sec['text']}"
+        cost = _estimate_tokens(block)
+        if spent + cost > FAST_CONTEXT_TOKEN_BUDGET:
+            if used:
+                # Lower-ranked but shorter sections may still fit
+                continue
+            block = block[: FAST_CONTEXT_TOKEN_BUDGET * 4]
+            cost = _estimate_tokens(block)
+        blocks.append(block)
+        used.append(sec)
+        spent += cost
+    return "\n\n".join(blocks), used
+
+
+def _fast_citations(answer: str, sections: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    refs = [int(n) for n in _CITE_MARK_RE.findall(answer)]
+    picked = [sections[n - 1] for n in refs if 1 <= n <= len(sections)]
+    if not picked and not answer.startswith("Not covered"):
+        picked = sections[:1]
+    citations: List[Dict[str, str]] = []
+    seen: Set[str] = set()
+    for sec in picked:
+        url = _doc_url(sec["filename"], sec["anchor"])
+        if url in seen:
+            continue
+        seen.add(url)
+        citations.append({"file_id": "", "filename": sec["filename"], "section": sec["heading"], "url": url})
+    return citations
+
+
+async def _fast_answer_events(question: str) -> AsyncIterator[Dict[str, Any]]:
+    """Answer from locally retrieved sections with a single streaming chat call.
+
+    Yields {"type": "delta", "text": ...} frames as tokens arrive, then one
+    {"type": "done", ...} frame with the answer, citations and usage.
+    """
+    with _stage("retrieval"):
+        context, sections = _build_fast_context(question)
+    messages = [
+        {
+            "role": "system",
+            "content": ASSISTANT_INSTRUCTIONS
+            + " The documentation excerpts are numbered; cite them inline as [n].",
+        },
+        {"role": "user", "content": f"Documentation excerpts:\n\n{context}\n\nQuestion: {question}"},
+    ]
+    visible, budget = RATE.estimate("chat", messages[0]["content"] + messages[1]["content"])
+    with _stage("chat_create"):
+        stream = await _openai(
+            client.chat.completions.create,
+            tokens=budget,
+            # Stateless: a repeat after a timeout or 5xx costs tokens but changes nothing
+            idempotent=True,
+            model=MODEL,
+            messages=messages,
+            temperature=0,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+    stream_start = time.perf_counter()
+    parts: List[str] = []
+    usage = None
+    completion_id = ""
+    async for chunk in stream:
+        completion_id = completion_id or getattr(chunk, "id", "") or ""
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        for choice in chunk.choices or []:
+            text = getattr(choice.delta, "content", None)
+            if text:
+                if not parts:
+                    _record_stage("first_token", time.perf_counter() - stream_start)
+                parts.append(text)
+                yield {"type": "delta", "text": text}
+    _record_stage("chat_stream", time.perf_counter() - stream_start)
+    RATE.settle("chat", visible, budget, usage)
+    answer = "".join(parts).strip() or "Not covered in our docs."
+    yield {
+        "type": "done",
+        "answer": answer,
+        "citations": _fast_citations(answer, sections),
+        "usage": usage,
+        "completion_id": completion_id,
+        "sections": len(sections),
+    }
+
+
+async def _ask_fast_run(data: AskRequest, state: Dict[str, Any], cache_key: str,
+                        start_ts: float) -> Dict[str, Any]:
+    result: Dict[str, Any] = {}
+    async for event, payload in _fast_run_events(data, state, cache_key, start_ts):
+        if event == "error":
+            raise HTTPException(status_code=500 if payload["status"] == "error" else 502, detail=payload["message"])
+        if event == "result":
+            result = payload
+    return result
+
+
+async def _fast_run_events(data: AskRequest, state: Dict[str, Any], cache_key: str,
+                           start_ts: float) -> AsyncIterator[Tuple[str, Any]]:
+    final: Dict[str, Any] = {}
+    try:
+        async for ev in _fast_answer_events(data.question):
+            if ev["type"] == "delta":
+                yield "delta", {"text": ev["text"]}
+            else:
+                final = ev
+    except HTTPException:
+        raise
+    except (APIConnectionError, APIStatusError) as e:
+        yield "error", {"status": "failed", "message": f"OpenAI API error: {e}"}
+        return
+    except Exception as e:
+        yield "error", {"status": "error", "message": str(e)}
+        return
+    if not final:
+        yield "error", {"status": "error", "message": "Answer stream ended without a result."}
+        return
+
+    answer = final["answer"]
+    citations = final["citations"]
+    meta = _build_meta(start_ts, citations, usage=final["usage"], mode="fast",
+                       context_sections=final["sections"])
+    try:
+        _cache_store(cache_key, {"answer": answer, "citations": citations, "cost_usd": meta["cost_usd"]})
+    except Exception:
+        pass
+    yield "result", {
+        "answer": answer,
+        "citations": citations,
+        "thread_id": data.thread_id or "fast",
+        "run_id": final["completion_id"] or "fast",
+        "assistant_id": state.get("assistant_id", ""),
+        "meta": meta,
+    }
+
+
+# ---------------------------
+# Request coalescing (single-flight)
+# ---------------------------
+
+class _Flight:
+    """One in-progress answer that concurrent duplicate requests can wait on.
+
+    The leader publishes the frames it streams (status/delta) and then either
+    finish()es with the full AskResponse dict or fail()s. Followers replay the
+    frames published so far and then follow live.
+    """
+
+    def __init__(self) -> None:
+        self.events: List[Tuple[str, Any]] = []
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[Dict[str, Any]] = None
+        self.done = False
+        self.followers = 0
+        self._changed = asyncio.Event()
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, event: str, payload: Any) -> None:
+        self.events.append((event, payload))
+        self._wake()
+
+    def finish(self, result: Dict[str, Any]) -> None:
+        self.result = result
+        self.done = True
+        self._wake()
+
+    def fail(self, status: str, message: str, http_status: int = 502) -> None:
+        self.error = {"status": status, "message": message, "http_status": http_status}
+        self.done = True
+        self._wake()
+
+    async def wait(self) -> None:
+        while not self.done:
+            await self._changed.wait()
+
+    async def subscribe(self, keepalive_s: float) -> AsyncIterator[Tuple[str, Any]]:
+        # Yields ("", None) after each quiet interval so callers can keep the connection alive
+        idx = 0
+        while True:
+            while idx < len(self.events):
+                yield self.events[idx]
+                idx += 1
+            if self.done:
+                return
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=keepalive_s)
+            except asyncio.TimeoutError:
+                yield "", None
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self.flights: Dict[str, _Flight] = {}
+
+    def join(self, key: str) -> Tuple[_Flight, bool]:
+        # Returns the flight for key and whether the caller leads it
+        flight = self.flights.get(key)
+        if flight is not None and not flight.done:
+            flight.followers += 1
+            return flight, False
+        flight = _Flight()
+        self.flights[key] = flight
+        return flight, True
+
+    def release(self, key: str, flight: _Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+
+IN_FLIGHT = SingleFlight()
+
+
+def _coalesced_response(result: Dict[str, Any], start_ts: float, mode: str) -> Dict[str, Any]:
+    # Followers did not pay for the run, so their own accounting shows zero tokens
+    citations = result["citations"]
+    return {
+        "answer": result["answer"],
+        "citations": citations,
+        "thread_id": "coalesced",
+        "run_id": result["run_id"],
+        "assistant_id": result["assistant_id"],
+        "meta": _build_meta(start_ts, citations, mode=mode, coalesced=True),
+    }
+
+
+async def _answer_json(cache_key: str, data: AskRequest, start_ts: float, mode: str,
+                       work: Any) -> Dict[str, Any]:
+    """Run work() once per cache key; concurrent duplicates wait for its result.
+
+    Follow-ups on an existing thread depend on that thread's history and are never shared.
+    """
+    if data.thread_id:
+        return await work()
+    flight, leader = IN_FLIGHT.join(cache_key)
+    if not leader:
+        await flight.wait()
+        if flight.error is not None:
+            raise HTTPException(status_code=flight.error["http_status"], detail=flight.error["message"])
+        return _coalesced_response(flight.result or {}, start_ts, mode)
+    try:
+        result = await work()
+        if flight.followers:
+            result["meta"]["coalesced_followers"] = flight.followers
+        flight.finish(result)
+        return result
+    except HTTPException as e:
+        flight.fail("failed", str(e.detail), e.status_code)
+        raise
+    finally:
+        if not flight.done:
+            flight.fail("cancelled", "The request answering this question was interrupted.", 503)
+        IN_FLIGHT.release(cache_key, flight)
+
+
+async def _answer_sse(cache_key: str, data: AskRequest, start_ts: float, mode: str,
+                      events: Any) -> AsyncIterator[str]:
+    """Stream one answer per cache key; concurrent duplicates subscribe to the leader's frames.
+
+    events() yields (event, payload) tuples: "status"/"delta" frames, "keepalive",
+    then a terminal "result" (AskResponse dict) or "error".
+    """
+    flight: Optional[_Flight] = None
+    if not data.thread_id:
+        flight, leader = IN_FLIGHT.join(cache_key)
+        if not leader:
+            saw_delta = False
+            async for event, payload in flight.subscribe(STREAM_KEEPALIVE_SECONDS):
+                if not event:
+                    yield ": keep-alive\n\n"
+                    continue
+                saw_delta = saw_delta or event == "delta"
+                yield _sse(event, payload)
+            if flight.error is not None:
+                yield _sse("error", {"status": flight.error["status"], "message": flight.error["message"]})
+                return
+            resp = _coalesced_response(flight.result or {}, start_ts, mode)
+            _log_query("ask/stream", data.question, mode, resp)
+            if not saw_delta:
+                yield _sse("delta", {"text": resp["answer"]})
+            yield _sse("done", {"meta": resp["meta"], "citations": resp["citations"]})
+            return
+    try:
+        async for event, payload in events():
+            if event == "keepalive":
+                yield ": keep-alive\n\n"
+            elif event == "error":
+                if flight is not None:
+                    flight.fail(payload["status"], payload["message"])
+                yield _sse("error", payload)
+                return
+            elif event == "result":
+                if flight is not None:
+                    if flight.followers:
+                        payload["meta"]["coalesced_followers"] = flight.followers
+                    flight.finish(payload)
+                _log_query("ask/stream", data.question, mode, payload)
+                # thread_id is the one to send follow-ups on (it changes when a long thread rolls over)
+                yield _sse("done", {"meta": payload["meta"], "citations": payload["citations"],
+                                    "thread_id": payload["thread_id"]})
+                return
+            else:
+                if flight is not None:
+                    flight.publish(event, payload)
+                yield _sse(event, payload)
+    except HTTPException as e:
+        # e.g. the circuit breaker opened mid-answer; the stream has started, so report it in-band
+        if flight is not None:
+            flight.fail("failed", str(e.detail), e.status_code)
+        yield _sse("error", {"status": "failed", "message": str(e.detail)})
+    except (APIConnectionError, APIStatusError) as e:
+        if flight is not None:
+            flight.fail("failed", f"OpenAI API error: {e}")
+        yield _sse("error", {"status": "failed", "message": f"OpenAI API error: {e}"})
+    finally:
+        if flight is not None:
+            if not flight.done:
+                flight.fail("cancelled", "The request answering this question was interrupted.", 503)
+            IN_FLIGHT.release(cache_key, flight)
 
 
 # ---------------------------
-# Models
+# Admission control
 # ---------------------------
 
-class SetupRequest(BaseModel):
-    recreate: Optional[bool] = False
-
+class AdmissionGate:
+    """Concurrency limit for one endpoint, with a bounded FIFO wait queue and a deadline.
 
-class SetupResponse(BaseModel):
-    assistant_id: str
-    vector_store_id: str
-    files_indexed: int
-    files: List[Dict[str, str]]
+    Requests over the limit wait for a slot for at most `timeout_s`; when the queue
+    is already full they are turned away at once. Either way the caller gets a 503
+    with a Retry-After estimated from recent service times, instead of piling up.
+    """
 
+    def __init__(self, name: str, limit: int, queue_size: int, timeout_s: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout_s = timeout_s
+        self.active = 0
+        self.waiters: "deque[asyncio.Future[None]]" = deque()
+        # Moving average of how long an admitted request holds its slot
+        self.service_s = 10.0
+        self.counters: Dict[str, int] = {
+            "admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0, "rejected_degraded": 0,
+        }
 
-class AskRequest(BaseModel):
-    question: str
-    thread_id: Optional[str] = None
+    def retry_after_s(self) -> int:
+        backlog = (len(self.waiters) + 1) / max(self.limit, 1)
+        return max(1, min(120, math.ceil(self.service_s * backlog)))
 
+    def reject(self, reason: str, retry_after_s: int = 0) -> HTTPException:
+        self.counters[f"rejected_{reason}"] += 1
+        return HTTPException(
+            status_code=503,
+            detail=f"Server busy ({self.name}: {reason}). Retry shortly.",
+            headers={"Retry-After": str(max(retry_after_s, self.retry_after_s()))},
+        )
 
-class AskResponse(BaseModel):
-    answer: str
-    citations: List[Dict[str, str]]
-    thread_id: str
-    run_id: str
-    assistant_id: str
-    meta: Dict[str, Any]
+    async def acquire(self) -> None:
+        if self.limit <= 0 or (self.active < self.limit and not self.waiters):
+            self.active += 1
+            self.counters["admitted"] += 1
+            return
+        if len(self.waiters) >= self.queue_size:
+            raise self.reject("full")
+        fut: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        self.counters["queued"] += 1
+        try:
+            with _stage("admission_wait"):
+                await asyncio.wait({fut}, timeout=self.timeout_s)
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # Handed a slot just as we were cancelled (client gone): pass it on
+                self._hand_off()
+            raise
+        finally:
+            if not fut.done():
+                fut.cancel()
+                try:
+                    self.waiters.remove(fut)
+                except ValueError:
+                    pass
+        if fut.cancelled():
+            raise self.reject("timeout")
+        self.counters["admitted"] += 1
 
+    def release(self, held_s: float) -> None:
+        self.service_s = 0.8 * self.service_s + 0.2 * held_s
+        self._hand_off()
 
-# ---------------------------
-# State helpers
-# ---------------------------
+    def _hand_off(self) -> None:
+        # Hand the slot straight to the next live waiter
+        while self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
 
-def _load_state() -> Dict[str, Any]:
-    if STATE_FILE.exists():
-        try:
-            return json.loads(STATE_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
-    return {}
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queue_depth": len(self.waiters),
+            "queue_size": self.queue_size,
+            "queue_timeout_s": self.timeout_s,
+            "avg_service_s": round(self.service_s, 3),
+            **self.counters,
+        }
 
 
-def _save_state(state: Dict[str, Any]) -> None:
-    STATE_FILE.write_text(json.dumps(state, indent=2), encoding="utf-8")
+ASK_GATE = AdmissionGate("ask", ASK_MAX_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT_SECONDS)
+STREAM_GATE = AdmissionGate("ask_stream", ASK_STREAM_MAX_CONCURRENCY, ADMISSION_QUEUE_SIZE,
+                            ADMISSION_QUEUE_TIMEOUT_SECONDS)
+BATCH_GATE = AdmissionGate("ask_batch", BATCH_MAX_ACTIVE, BATCH_MAX_ACTIVE, ADMISSION_QUEUE_TIMEOUT_SECONDS)
 
 
-def _list_markdown_files() -> List[Path]:
-    files: List[Path] = []
-    for p in sorted(HELP_DOCS_DIR.glob("*.md")):
-        files.append(p)
-    return files
+def _upstream_saturated() -> bool:
+    # OpenAI is throttling us, or the rate scheduler already has a long queue
+    if not DEGRADE_WHEN_SATURATED:
+        return False
+    if RATE.paused_until > time.monotonic():
+        return True
+    return sum(1 for w in RATE.waiters if not w[3].done()) >= DEGRADE_RATE_QUEUE_DEPTH
 
 
-# ---------------------------
-# OpenAI Assistants setup
-# ---------------------------
+@asynccontextmanager
+async def _admission(gate: AdmissionGate, cache_key: str, data: AskRequest) -> AsyncIterator[None]:
+    """Hold a slot of `gate` while answering a cache miss.
 
-def _delete_previous_resources(state: Dict[str, Any]) -> None:
-    # Best-effort clean-up; ignore errors
+    Requests that will join an identical in-flight answer need no slot. While the
+    upstream is saturated or the circuit breaker is open the server is cache-only: misses
+    are refused straight away (503), as they are once the spend budget is used up (429).
+    """
+    if not data.thread_id and cache_key in IN_FLIGHT.flights:
+        yield
+        return
+    if BUDGET.stage() >= 3:
+        raise BUDGET.reject()
+    if BREAKER.is_open():
+        raise BREAKER.reject()
+    if _upstream_saturated():
+        raise gate.reject("degraded", math.ceil(max(0.0, RATE.paused_until - time.monotonic())))
+    await gate.acquire()
+    start = time.perf_counter()
     try:
-        if "assistant_id" in state:
-            client.beta.assistants.delete(assistant_id=state["assistant_id"])
-    except Exception:
-        pass
+        yield
+    finally:
+        gate.release(time.perf_counter() - start)
 
-    try:
-        if "vector_store_id" in state:
-            client.vector_stores.delete(vector_store_id=state["vector_store_id"])
-    except Exception:
-        pass
 
+async def _stream_after_admission(frames: AsyncIterator[str], media_type: str) -> StreamingResponse:
+    """Run a frame generator up to its first frame before responding.
 
-def _create_or_get_assistant_and_vector_store(recreate: bool = False) -> Dict[str, Any]:
-    state = _load_state()
+    Generators admit themselves before their first frame, so a rejection is still a
+    plain 503 with Retry-After rather than an error inside a 200 stream.
+    """
+    first = await frames.__anext__()
 
-    if not recreate and "assistant_id" in state and "vector_store_id" in state:
-        # Validate they still exist by attempting a lightweight retrieve
+    async def _chain() -> AsyncIterator[str]:
         try:
-            client.beta.assistants.retrieve(assistant_id=state["assistant_id"])
-            client.vector_stores.retrieve(vector_store_id=state["vector_store_id"])
-            return state
-        except Exception:
-            # If retrieval fails, proceed to recreate them
-            pass
+            yield first
+            async for frame in frames:
+                yield frame
+        finally:
+            await frames.aclose()  # type: ignore[attr-defined]
 
-    if recreate and state:
-        _delete_previous_resources(state)
-        state = {}
+    return StreamingResponse(_chain(), media_type=media_type)
 
-    # 1) Create a vector store
-    vector_store = client.vector_stores.create(name="erp-help-docs")
 
-    # 2) Upload and attach all Markdown files
-    md_files = _list_markdown_files()
-    file_streams = [open(str(p), "rb") for p in md_files]
-    file_batch = None
-    try:
-        if file_streams:
-            file_batch = client.vector_stores.file_batches.upload_and_poll(
-                vector_store_id=vector_store.id,
-                files=file_streams,
-            )
-    finally:
-        # Ensure streams are closed
-        for fs in file_streams:
-            try:
-                fs.close()
-            except Exception:
-                pass
+# ---------------------------
+# Cache warm-up
+# ---------------------------
 
-    # 3) Create the Assistant with File Search tool attached
-    instructions = (
-        "You are an ERP help center assistant. Answer strictly from the provided help documentation. "
-        "If the docs do not contain the answer, respond with: Not covered in our docs. "
-        "Provide step-by-step guidance and list the exact menu paths users should click. "
-        "Always include source citations indicating the document title and section. "
-        "Do not invent steps or features. Keep answers concise, 1–2 short paragraphs unless a numbered list of steps is necessary."
-    )
+def _load_warmup_questions(path: Optional[Path] = None) -> List[str]:
+    # One question per line; blank lines, "#" comments and repeats (after normalization) are skipped
+    path = path or WARMUP_QUESTIONS_FILE
+    if not path.exists():
+        return []
+    seen: Set[str] = set()
+    questions: List[str] = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        q = line.strip()
+        if not q or q.startswith("#") or _normalize_question(q) in seen:
+            continue
+        seen.add(_normalize_question(q))
+        questions.append(q)
+    return questions
 
-    assistant = client.beta.assistants.create(
-        name="ERP Help Assistant",
-        model=MODEL,
-        instructions=instructions,
-        tools=[{"type": "file_search"}],
-        tool_resources={
-            "file_search": {
-                "vector_store_ids": [vector_store.id]
-            }
-        },
-    )
 
-    # Capture filenames for later citation lookup
-    attached_files: List[Dict[str, str]] = []
-    try:
-        # Vector store files list may be large; we only need names we just uploaded
-        if file_batch and hasattr(file_batch, "file_counts"):
-            # Fallback to local list we uploaded
-            for p in md_files:
-                attached_files.append({"filename": p.name, "path": f"/docs/{p.name}"})
-        else:
-            for p in md_files:
-                attached_files.append({"filename": p.name, "path": f"/docs/{p.name}"})
-    except Exception:
-        for p in md_files:
-            attached_files.append({"filename": p.name, "path": f"/docs/{p.name}"})
+# The current (or last) warm-up task and its progress report, served by GET /warmup
+_WARMUP: Dict[str, Any] = {"task": None, "report": {"status": "idle"}}
 
-    new_state = {
-        "assistant_id": assistant.id,
-        "vector_store_id": vector_store.id,
-        "files": attached_files,
-    }
-    _save_state(new_state)
-    return new_state
 
+async def _warm_cache(questions: List[str], mode: str, concurrency: int, force: bool = False,
+                      report: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Answer canonical questions ahead of users and cache them for the current docs index.
 
-def _poll_run(thread_id: str, run_id: str, timeout_s: float = 120.0, interval_s: float = 0.7) -> Dict[str, Any]:
-    start = time.time()
-    while True:
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-        status = run.status  # type: ignore[attr-defined]
-        if status in ("completed", "failed", "cancelled", "expired"):
-            return {"status": status, "run": run}
-        if status in ("requires_action",):
-            # We are not using tools that require action; cancel such runs
-            try:
-                client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
-            except Exception:
-                pass
-            return {"status": "cancelled", "run": run}
-        if time.time() - start > timeout_s:
+    Questions that are already cached (and fresh) are skipped unless `force`. Answers
+    go through the same single-flight path as /ask, so a user asking one of them
+    meanwhile waits for the warm-up run instead of paying for a second one.
+    """
+    state = STATE.get()
+    if mode == "assistant" and ("assistant_id" not in state or "vector_store_id" not in state):
+        raise RuntimeError("Setup not completed. Call /setup first.")
+    _PRIORITY.set(RateScheduler.BACKGROUND)
+    _ENDPOINT.set("warmup")
+    _TIMINGS.set(None)
+    scope = _fast_cache_scope() if mode == "fast" else state["vector_store_id"]
+    start = time.perf_counter()
+    report = {} if report is None else report
+    report.update({
+        "status": "running", "mode": mode, "scope": scope, "started_at": round(time.time(), 3),
+        "questions": len(questions), "answered": 0, "already_cached": 0, "skipped_budget": 0, "errors": 0,
+        "failed": [],
+        "tokens": {"input": 0, "output": 0, "total": 0}, "cost_usd": 0.0, "duration_ms": 0,
+    })
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(question: str) -> None:
+        key = _cache_key(question, MODEL, scope)
+        if not force and ANSWER_CACHE.get(key) is not None:
+            report["already_cached"] += 1
+            return
+        async with sem:
+            if BUDGET.stage() >= 1:
+                # Pre-paying for answers is the first spend a tight budget gives up
+                report["skipped_budget"] += 1
+                return
+            req = AskRequest(question=question, mode=mode)
+            item_ts = time.perf_counter()
             try:
-                client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
-            except Exception:
-                pass
-            return {"status": "expired", "run": run}
-        time.sleep(interval_s)
+                resp = await _answer_json(key, req, item_ts, mode, _answer_work(req, dict(state), key, item_ts, mode))
+            except Exception as e:
+                report["errors"] += 1
+                report["failed"].append({"question": question,
+                                         "error": str(e.detail) if isinstance(e, HTTPException) else str(e)})
+                return
+        meta = resp["meta"]
+        report["answered"] += 1
+        for part in ("input", "output", "total"):
+            report["tokens"][part] += meta["tokens"][part]
+        report["cost_usd"] = round(report["cost_usd"] + meta["cost_usd"], 6)
 
+    try:
+        await asyncio.gather(*(one(q) for q in questions))
+        report["status"] = "done"
+    except asyncio.CancelledError:
+        report["status"] = "cancelled"
+        raise
+    finally:
+        report["duration_ms"] = int((time.perf_counter() - start) * 1000)
+        report["finished_at"] = round(time.time(), 3)
+    return report
 
-def _extract_answer_and_citations(thread_id: str) -> Dict[str, Any]:
-    msgs = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=5)
-    answer_text = ""
-    file_ids: Set[str] = set()
 
-    # Find the latest assistant message
-    for m in msgs.data:
-        if m.role == "assistant":
-            # Message content may contain multiple items
-            for item in m.content:
-                if item.type == "text":
-                    # Collect text
-                    answer_text += item.text.value  # type: ignore[attr-defined]
-                    # Collect citations
-                    for ann in item.text.annotations:  # type: ignore[attr-defined]
-                        try:
-                            if ann.type == "file_citation":
-                                file_ids.add(ann.file_citation.file_id)  # type: ignore[attr-defined]
-                        except Exception:
-                            continue
-            break
+def _schedule_warmup(questions: Optional[List[str]] = None, mode: Optional[str] = None,
+                     concurrency: Optional[int] = None, force: bool = False) -> "asyncio.Task[Any]":
+    # One warm-up at a time; a new one (e.g. after another reindex) replaces the old
+    previous = _WARMUP["task"]
+    if previous is not None and not previous.done():
+        previous.cancel()
+    questions = _load_warmup_questions() if questions is None else questions
+    mode = _resolve_mode(mode)
+    report: Dict[str, Any] = {"status": "scheduled", "mode": mode, "questions": len(questions)}
 
-    # Map file_ids to filenames
-    citations: List[Dict[str, str]] = []
-    for fid in file_ids:
+    async def _run() -> Dict[str, Any]:
         try:
-            fi = client.files.retrieve(fid)
-            fn = fi.filename or fid  # type: ignore[attr-defined]
-        except Exception:
-            fn = fid
-        citations.append({
-            "file_id": fid,
-            "filename": fn,
-            "url": f"/docs/{fn}",
-        })
+            return await _warm_cache(questions, mode, concurrency or WARMUP_CONCURRENCY, force, report)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            report.update({"status": "failed", "error": str(e)})
+            return report
 
-    return {"answer": answer_text.strip(), "citations": citations}
+    _WARMUP["report"] = report
+    _WARMUP["task"] = asyncio.ensure_future(_run())
+    return _WARMUP["task"]
 
 
 # ---------------------------
@@ -335,18 +3913,51 @@ def health() -> Dict[str, str]:
 
 
 @app.post("/setup", response_model=SetupResponse)
-def setup(data: SetupRequest) -> Any:
+async def setup(data: SetupRequest) -> Any:
     try:
-        state = _create_or_get_assistant_and_vector_store(recreate=bool(data.recreate))
-        # Clear cache on reindex to avoid stale answers
-        if bool(data.recreate):
-            ANSWER_CACHE.clear()
+        start = time.perf_counter()
+        report: Dict[str, Any] = {}
+        rebuilt = bool(data.recreate)
+        state = old_state = STATE.get()
+        if data.incremental and not data.recreate and "assistant_id" in state and "vector_store_id" in state:
+            try:
+                state, report = await _sync_vector_store(state)
+                STATE.mark_validated()
+            except NotFoundError:
+                # The store is gone; fall back to building everything from scratch
+                state = await _create_or_get_assistant_and_vector_store(recreate=True)
+                rebuilt = True
+        else:
+            state = await _create_or_get_assistant_and_vector_store(recreate=bool(data.recreate))
+        # Per-module stores follow the combined store's files (or are removed when turned off)
+        modules = None
+        want_modules = MODULE_STORES if data.modules is None else data.modules
+        if want_modules or state.get("modules"):
+            state, modules = await _sync_module_stores(state, bool(want_modules))
+            modules = modules or None
+        # Evict only the cached answers whose cited documents changed
+        cache_stats = _invalidate_answer_cache(old_state, state)
+        # Keep the local section index in step with the uploaded docs (the corpus
+        # signature picks up incremental edits on its own)
+        _get_search_index(rebuild=rebuilt)
+        await asyncio.to_thread(DOCS.refresh, rebuilt)
+        if report:
+            report["timings_ms"]["total_ms"] = int((time.perf_counter() - start) * 1000)
+        # Re-answer the canonical questions the reindex evicted (or a fresh store lacks)
+        warmup = None
+        if WARMUP_AFTER_SETUP if data.warmup is None else data.warmup:
+            _schedule_warmup()
+            warmup = dict(_WARMUP["report"])
         files = state.get("files", [])
         return {
             "assistant_id": state["assistant_id"],
             "vector_store_id": state["vector_store_id"],
             "files_indexed": len(files),
             "files": files,
+            "cache": cache_stats,
+            "warmup": warmup,
+            "modules": modules,
+            **report,
         }
     except (APIConnectionError, APIStatusError) as e:
         raise HTTPException(status_code=502, detail=f"OpenAI API error: {e}")
@@ -354,71 +3965,251 @@ def setup(data: SetupRequest) -> Any:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/warmup")
+async def warmup(data: WarmupRequest) -> Dict[str, Any]:
+    """Answer the warm-up questions (or the given ones) into the cache; poll GET /warmup for progress."""
+    state = STATE.get()
+    mode = _resolve_mode(data.mode)
+    if mode == "assistant" and ("assistant_id" not in state or "vector_store_id" not in state):
+        raise HTTPException(status_code=400, detail="Setup not completed. Call /setup first.")
+    questions = [q for q in data.questions if q.strip()] if data.questions is not None else None
+    task = _schedule_warmup(questions, mode, data.concurrency, bool(data.force))
+    if data.wait:
+        return await asyncio.shield(task)
+    return dict(_WARMUP["report"])
+
+
+@app.get("/warmup")
+def warmup_status() -> Dict[str, Any]:
+    """Progress and totals of the current or last warm-up."""
+    return dict(_WARMUP["report"])
+
+
+@app.get("/cache/stats")
+async def cache_stats() -> Dict[str, Any]:
+    """Answer cache size, policy settings and counters (counters are per worker process)."""
+    return {
+        "backend": ANSWER_CACHE_BACKEND,
+        **ANSWER_CACHE.stats(),
+        **CACHE_STATS,
+        "hit_rate": round(
+            (CACHE_STATS["hits"] + CACHE_STATS["stale_hits"] + CACHE_STATS["semantic_hits"])
+            / max(1, CACHE_STATS["hits"] + CACHE_STATS["stale_hits"] + CACHE_STATS["semantic_hits"]
+                  + CACHE_STATS["misses"]),
+            4,
+        ),
+        "revalidating": len(_REVALIDATIONS),
+        "semantic_entries": len(SEMANTIC_CACHE.vectors) if SEMANTIC_CACHE_ENABLED else 0,
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """Prometheus text exposition: stage latency histograms, polls per run, cache,
+    admission and rate-limit counters, and tokens/cost per model (per worker process)."""
+    return PlainTextResponse(_render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/admission/stats")
+async def admission_stats() -> Dict[str, Any]:
+    """Per-endpoint concurrency, queue depth and rejections, plus the OpenAI rate scheduler."""
+    return {
+        "degraded": _upstream_saturated(),
+        "budget_stage": SpendBudget.STAGES[BUDGET.stage()],
+        "breaker": BREAKER.stats(),
+        "resources": STATE.stats(),
+        "endpoints": {g.name: g.stats() for g in (ASK_GATE, STREAM_GATE, BATCH_GATE)},
+        "rate": RATE.stats(),
+    }
+
+
+@app.get("/usage")
+async def usage(days: int = 30, by: str = "day,model,endpoint") -> Dict[str, Any]:
+    """Ledger totals for the last `days` UTC days (today included), grouped by any of
+    day, model and endpoint, plus the budget's state."""
+    groups = [g.strip() for g in by.split(",") if g.strip()]
+    unknown = [g for g in groups if g not in ("day", "model", "endpoint")]
+    if unknown or len(set(groups)) != len(groups):
+        raise HTTPException(status_code=400, detail="by takes a comma-separated subset of day, model, endpoint.")
+    if days < 1:
+        raise HTTPException(status_code=400, detail="days must be at least 1.")
+    # This worker's latest answers first, so the report is current
+    await LEDGER.flush()
+    report = await asyncio.to_thread(LEDGER.report, _utc_day(time.time() - (days - 1) * 86400), groups)
+    return {**report, "budget": BUDGET.status(), "ledger": dict(LEDGER.counters)}
+
+
+@app.get("/search", response_model=SearchResponse)
+def search(q: str, k: int = 5) -> Any:
+    start_ts = time.perf_counter()
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Query must not be empty.")
+    k = max(1, min(k, 50))
+    index = _get_search_index()
+    results = []
+    for sec in index.search(q, k=k):
+        results.append({
+            "filename": sec["filename"],
+            "heading": sec["heading"],
+            "trail": sec["trail"],
+            "score": sec["score"],
+            "text": sec["text"],
+            "url": _doc_url(sec["filename"], sec["anchor"]),
+        })
+    elapsed = time.perf_counter() - start_ts
+    return {
+        "query": q,
+        "results": results,
+        "meta": {
+            "duration_ms": round(elapsed * 1000, 3),
+            "sections_indexed": len(index.sections),
+        },
+    }
+
+
 @app.post("/ask", response_model=AskResponse)
-def ask(data: AskRequest) -> Any:
-    state = _load_state()
-    if "assistant_id" not in state or "vector_store_id" not in state:
+async def ask(data: AskRequest) -> Any:
+    _ENDPOINT.set("ask")
+    mode = _resolve_mode(data.mode)
+    state = STATE.get()
+    if mode == "assistant" and ("assistant_id" not in state or "vector_store_id" not in state):
         raise HTTPException(status_code=400, detail="Setup not completed. Call /setup first.")
 
-    assistant_id: str = state["assistant_id"]
     start_ts = time.perf_counter()
+    _TIMINGS.set({} if (META_TIMINGS if data.timings is None else data.timings) else None)
     # Cache lookup to avoid re-paying for identical answers on same docs index and model
-    cache_key = _cache_key(data.question, MODEL, state["vector_store_id"])
-    cached = ANSWER_CACHE.get(cache_key)
+    scope = _fast_cache_scope() if mode == "fast" else state["vector_store_id"]
+    cache_key = _cache_key(data.question, MODEL, scope)
+    cached, cache_meta = _cache_lookup(cache_key)
     if cached is not None:
+        if cache_meta.get("stale"):
+            _schedule_revalidation(cache_key, data, state, mode)
         answer = cached["answer"]
         citations = cached["citations"]
-        elapsed = time.perf_counter() - start_ts
-        meta = {
-            "duration_seconds": round(elapsed, 4),
-            "duration_ms": int(elapsed * 1000),
-            "tokens": {"input": 0, "output": 0, "total": 0},
-            "cost_usd": 0.0,
-            "chunks": len(citations or []),
-            "shots": 0,
-            "model": MODEL,
-            "cached": True,
-        }
-        return {
+        meta = _build_meta(start_ts, citations, cached=True, mode=mode, **cache_meta)
+        resp = {
             "answer": answer,
             "citations": citations,
             "thread_id": data.thread_id or "cached",
             "run_id": "cached",
-            "assistant_id": assistant_id,
+            "assistant_id": state.get("assistant_id", ""),
             "meta": meta,
         }
+        _log_query("ask", data.question, mode, resp, cost_usd=cached.get("cost_usd"))
+        return resp
+
+    work = _answer_work(data, state, cache_key, start_ts, mode)
+    async with _admission(ASK_GATE, cache_key, data):
+        resp = await _answer_json(cache_key, data, start_ts, mode, work)
+    _log_query("ask", data.question, mode, resp)
+    return resp
+
+
+def _answer_work(data: AskRequest, state: Dict[str, Any], cache_key: str, start_ts: float,
+                 mode: str) -> Any:
+    # The coroutine factory that answers (and caches) one /ask question
+    if mode == "fast":
+        return lambda: _ask_fast_run(data, state, cache_key, start_ts)
+    if RUN_TRANSPORT == "stream":
+        return lambda: _ask_assistant_streamed(data, state, cache_key, start_ts)
+    return lambda: _ask_assistant_run(data, state, cache_key, start_ts)
+
+
+_REVALIDATIONS: Dict[str, "asyncio.Task[Any]"] = {}
 
-    # Validate vector store exists; if missing (404) recreate assistant + store
+
+def _schedule_revalidation(cache_key: str, data: AskRequest, state: Dict[str, Any], mode: str) -> None:
+    """Refresh a stale cache entry in the background, at most once at a time per key.
+
+    The refresh joins the single-flight group, so a cache miss for the same question
+    while it runs waits for it instead of starting another run.
+    """
+    if cache_key in _REVALIDATIONS or cache_key in IN_FLIGHT.flights:
+        return
+    if BUDGET.stage() >= 1 or BREAKER.is_open():
+        # Tight budget or OpenAI down: keep serving the stale answer for now
+        return
+    req = AskRequest(question=data.question, mode=mode)
+
+    async def _refresh() -> None:
+        _PRIORITY.set(RateScheduler.BACKGROUND)
+        _ENDPOINT.set("revalidate")
+        _TIMINGS.set(None)
+        start_ts = time.perf_counter()
+        try:
+            await _answer_json(cache_key, req, start_ts, mode,
+                               _answer_work(req, dict(state), cache_key, start_ts, mode))
+        except Exception:
+            pass
+        finally:
+            _REVALIDATIONS.pop(cache_key, None)
+
+    CACHE_STATS["revalidations"] += 1
+    _REVALIDATIONS[cache_key] = asyncio.get_running_loop().create_task(_refresh())
+
+
+async def _ask_assistant_streamed(data: AskRequest, state: Dict[str, Any], cache_key: str,
+                                  start_ts: float) -> Dict[str, Any]:
+    # Same run as /ask/stream, collected into one response: no polls at all
     try:
-        client.vector_stores.retrieve(vector_store_id=state["vector_store_id"])
-    except Exception:
-        new_state = _create_or_get_assistant_and_vector_store(recreate=True)
-        state = new_state
-        assistant_id = state["assistant_id"]
+        async for event, payload in _assistant_run_events(data, state, cache_key, start_ts):
+            if event == "error":
+                raise HTTPException(status_code=502, detail=f"{payload['message']}. Status: {payload['status']}")
+            if event == "result":
+                payload["meta"].update({"transport": "stream", "polls": 0})
+                return payload
+    except HTTPException:
+        raise
+    except (APIConnectionError, APIStatusError) as e:
+        raise HTTPException(status_code=502, detail=f"OpenAI API error: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    raise HTTPException(status_code=502, detail="Run stream ended without a result.")
+
+
+async def _ask_assistant_run(data: AskRequest, state: Dict[str, Any], cache_key: str,
+                             start_ts: float) -> Dict[str, Any]:
+    # Resources are validated in the background; while confirmed missing (404) they are rebuilt in
+    # the background and the question is answered from the local index
+    if STATE.rebuilding():
+        # Cached under the fast-mode key: it is not an assistant answer
+        fast_key = _cache_key(data.question, MODEL, _fast_cache_scope())
+        resp = await _ask_fast_run(data, state, fast_key, start_ts)
+        resp["meta"]["fallback"] = "rebuilding"
+        return resp
+    route = _assistant_route(data, state)
+    assistant_id: str = route["assistant_id"]
 
     try:
-        # Create or reuse a thread
-        if data.thread_id:
-            thread_id = data.thread_id
-        else:
-            thread = client.beta.threads.create()
-            thread_id = thread.id  # type: ignore[attr-defined]
+        # Create or reuse a thread (a reused one may roll over to a fresh thread)
+        thread_id, memory = await _open_thread(data, route)
 
         # Add the user question
-        client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=data.question,
-        )
+        with _stage("message_create"):
+            await _openai(
+                client.beta.threads.messages.create,
+                thread_id=thread_id,
+                role="user",
+                content=data.question,
+            )
 
         # Run the assistant
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=assistant_id,
-        )
+        visible, budget = RATE.estimate("run", ASSISTANT_INSTRUCTIONS + data.question)
+        with _stage("run_create"):
+            run = await _openai(
+                client.beta.threads.runs.create,
+                tokens=budget,
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                **memory["run"],
+            )
 
         # Poll until completion
-        result = _poll_run(thread_id=thread_id, run_id=run.id)  # type: ignore[attr-defined]
+        with _stage("poll"):
+            result = await _poll_run(thread_id=thread_id, run_id=run.id)  # type: ignore[attr-defined]
+        METRIC_RUN_POLLS.observe(result["polls"])
+        _record_run_phases(result.get("run"))
+        RATE.settle("run", visible, budget, getattr(result.get("run"), "usage", None))
         status = result["status"]
         if status != "completed":
             run_obj = result.get("run")
@@ -432,7 +4223,7 @@ def ask(data: AskRequest) -> Any:
             raise HTTPException(status_code=502, detail=f"Run did not complete. Status: {status}{err_msg}")
 
         # Extract answer and citations
-        parsed = _extract_answer_and_citations(thread_id=thread_id)
+        parsed = await _extract_answer_and_citations(thread_id=thread_id)
         answer = parsed["answer"]
         citations = parsed["citations"]
 
@@ -441,34 +4232,14 @@ def ask(data: AskRequest) -> Any:
             answer = "Not covered in our docs."
 
         # Metrics
-        elapsed = time.perf_counter() - start_ts
         run_obj = result["run"]
-        input_tokens = 0
-        output_tokens = 0
-        total_tokens = 0
-        try:
-            usage = getattr(run_obj, "usage", None)
-            if usage:
-                # Support different SDK field names
-                input_tokens = getattr(usage, "input_tokens", getattr(usage, "prompt_tokens", 0)) or 0
-                output_tokens = getattr(usage, "output_tokens", getattr(usage, "completion_tokens", 0)) or 0
-                total_tokens = getattr(usage, "total_tokens", (input_tokens + output_tokens)) or (input_tokens + output_tokens)
-        except Exception:
-            pass
-        cost_usd = round(input_tokens * INPUT_PRICE_PER_TOKEN + output_tokens * OUTPUT_PRICE_PER_TOKEN, 6)
-        meta = {
-            "duration_seconds": round(elapsed, 4),
-            "duration_ms": int(elapsed * 1000),
-            "tokens": {"input": input_tokens, "output": output_tokens, "total": total_tokens},
-            "cost_usd": cost_usd,
-            "chunks": len(citations or []),
-            "shots": 0,
-            "model": MODEL,
-            "cached": False,
-        }
+        meta = _build_meta(start_ts, citations, usage=getattr(run_obj, "usage", None), mode="assistant",
+                           transport="poll", polls=result["polls"], poll_hedges=result["hedges"],
+                           poll_wasted_ms=result["wasted_ms"], **route["meta"], **memory["meta"])
+        MEMORY.record(thread_id, data.question, answer)
         # Save to cache for future identical queries on same docs index and model
         try:
-            ANSWER_CACHE.set(cache_key, {"answer": answer, "citations": citations})
+            _cache_store(cache_key, {"answer": answer, "citations": citations, "cost_usd": meta["cost_usd"]})
         except Exception:
             pass
         return {
@@ -479,6 +4250,8 @@ def ask(data: AskRequest) -> Any:
             "assistant_id": assistant_id,
             "meta": meta,
         }
+    except HTTPException:
+        raise
     except (APIConnectionError, APIStatusError) as e:
         raise HTTPException(status_code=502, detail=f"OpenAI API error: {e}")
     except Exception as e:
@@ -495,136 +4268,376 @@ def _sse(event: str, data: Any) -> str:
 
 
 @app.post("/ask/stream")
-def ask_stream(data: AskRequest):
+async def ask_stream(data: AskRequest):
     """
     Server-Sent Events endpoint for streaming answers with zero extra token cost.
-    We still use the Assistants run under the hood; we stream the final result as SSE frames.
+    We still use the Assistants run under the hood, consumed as a run event stream so
+    text is forwarded as soon as the model produces it.
     Frames:
       - start: empty payload
-      - delta: { "text": "...partial or full text..." }
-      - done: { "meta": {...}, "citations": [...] }
+      - status: { "status": "queued" | "in_progress" | "searching_files" | "writing" }
+      - delta: { "text": "...partial text..." }
+      - done: { "meta": {...}, "citations": [...], "thread_id": "..." (uncached answers) }
       - error: { "status": "...", "message": "..." }
+    While the run is quiet a ": keep-alive" comment is sent every STREAM_KEEPALIVE_SECONDS.
+    A cache miss over the concurrency limit waits for a slot before the stream starts,
+    and gets a 503 with Retry-After if the queue is full or the wait times out.
+    In "fast" mode the deltas are the chat-completion tokens as they arrive.
+    Concurrent identical questions share one run: later callers replay its frames.
     """
-    state = _load_state()
-    if "assistant_id" not in state or "vector_store_id" not in state:
+    _ENDPOINT.set("ask/stream")
+    mode = _resolve_mode(data.mode)
+    state = STATE.get()
+    if mode == "assistant" and ("assistant_id" not in state or "vector_store_id" not in state):
         raise HTTPException(status_code=400, detail="Setup not completed. Call /setup first.")
 
-    assistant_id_state: str = state["assistant_id"]
-
-    def event_gen():
+    async def event_gen():
+        # Someone is watching this answer appear; it goes ahead of batch and background work
+        _PRIORITY.set(RateScheduler.INTERACTIVE)
+        _TIMINGS.set({} if (META_TIMINGS if data.timings is None else data.timings) else None)
         start_ts = time.perf_counter()
-        # Notify client stream started
-        yield _sse("start", {})
 
         # 1) Cache lookup (free, immediate)
-        cache_key = _cache_key(data.question, MODEL, state["vector_store_id"])
-        cached = ANSWER_CACHE.get(cache_key)
+        scope = _fast_cache_scope() if mode == "fast" else state["vector_store_id"]
+        cache_key = _cache_key(data.question, MODEL, scope)
+        cached, cache_meta = _cache_lookup(cache_key)
         if cached is not None:
+            if cache_meta.get("stale"):
+                _schedule_revalidation(cache_key, data, state, mode)
             answer = cached["answer"]
             citations = cached["citations"]
-            elapsed = time.perf_counter() - start_ts
-            meta = {
-                "duration_seconds": round(elapsed, 4),
-                "duration_ms": int(elapsed * 1000),
-                "tokens": {"input": 0, "output": 0, "total": 0},
-                "cost_usd": 0.0,
-                "chunks": len(citations or []),
-                "shots": 0,
-                "model": MODEL,
-                "cached": True,
-            }
+            meta = _build_meta(start_ts, citations, cached=True, mode=mode, **cache_meta)
+            _log_query("ask/stream", data.question, mode, {"answer": answer, "citations": citations, "meta": meta},
+                       cost_usd=cached.get("cost_usd"))
+            yield _sse("start", {})
             yield _sse("delta", {"text": answer})
             yield _sse("done", {"meta": meta, "citations": citations})
             return
 
-        # 2) Ensure vector store exists; recreate if missing
-        try:
-            client.vector_stores.retrieve(vector_store_id=state["vector_store_id"])
-            assistant_id_local = assistant_id_state
-        except Exception:
-            new_state = _create_or_get_assistant_and_vector_store(recreate=True)
-            state.update(new_state)
-            assistant_id_local = state["assistant_id"]
-
-        # 3) Thread create/reuse
-        if data.thread_id:
-            thread_id = data.thread_id
+        # 2) Answer (or join an identical in-flight answer) once admitted
+        if mode == "fast":
+            events = lambda: _fast_run_events(data, state, cache_key, start_ts)  # noqa: E731
         else:
-            thread = client.beta.threads.create()
-            thread_id = thread.id  # type: ignore[attr-defined]
+            events = lambda: _assistant_run_events(data, state, cache_key, start_ts)  # noqa: E731
+        async with _admission(STREAM_GATE, cache_key, data):
+            # Notify client stream started
+            yield _sse("start", {})
+            async for frame in _answer_sse(cache_key, data, start_ts, mode, events):
+                yield frame
+
+    return await _stream_after_admission(event_gen(), "text/event-stream")
+
+
+async def _assistant_run_events(data: AskRequest, state: Dict[str, Any], cache_key: str,
+                                start_ts: float) -> AsyncIterator[Tuple[str, Any]]:
+    # 1) Resources are validated in the background; while confirmed missing (404) they are rebuilt
+    # in the background and the question is answered from the local index
+    if STATE.rebuilding():
+        # Cached under the fast-mode key: it is not an assistant answer
+        fast_key = _cache_key(data.question, MODEL, _fast_cache_scope())
+        async for event, payload in _fast_run_events(data, state, fast_key, start_ts):
+            if event == "result":
+                payload["meta"]["fallback"] = "rebuilding"
+            yield event, payload
+        return
+    route = _assistant_route(data, state)
+    assistant_id_local = route["assistant_id"]
+
+    # 2) Thread create/reuse (a reused one may roll over to a fresh thread)
+    thread_id, memory = await _open_thread(data, route)
 
-        # 4) Add user question
-        client.beta.threads.messages.create(
+    # 3) Add user question
+    with _stage("message_create"):
+        await _openai(
+            client.beta.threads.messages.create,
             thread_id=thread_id,
             role="user",
             content=data.question,
         )
 
-        # 5) Run assistant (poll completion, then stream frames)
-        run = client.beta.threads.runs.create(
+    # 4) Run assistant on the event stream, forwarding text deltas as they arrive
+    visible, budget = RATE.estimate("run", ASSISTANT_INSTRUCTIONS + data.question)
+    with _stage("run_create"):
+        events = await _openai(
+            client.beta.threads.runs.create,
+            tokens=budget,
             thread_id=thread_id,
             assistant_id=assistant_id_local,
+            stream=True,
+            **memory["run"],
         )
+    stream_start = time.perf_counter()
 
-        result = _poll_run(thread_id=thread_id, run_id=run.id)  # type: ignore[attr-defined]
-        status = result["status"]
-        if status != "completed":
-            err_msg = ""
-            run_obj = result.get("run")
+    run_id = ""
+    run_created = time.perf_counter()
+    run_obj = None
+    status = "queued"
+    last_status = ""
+    parts: List[str] = []
+    file_ids: Set[str] = set()
+    try:
+        async for ev in _aiter_with_keepalive(events, STREAM_KEEPALIVE_SECONDS):
+            if ev is None:
+                if time.perf_counter() - start_ts > RUN_TIMEOUT_SECONDS:
+                    status = "expired"
+                    break
+                yield "keepalive", None
+                continue
+            name = getattr(ev, "event", "")
+            obj = getattr(ev, "data", None)
+            if name == "thread.run.created":
+                run_id = obj.id  # type: ignore[union-attr]
+                run_created = time.perf_counter()
+            elif name == "thread.message.delta":
+                for part in getattr(obj.delta, "content", None) or []:  # type: ignore[union-attr]
+                    if part.type != "text" or not part.text:
+                        continue
+                    file_ids |= _annotation_file_ids(part.text.annotations)
+                    if part.text.value:
+                        if not parts:
+                            _record_stage("first_token", time.perf_counter() - stream_start)
+                        parts.append(part.text.value)
+                        yield "delta", {"text": part.text.value}
+            elif name == "thread.message.completed":
+                for item in obj.content:  # type: ignore[union-attr]
+                    if item.type == "text":
+                        file_ids |= _annotation_file_ids(item.text.annotations)
+            elif name == "thread.run.requires_action":
+                # We are not using tools that require action; cancel such runs
+                run_obj, status = obj, "cancelled"
+                break
+            elif name in ("thread.run.completed", "thread.run.failed", "thread.run.cancelled",
+                          "thread.run.expired", "thread.run.incomplete"):
+                run_obj, status = obj, name.rsplit(".", 1)[1]
+                if status == "completed":
+                    # Streamed runs feed the same duration stats that time /ask polls
+                    RUN_STATS.add(time.perf_counter() - run_created)
+            elif name == "error":
+                yield "error", {"status": "failed", "message": str(getattr(obj, "message", obj))}
+                return
+
+            new_status = _stream_status(name, obj)
+            if new_status and new_status != last_status:
+                last_status = new_status
+                yield "status", {"status": new_status}
+    finally:
+        try:
+            await events.close()
+        except Exception:
+            pass
+
+    _record_stage("run_stream", time.perf_counter() - stream_start)
+    _record_run_phases(run_obj)
+    RATE.settle("run", visible, budget, getattr(run_obj, "usage", None))
+    if status != "completed":
+        if run_id:
             try:
-                last_err = getattr(run_obj, "last_error", None)
-                if last_err:
-                    err_msg = f", error: {getattr(last_err, 'message', str(last_err))}"
+                await _openai(client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run_id)
             except Exception:
                 pass
-            yield _sse("error", {"status": status, "message": f"Run did not complete{err_msg}"})
-            return
-
-        # 6) Extract answer and citations
-        parsed = _extract_answer_and_citations(thread_id=thread_id)
-        answer = (parsed["answer"] or "").strip()
-        citations = parsed["citations"]
-
-        if not answer:
-            answer = "Not covered in our docs."
-
-        # 7) Compute meta (same accounting as /ask)
-        run_obj = result["run"]
-        input_tokens = 0
-        output_tokens = 0
-        total_tokens = 0
+        err_msg = ""
         try:
-            usage = getattr(run_obj, "usage", None)
-            if usage:
-                input_tokens = getattr(usage, "input_tokens", getattr(usage, "prompt_tokens", 0)) or 0
-                output_tokens = getattr(usage, "output_tokens", getattr(usage, "completion_tokens", 0)) or 0
-                total_tokens = getattr(usage, "total_tokens", (input_tokens + output_tokens)) or (input_tokens + output_tokens)
+            last_err = getattr(run_obj, "last_error", None)
+            if last_err:
+                err_msg = f", error: {getattr(last_err, 'message', str(last_err))}"
         except Exception:
             pass
-        cost_usd = round(input_tokens * INPUT_PRICE_PER_TOKEN + output_tokens * OUTPUT_PRICE_PER_TOKEN, 6)
-        elapsed = time.perf_counter() - start_ts
-        meta = {
-            "duration_seconds": round(elapsed, 4),
-            "duration_ms": int(elapsed * 1000),
-            "tokens": {"input": input_tokens, "output": output_tokens, "total": total_tokens},
-            "cost_usd": cost_usd,
-            "chunks": len(citations or []),
-            "shots": 0,
-            "model": MODEL,
-            "cached": False,
+        yield "error", {"status": status, "message": f"Run did not complete{err_msg}"}
+        return
+
+    # 5) Answer and citations come from the stream; only file names need a lookup
+    answer = "".join(parts).strip()
+    citations = await _resolve_citations(file_ids, answer)
+
+    if not answer:
+        answer = "Not covered in our docs."
+        yield "delta", {"text": answer}
+
+    # 6) Compute meta (same accounting as /ask)
+    meta = _build_meta(start_ts, citations, usage=getattr(run_obj, "usage", None), mode="assistant",
+                       **route["meta"], **memory["meta"])
+    MEMORY.record(thread_id, data.question, answer)
+
+    # 7) Cache for next time
+    try:
+        _cache_store(cache_key, {"answer": answer, "citations": citations, "cost_usd": meta["cost_usd"]})
+    except Exception:
+        pass
+
+    yield "result", {
+        "answer": answer,
+        "citations": citations,
+        "thread_id": thread_id,
+        "run_id": run_id or getattr(run_obj, "id", ""),
+        "assistant_id": assistant_id_local,
+        "meta": meta,
+    }
+
+
+@app.post("/ask/batch")
+async def ask_batch(data: BatchAskRequest):
+    """
+    Answer a list of questions, streaming each result as soon as it is ready.
+    Questions are deduplicated by cache key; cache hits are sent first, then the misses
+    run concurrently (up to `concurrency`) and are sent in completion order. At most
+    BATCH_MAX_ACTIVE batches run at once; the next one waits briefly, then gets a 503.
+    Frames (NDJSON lines with a "type" field, or SSE events of that name):
+      - start: { "questions": n, "unique": u, "concurrency": c }
+      - item: { "index", "question", "status": "ok", "answer", "citations", "meta" }
+              or { "index", "question", "status": "error", "error": "..." }
+      - done: { "totals": {...} } with tokens and cost summed over the batch
+    """
+    _ENDPOINT.set("ask/batch")
+    mode = _resolve_mode(data.mode)
+    fmt = (data.format or "ndjson").strip().lower()
+    if fmt not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail=f"Unknown batch format: {fmt}. Use 'ndjson' or 'sse'.")
+    questions = data.questions
+    if not questions:
+        raise HTTPException(status_code=400, detail="No questions given.")
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch.")
+    state = STATE.get()
+    if mode == "assistant" and ("assistant_id" not in state or "vector_store_id" not in state):
+        raise HTTPException(status_code=400, detail="Setup not completed. Call /setup first.")
+    concurrency = max(1, min(data.concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+
+    scope = _fast_cache_scope() if mode == "fast" else state["vector_store_id"]
+    groups: "OrderedDict[str, List[int]]" = OrderedDict()
+    blank: List[int] = []
+    for i, q in enumerate(questions):
+        if not q.strip():
+            blank.append(i)
+            continue
+        groups.setdefault(_cache_key(q, MODEL, scope), []).append(i)
+
+    def frame(kind: str, payload: Dict[str, Any]) -> str:
+        if fmt == "sse":
+            return _sse(kind, payload)
+        return json.dumps({"type": kind, **payload}) + "\n"
+
+    async def event_gen():
+        start_ts = time.perf_counter()
+        totals: Dict[str, Any] = {
+            "questions": len(questions), "unique": len(groups), "cached": 0, "answered": 0,
+            "deduplicated": 0, "errors": 0,
+            "tokens": {"input": 0, "output": 0, "total": 0}, "cost_usd": 0.0,
         }
 
-        # 8) Cache for next time
+        def items(key: str, result: Optional[Dict[str, Any]], error: Optional[str]) -> List[str]:
+            idxs = groups[key]
+            out: List[str] = []
+            if result is None:
+                totals["errors"] += len(idxs)
+                for i in idxs:
+                    out.append(frame("item", {"index": i, "question": questions[i],
+                                              "status": "error", "error": error or "failed"}))
+                return out
+            meta = result["meta"]
+            totals["cached" if meta.get("cached") else "answered"] += 1
+            for part in ("input", "output", "total"):
+                totals["tokens"][part] += meta["tokens"][part]
+            totals["cost_usd"] += meta["cost_usd"]
+            for n, i in enumerate(idxs):
+                if n:
+                    # Repeats of a question in this batch share the first one's answer at no cost
+                    totals["deduplicated"] += 1
+                    meta = _build_meta(start_ts, result["citations"], cached=bool(result["meta"].get("cached")),
+                                       mode=mode, deduplicated=True, duplicate_of=idxs[0])
+                _log_query("ask/batch", questions[i], mode, dict(result, meta=meta),
+                           cost_usd=result.get("cost_usd") if n == 0 else None)
+                out.append(frame("item", {"index": i, "question": questions[i], "status": "ok",
+                                          "answer": result["answer"], "citations": result["citations"],
+                                          "meta": meta}))
+            return out
+
+        # Whole batches are admitted (or refused with a 503) before the first frame
+        await BATCH_GATE.acquire()
+        held_from = time.perf_counter()
         try:
-            ANSWER_CACHE.set(cache_key, {"answer": answer, "citations": citations})
-        except Exception:
-            pass
+            yield frame("start", {"questions": len(questions), "unique": len(groups), "concurrency": concurrency})
+            for i in blank:
+                totals["errors"] += 1
+                yield frame("item", {"index": i, "question": questions[i], "status": "error",
+                                     "error": "Question must not be empty."})
+
+            # 1) Cache hits, immediately
+            misses: List[str] = []
+            for key, idxs in groups.items():
+                cached, cache_meta = _cache_lookup(key)
+                if cached is None:
+                    misses.append(key)
+                    continue
+                if cache_meta.get("stale"):
+                    _schedule_revalidation(key, AskRequest(question=questions[idxs[0]]), state, mode)
+                result = {"answer": cached["answer"], "citations": cached["citations"],
+                          "meta": _build_meta(start_ts, cached["citations"], cached=True, mode=mode, **cache_meta),
+                          "cost_usd": cached.get("cost_usd")}
+                for f in items(key, result, None):
+                    yield f
+
+            # 2) Misses, at most `concurrency` at a time, reported as they finish
+            sem = asyncio.Semaphore(concurrency)
+
+            async def answer(key: str) -> Tuple[str, Optional[Dict[str, Any]], Optional[str]]:
+                _PRIORITY.set(RateScheduler.BACKGROUND)
+                async with sem:
+                    if BUDGET.stage() >= 3:
+                        return key, None, str(BUDGET.reject().detail)
+                    req = AskRequest(question=questions[groups[key][0]], mode=mode)
+                    item_ts = time.perf_counter()
+                    try:
+                        work = _answer_work(req, dict(state), key, item_ts, mode)
+                        return key, await _answer_json(key, req, item_ts, mode, work), None
+                    except HTTPException as e:
+                        return key, None, str(e.detail)
+                    except Exception as e:
+                        return key, None, str(e)
+
+            tasks = [asyncio.ensure_future(answer(k)) for k in misses]
+            try:
+                for fut in asyncio.as_completed(tasks):
+                    key, result, error = await fut
+                    for f in items(key, result, error):
+                        yield f
+            finally:
+                # Client went away: stop the runs that have not started or finished
+                for t in tasks:
+                    t.cancel()
+
+            totals["cost_usd"] = round(totals["cost_usd"], 6)
+            totals["duration_ms"] = int((time.perf_counter() - start_ts) * 1000)
+            yield frame("done", {"totals": totals})
+        finally:
+            BATCH_GATE.release(time.perf_counter() - held_from)
+
+    media_type = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return await _stream_after_admission(event_gen(), media_type)
+
+
+@app.get("/docs/stats")
+def docs_stats() -> Dict[str, Any]:
+    return DOCS.stats()
+
+
+@app.api_route("/docs/{name}", methods=["GET", "HEAD"])
+async def docs_file(name: str, request: Request) -> Response:
+    doc = await DOCS.get(name)
+    if doc is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    encoding = _accepted_encoding(request.headers.get("accept-encoding", ""), doc["bodies"])
+    headers = {
+        "ETag": f'"{doc["etag"]}"' if encoding == "identity" else f'"{doc["etag"]}-{encoding}"',
+        "Cache-Control": f"public, max-age={DOCS_CACHE_MAX_AGE_SECONDS}",
+        "Vary": "Accept-Encoding",
+    }
+    if _etag_matches(request.headers.get("if-none-match"), doc["etag"]):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(doc["bodies"][encoding], media_type=doc["media_type"], headers=headers)
 
-        # 9) Stream answer + done
-        yield _sse("delta", {"text": answer})
-        yield _sse("done", {"meta": meta, "citations": citations})
 
-    return StreamingResponse(event_gen(), media_type="text/event-stream")
 @app.get("/")
 def root() -> Dict[str, str]:
     return {
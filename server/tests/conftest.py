@@ -0,0 +1,112 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+# main.py reads its settings at import time: keep state, caches and the ledger in a temp dir
+_STATE_DIR = tempfile.mkdtemp(prefix="erp-tests-")
+os.environ["STATE_DIR"] = _STATE_DIR
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ["ANSWER_CACHE_BACKEND"] = "memory"
+os.environ["WARMUP_AFTER_SETUP"] = "false"
+# The local OpenAI stand-in, fast enough for unit tests
+os.environ.update({"FAKE_RUN_LATENCY_SECONDS": "0.05", "FAKE_RUN_JITTER_SECONDS": "0", "FAKE_RUN_QUEUE_SECONDS": "0.01",
+                   "FAKE_API_LATENCY_SECONDS": "0", "FAKE_STREAM_DELTAS": "5", "FAKE_ERROR_RATIO": "0"})
+for name in ("BUDGET_DAILY_USD", "BUDGET_MONTHLY_USD", "OPENAI_RPM_LIMIT", "OPENAI_TPM_LIMIT"):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import fake_openai  # noqa: E402
+import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def _reset_shared_state():
+    # Every test starts with empty answer caches; the budget and the breaker tune the shared
+    # answer cache, so put that back after each test
+    main.ANSWER_CACHE.clear()
+    main.SEMANTIC_CACHE.clear()
+    yield
+    main.ANSWER_CACHE.ttl_extension_s = 0
+    main.ANSWER_CACHE.outage_stale_s = 0
+
+
+class Clock:
+    """A settable clock for the answer caches."""
+
+    def __init__(self) -> None:
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    # Builds an answer cache on each backend, driven by a Clock
+    def make(max_entries=100, ttl=60, **kw):
+        if request.param == "memory":
+            cache = main.AnswerCache(max_entries, ttl, **kw)
+        else:
+            cache = main.SQLiteAnswerCache(tmp_path / "answers.sqlite3", max_entries, ttl, **kw)
+        cache.clock = Clock()
+        return cache
+    return make
+
+
+@pytest.fixture
+def api():
+    # Routes only; the lifespan (index load, warm-up, background tasks) is not started
+    from fastapi.testclient import TestClient
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def openai_fake(monkeypatch):
+    """Routes main's OpenAI client to server/fake_openai.py in-process; returns the fake module."""
+    for store in (fake_openai.CALLS, fake_openai.FILES, fake_openai.STORES, fake_openai.STORE_FILES,
+                  fake_openai.ASSISTANTS, fake_openai.THREADS, fake_openai.RUNS, fake_openai.BATCHES):
+        store.clear()
+    fake_openai.OUTAGE["error_ratio"] = 0.0
+    transport = httpx.ASGITransport(app=fake_openai.app)
+    fake = AsyncOpenAI(api_key="test", base_url="http://fake-openai/v1", max_retries=0,
+                       http_client=httpx.AsyncClient(transport=transport, base_url="http://fake-openai/v1"))
+    monkeypatch.setattr(main, "client", fake)
+    monkeypatch.setattr(main, "BREAKER", main.CircuitBreaker(False, 30, 10, 0.5, 5, 15, 0))
+    return fake_openai
+
+
+@pytest.fixture
+def assistant_ready(api, openai_fake):
+    # /setup against the fake: uploads help_docs and creates the vector store and the assistant
+    resp = api.post("/setup", json={})
+    assert resp.status_code == 200, resp.text
+    return resp.json()
+
+
+def sse_frames(text: str):
+    """(event, data) pairs of an SSE body; data is parsed JSON."""
+    import json
+    frames = []
+    for block in text.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line and not line.startswith(":"))
+        if "event" in lines:
+            frames.append((lines["event"], json.loads(lines.get("data", "null"))))
+    return frames
+
+
+@pytest.fixture
+def docs_dir(tmp_path, monkeypatch):
+    """A writable copy of three guides standing in for help_docs."""
+    import shutil
+    path = tmp_path / "help_docs"
+    path.mkdir()
+    for src in sorted(main.HELP_DOCS_DIR.glob("*.md"))[:3]:
+        shutil.copy(src, path / src.name)
+    monkeypatch.setattr(main, "HELP_DOCS_DIR", path)
+    return path
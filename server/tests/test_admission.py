@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def test_admits_up_to_the_limit_then_queues():
+    async def run():
+        gate = main.AdmissionGate("test", 2, 5, 1.0)
+        await gate.acquire()
+        await gate.acquire()
+        waiter = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done() and len(gate.waiters) == 1
+        gate.release(0.1)
+        await waiter
+        return gate
+
+    gate = asyncio.run(run())
+    assert gate.active == 2
+    assert gate.counters["admitted"] == 3 and gate.counters["queued"] == 1
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def run():
+        gate = main.AdmissionGate("test", 1, 1, 1.0)
+        await gate.acquire()
+        waiter = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as exc:
+            await gate.acquire()
+        waiter.cancel()
+        return exc.value, gate
+
+    error, gate = asyncio.run(run())
+    assert error.status_code == 503
+    assert int(error.headers["Retry-After"]) >= 1
+    assert gate.counters["rejected_full"] == 1
+
+
+def test_queue_wait_times_out():
+    async def run():
+        gate = main.AdmissionGate("test", 1, 5, 0.01)
+        await gate.acquire()
+        with pytest.raises(HTTPException) as exc:
+            await gate.acquire()
+        return exc.value, gate
+
+    error, gate = asyncio.run(run())
+    assert error.status_code == 503
+    assert gate.counters["rejected_timeout"] == 1
+    assert gate.active == 1 and not gate.waiters
+
+
+def test_slot_handed_to_a_cancelled_waiter_is_passed_on():
+    # release() resolves the waiter's future, then the waiter is cancelled before it runs
+    async def run():
+        gate = main.AdmissionGate("test", 1, 5, 5.0)
+        await gate.acquire()
+        cancelled = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        nxt = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        gate.release(0.1)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await asyncio.wait_for(nxt, 1.0)
+        gate.release(0.1)
+        return gate
+
+    gate = asyncio.run(run())
+    assert gate.active == 0 and not gate.waiters
+
+
+def test_cancelled_waiter_without_a_slot_leaves_the_queue():
+    async def run():
+        gate = main.AdmissionGate("test", 1, 5, 5.0)
+        await gate.acquire()
+        waiter = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        gate.release(0.1)
+        return gate
+
+    gate = asyncio.run(run())
+    assert gate.active == 0 and not gate.waiters
+
+
+def test_unlimited_gate_never_queues():
+    async def run():
+        gate = main.AdmissionGate("test", 0, 0, 1.0)
+        for _ in range(10):
+            await gate.acquire()
+        return gate
+
+    assert asyncio.run(run()).counters["queued"] == 0
+
+
+def test_admission_stats_leave_the_rate_buckets_alone(api, monkeypatch):
+    rate = main.RateScheduler(60, 6000)
+    rate.requests = 0.0
+    monkeypatch.setattr(main, "RATE", rate)
+    body = api.get("/admission/stats").json()
+    assert set(body["endpoints"]) == {"ask", "ask_stream", "ask_batch"}
+    assert body["budget_stage"] == main.SpendBudget.STAGES[0]
+    assert body["rate"]["rpm_limit"] == 60
+    assert rate.requests == 0.0
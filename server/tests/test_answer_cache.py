@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+
+import pytest
+
+import main
+
+
+def _answer(text: str = "answer", cost: float = 0.001):
+    return {"answer": text, "citations": [], "cost_usd": cost}
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        main.AnswerCacheBackend(10, 60)
+
+
+def test_set_and_lookup(make_cache):
+    cache = make_cache()
+    cache.set("k", _answer())
+    assert cache.lookup("k") == (_answer(), False)
+    assert cache.get("missing") is None
+    assert cache.size()[0] == 1
+
+
+def test_entries_expire_after_ttl(make_cache):
+    cache = make_cache(ttl=60)
+    cache.set("k", _answer())
+    cache.clock.now += 61
+    assert cache.lookup("k") == (None, False)
+    assert cache.counters["expired"] == 1
+
+
+def test_items_delete_and_clear(make_cache):
+    cache = make_cache()
+    cache.set("a", _answer("a"))
+    cache.set("b", _answer("b"))
+    assert sorted(k for k, _ in cache.items()) == ["a", "b"]
+    cache.delete("a")
+    assert cache.keys() == ["b"]
+    cache.clear()
+    assert cache.size() == (0, 0)
+
+
+def test_size_tracks_updates_and_deletes(make_cache):
+    cache = make_cache()
+    cache.set("a", _answer("short"))
+    cache.set("b", _answer("b"))
+    cache.set("a", _answer("a much longer answer than before"))
+    cache.delete("b")
+    _, size, _ = main.AnswerCacheBackend._entry_size_cost(_answer("a much longer answer than before"))
+    assert cache.size() == (1, size)
+
+
+def test_refused_update_keeps_the_cached_answer(make_cache):
+    cache = make_cache(max_bytes=200)
+    cache.set("k", _answer("fits"))
+    cache.set("k", _answer("x" * 500))
+    assert cache.get("k") == _answer("fits")
+    assert cache.counters["rejected"] == 1
+
+
+def test_sqlite_cache_is_shared_between_instances(tmp_path):
+    first = main.SQLiteAnswerCache(tmp_path / "shared.sqlite3", 10, 60)
+    second = main.SQLiteAnswerCache(tmp_path / "shared.sqlite3", 10, 60)
+    first.set("k", _answer())
+    assert second.get("k") == _answer()
+    assert second.warm() == 1
+
+
+def test_concurrent_writers_stay_within_the_bound(tmp_path):
+    path = tmp_path / "shared.sqlite3"
+    main.SQLiteAnswerCache(path, 20, 60, policy="lru")
+
+    def writer(n: int) -> None:
+        # One instance per "worker", each with its own connection
+        cache = main.SQLiteAnswerCache(path, 20, 60, policy="lru")
+        for i in range(100):
+            cache.set(f"w{n}-{i}", _answer(f"{n}-{i}"))
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    conn = sqlite3.connect(str(path))
+    count, nbytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+    assert count == 20
+    assert conn.execute("SELECT entries, bytes FROM answers_meta").fetchone() == (count, nbytes)
+
+
+def test_totals_are_seeded_for_an_existing_table(tmp_path):
+    path = tmp_path / "old.sqlite3"
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE answers (key TEXT PRIMARY KEY, value TEXT NOT NULL, ts REAL NOT NULL,"
+                 " atime REAL NOT NULL)")
+    conn.execute("INSERT INTO answers VALUES ('k', '{\"answer\": \"a\"}', 1, 1)")
+    conn.commit()
+    conn.close()
+    cache = main.SQLiteAnswerCache(path, 10, 10 ** 10)
+    assert cache.size() == (1, len('{"answer": "a"}'))
@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import main
+
+
+def _frames(text: str):
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def test_batch_deduplicates_and_streams_ndjson(api, assistant_ready, openai_fake):
+    questions = ["How do I post an invoice?", "  how do I post an INVOICE?", "What is a BOM?", " "]
+    resp = api.post("/ask/batch", json={"questions": questions})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    frames = _frames(resp.text)
+    assert frames[0] == {"type": "start", "questions": 4, "unique": 2, "concurrency": main.BATCH_CONCURRENCY}
+    assert frames[-1]["type"] == "done"
+    items = {f["index"]: f for f in frames if f["type"] == "item"}
+    assert sorted(items) == [0, 1, 2, 3]
+    assert items[3]["status"] == "error"
+    assert items[0]["answer"] == items[1]["answer"]
+    assert items[1]["meta"]["deduplicated"] is True and items[1]["meta"]["duplicate_of"] == 0
+    totals = frames[-1]["totals"]
+    assert (totals["unique"], totals["answered"], totals["deduplicated"], totals["errors"]) == (2, 2, 1, 1)
+    assert openai_fake.CALLS["threads.runs.create"] + openai_fake.CALLS["threads.create_and_run"] == 2
+
+
+def test_batch_serves_cache_hits_first(api, assistant_ready):
+    api.post("/ask", json={"question": "What is a BOM?"})
+    frames = _frames(api.post("/ask/batch", json={"questions": ["How do I post an invoice?", "What is a BOM?"]}).text)
+    items = [f for f in frames if f["type"] == "item"]
+    assert items[0]["index"] == 1 and items[0]["meta"]["cached"] is True
+    assert frames[-1]["totals"]["cached"] == 1
+
+
+def test_batch_runs_at_most_concurrency_misses_at_once(api, assistant_ready, monkeypatch):
+    active, peak = [0], [0]
+    answer_work = main._answer_work
+
+    def tracked(*args, **kw):
+        work = answer_work(*args, **kw)
+
+        async def run():
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            try:
+                await asyncio.sleep(0.02)
+                return await work()
+            finally:
+                active[0] -= 1
+        return run
+
+    monkeypatch.setattr(main, "_answer_work", tracked)
+    questions = [f"Question number {i}?" for i in range(6)]
+    frames = _frames(api.post("/ask/batch", json={"questions": questions, "concurrency": 2}).text)
+    assert frames[0]["concurrency"] == 2
+    assert frames[-1]["totals"]["answered"] == 6
+    assert peak[0] == 2
+
+
+def test_batch_sse_format_and_validation(api, assistant_ready):
+    resp = api.post("/ask/batch", json={"questions": ["What is a BOM?"], "format": "sse"})
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    assert "event: start" in resp.text and "event: done" in resp.text
+    assert api.post("/ask/batch", json={"questions": []}).status_code == 400
+    assert api.post("/ask/batch", json={"questions": ["x"], "format": "xml"}).status_code == 400
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return main.UsageLedger(tmp_path / "usage.sqlite3")
+
+
+def _spend(ledger: main.UsageLedger, usd: float) -> None:
+    ledger.record("ask", "gpt-4o-mini", "answered", 1000, 200, usd)
+
+
+def test_ledger_counts_outcomes_and_spend(ledger):
+    _spend(ledger, 0.25)
+    ledger.record("ask", "gpt-4o-mini", "cache", 0, 0, 0.0)
+    ledger.record("ask/stream", "gpt-4o-mini", "semantic", 0, 0, 0.0)
+    assert ledger.spent() == (pytest.approx(0.25), pytest.approx(0.25))
+    ask = ledger.pending[(main._utc_day(), "gpt-4o-mini", "ask")]
+    assert (ask["requests"], ask["hits"], ask["misses"]) == (2, 1, 1)
+
+
+def test_flush_persists_for_every_worker(ledger, tmp_path):
+    _spend(ledger, 0.1)
+    _spend(ledger, 0.2)
+    asyncio.run(ledger.flush())
+    assert not ledger.pending
+    other = main.UsageLedger(tmp_path / "usage.sqlite3")
+    asyncio.run(other.flush())
+    assert other.spent()[0] == pytest.approx(0.3)
+    report = other.report(main._utc_day(), ["endpoint"])
+    assert report["rows"][0]["endpoint"] == "ask"
+    assert report["rows"][0]["requests"] == 2
+    assert report["rows"][0]["tokens"] == 2400
+
+
+@pytest.mark.parametrize("spent, stage", [(0.0, 0), (0.5, 0), (0.75, 1), (0.95, 2), (1.0, 3)])
+def test_stage_follows_the_share_spent(ledger, spent, stage):
+    budget = main.SpendBudget(ledger, daily_usd=1.0, monthly_usd=0.0)
+    if spent:
+        _spend(ledger, spent)
+    assert budget.stage() == stage
+    assert budget.status()["stage"] == main.SpendBudget.STAGES[stage]
+
+
+def test_the_tighter_cap_wins(ledger):
+    budget = main.SpendBudget(ledger, daily_usd=100.0, monthly_usd=1.0)
+    _spend(ledger, 1.5)
+    assert budget.stage() == 3
+
+
+def test_tight_budget_keeps_answers_longer(ledger):
+    budget = main.SpendBudget(ledger, daily_usd=1.0, monthly_usd=0.0)
+    _spend(ledger, 0.8)
+    budget.stage()
+    assert main.ANSWER_CACHE.ttl_extension_s == main.ANSWER_CACHE.ttl * (main.BUDGET_TTL_MULTIPLIER - 1)
+
+
+def test_spent_budget_rejects_with_retry_after(ledger):
+    budget = main.SpendBudget(ledger, daily_usd=1.0, monthly_usd=0.0)
+    _spend(ledger, 1.0)
+    error = budget.reject()
+    assert isinstance(error, HTTPException) and error.status_code == 429
+    assert 1 <= int(error.headers["Retry-After"]) <= 86400
+    assert budget.counters["rejected"] == 1
+
+
+def test_no_caps_means_no_budget(ledger):
+    budget = main.SpendBudget(ledger, daily_usd=0.0, monthly_usd=0.0)
+    _spend(ledger, 1000.0)
+    assert budget.stage() == 0
+
+
+def test_ttl_extension_keeps_entries_fresh(make_cache):
+    cache = make_cache(ttl=60)
+    cache.set("k", {"answer": "a", "citations": []})
+    cache.ttl_extension_s = 60
+    cache.clock.now += 90
+    assert cache.lookup("k") == ({"answer": "a", "citations": []}, False)
+    cache.ttl_extension_s = 0
+    assert cache.lookup("k") == (None, False)
@@ -0,0 +1,53 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def cache(make_cache, monkeypatch):
+    backend = make_cache()
+    monkeypatch.setattr(main, "ANSWER_CACHE", backend)
+    return backend
+
+
+def _state(store, **hashes):
+    return {"vector_store_id": store,
+            "files": [{"filename": f"{name}.md", "sha256": sha} for name, sha in hashes.items()]}
+
+
+def _answer(**sources):
+    return {"answer": "x", "citations": [], "sources": {f"{name}.md": sha for name, sha in sources.items()}}
+
+
+def test_only_answers_citing_edited_docs_are_evicted(cache):
+    cache.set(main._cache_key("about a", "m", "vs_1"), _answer(a="1"))
+    cache.set(main._cache_key("about b", "m", "vs_1"), _answer(b="1"))
+    cache.set(main._cache_key("legacy", "m", "vs_1"), {"answer": "x", "citations": []})
+
+    stats = main._invalidate_answer_cache(_state("vs_1", a="1", b="1"), _state("vs_1", a="2", b="1"))
+    assert stats == {"kept": 1, "evicted": 2, "moved": 0}
+    assert cache.keys() == [main._cache_key("about b", "m", "vs_1")]
+
+
+def test_a_rebuild_moves_answers_without_restarting_their_ttl(cache):
+    old_key = main._cache_key("about a", "m", "vs_1")
+    cache.set(old_key, _answer(a="1"))
+    cache.clock.now += 50
+
+    stats = main._invalidate_answer_cache(_state("vs_1", a="1"), _state("vs_2", a="1"))
+    new_key = main._cache_key("about a", "m", "vs_2")
+    assert stats == {"kept": 0, "evicted": 0, "moved": 1}
+    assert cache.keys() == [new_key]
+    assert cache.size()[1] > 0
+    cache.clock.now += 11
+    assert cache.get(new_key) is None
+
+
+def test_rename_keeps_an_answer_already_at_the_target(cache):
+    cache.set("old", {"answer": "old"})
+    cache.set("new", {"answer": "new"})
+    assert cache.rename("old", "new") is False
+    assert cache.rename("missing", "other") is False
+    assert cache.keys() == ["new"]
+    assert cache.get("new") == {"answer": "new"}
+    assert cache.size()[0] == 1
@@ -0,0 +1,84 @@
+import pytest
+
+import main
+
+
+def _answer(text: str = "answer", cost: float = 0.001):
+    return {"answer": text, "citations": [], "cost_usd": cost}
+
+
+def test_popular_entries_are_served_stale(make_cache):
+    cache = make_cache(ttl=60, stale_seconds=30, stale_min_hits=2)
+    cache.set("hot", _answer())
+    cache.set("cold", _answer())
+    cache.lookup("hot")
+    cache.lookup("hot")
+    cache.clock.now += 70
+    assert cache.lookup("hot") == (_answer(), True)
+    assert cache.get("hot") is None
+    assert cache.lookup("cold") == (None, False)
+    cache.clock.now += 30
+    assert cache.lookup("hot") == (None, False)
+
+
+def test_entry_count_bound_evicts_least_recently_used(make_cache):
+    cache = make_cache(max_entries=3, policy="lru")
+    for i in range(5):
+        cache.set(f"k{i}", _answer())
+        cache.clock.now += 2
+    assert cache.size()[0] == 3
+    assert cache.get("k0") is None and cache.get("k1") is None
+    assert cache.get("k4") is not None
+
+
+def test_byte_bound_is_kept(make_cache):
+    cache = make_cache(max_bytes=400, policy="lru")
+    for i in range(5):
+        cache.set(f"k{i}", _answer("x" * 100))
+        cache.clock.now += 2
+    entries, nbytes = cache.size()
+    assert 0 < nbytes <= 400
+    assert entries < 5 and cache.get("k4") is not None
+
+
+def test_oversized_answer_is_rejected(make_cache):
+    cache = make_cache(max_bytes=200)
+    cache.set("big", _answer("x" * 500))
+    assert cache.get("big") is None
+    assert cache.counters["rejected"] == 1
+
+
+def test_cost_policy_evicts_cheap_answers_first(make_cache):
+    cache = make_cache(max_entries=2, policy="cost")
+    cache.set("expensive", _answer(cost=0.05))
+    cache.clock.now += 2
+    cache.set("cheap", _answer(cost=0.0))
+    cache.clock.now += 2
+    cache.set("new", _answer(cost=0.01))
+    assert cache.get("expensive") is not None
+    assert cache.get("cheap") is None
+    assert cache.get("new") is not None
+
+
+def test_low_value_answer_is_not_admitted_over_a_hot_one(make_cache):
+    cache = make_cache(max_entries=1, policy="cost")
+    cache.set("hot", _answer(cost=0.05))
+    for _ in range(5):
+        cache.lookup("hot")
+    cache.set("once", _answer(cost=0.0))
+    assert cache.get("hot") is not None
+    assert cache.get("once") is None
+    assert cache.counters["rejected"] == 1
+
+
+def test_unknown_policy_is_refused():
+    with pytest.raises(RuntimeError):
+        main.AnswerCache(10, 60, policy="fifo")
+
+
+def test_cache_stats_reports_bounds_and_counters(api):
+    main.ANSWER_CACHE.set("k", _answer())
+    body = api.get("/cache/stats").json()
+    assert body["backend"] == "memory"
+    assert body["entries"] == 1 and body["bytes"] > 0
+    assert {"max_entries", "max_bytes", "sets", "evicted", "rejected", "hit_rate"} <= set(body)
@@ -0,0 +1,141 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from openai import APIConnectionError, APIStatusError
+
+import main
+
+
+def _breaker(**kw) -> main.CircuitBreaker:
+    settings = dict(enabled=True, window_s=30, min_calls=10, error_ratio=0.5, consecutive=3, open_s=0.05,
+                    stale_s=3600)
+    settings.update(kw)
+    return main.CircuitBreaker(**settings)
+
+
+def _status_error(status: int) -> APIStatusError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/threads")
+    return APIStatusError("error", response=httpx.Response(status, request=request), body=None)
+
+
+def test_opens_after_consecutive_failures():
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.allow()
+        breaker.record(True)
+    assert breaker.is_open()
+    assert main.ANSWER_CACHE.outage_stale_s == 3600
+    with pytest.raises(main.CircuitOpenError) as exc:
+        breaker.allow()
+    assert exc.value.status_code == 503
+    assert int(exc.value.headers["Retry-After"]) >= 1
+
+
+def test_opens_on_error_ratio_over_the_window():
+    breaker = _breaker(consecutive=100)
+    for i in range(10):
+        breaker.record(i % 2 == 0)
+    assert breaker.state == "open"
+    assert breaker.counters["opened"] == 1
+
+
+def test_stays_closed_below_min_calls():
+    breaker = _breaker(consecutive=100)
+    for _ in range(5):
+        breaker.record(True)
+    assert breaker.state == "closed"
+
+
+def test_one_probe_after_cool_down_closes_it():
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.record(True)
+    time.sleep(0.06)
+    breaker.allow()
+    assert breaker.state == "half_open"
+    with pytest.raises(main.CircuitOpenError):
+        breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "closed"
+    assert main.ANSWER_CACHE.outage_stale_s == 0
+    breaker.allow()
+
+
+def test_failed_probe_reopens_and_cancelled_probe_frees_the_slot():
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.record(True)
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.record(None)
+    breaker.allow()
+    breaker.record(True)
+    assert breaker.is_open()
+    assert breaker.counters["opened"] == 2
+
+
+def test_disabled_breaker_never_opens():
+    breaker = _breaker(enabled=False)
+    for _ in range(20):
+        breaker.record(True)
+    breaker.allow()
+    assert breaker.state == "closed"
+
+
+def test_retry_classification():
+    connect = APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/threads"))
+    connect.__cause__ = httpx.ConnectError("refused")
+    timeout = APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/threads"))
+    assert main._retryable(_status_error(429), idempotent=False)
+    assert main._retryable(connect, idempotent=False)
+    # The server may have acted on a create that timed out or failed with a 5xx
+    assert not main._retryable(timeout, idempotent=False)
+    assert not main._retryable(_status_error(500), idempotent=False)
+    assert main._retryable(_status_error(500), idempotent=True)
+    assert not main._retryable(_status_error(400), idempotent=True)
+    assert main._upstream_failure(_status_error(503))
+    assert not main._upstream_failure(_status_error(429))
+
+
+def test_openai_does_not_repeat_a_failed_create(monkeypatch):
+    monkeypatch.setattr(main, "BREAKER", _breaker())
+    calls = []
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        raise _status_error(500)
+
+    with pytest.raises(APIStatusError):
+        asyncio.run(main._openai(create, thread_id="thread_1"))
+    assert len(calls) == 1
+
+
+def test_openai_retries_an_idempotent_read(monkeypatch):
+    monkeypatch.setattr(main, "BREAKER", _breaker())
+    monkeypatch.setattr(main, "OPENAI_RETRY_MAX_SECONDS", 0.01)
+    calls = []
+
+    async def retrieve(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise _status_error(503)
+        return "ok"
+
+    assert asyncio.run(main._openai(retrieve, thread_id="thread_1")) == "ok"
+    assert len(calls) == 2
+
+
+def test_expired_answers_are_served_stale_while_open(make_cache, monkeypatch):
+    cache = make_cache(ttl=60)
+    monkeypatch.setattr(main, "ANSWER_CACHE", cache)
+    cache.set("k", {"answer": "a", "citations": []})
+    cache.clock.now += 120
+    breaker = _breaker()
+    for _ in range(3):
+        breaker.allow()
+        breaker.record(True)
+    assert cache.lookup("k") == ({"answer": "a", "citations": []}, True)
+    breaker._close()
+    assert cache.lookup("k") == (None, False)
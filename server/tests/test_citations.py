@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import NotFoundError
+
+import main
+
+
+@pytest.fixture
+def files(monkeypatch):
+    calls = []
+    running = {"now": 0, "peak": 0}
+
+    async def retrieve(file_id):
+        calls.append(file_id)
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        await asyncio.sleep(0.005)
+        running["now"] -= 1
+        if file_id.startswith("file-gone"):
+            request = httpx.Request("GET", f"https://api.openai.com/v1/files/{file_id}")
+            raise NotFoundError("not found", response=httpx.Response(404, request=request), body=None)
+        return SimpleNamespace(filename=f"{file_id}.md")
+
+    async def listing(**kwargs):
+        raise AssertionError("citations must not list every file in the organization")
+
+    monkeypatch.setattr(main, "client", SimpleNamespace(files=SimpleNamespace(retrieve=retrieve, list=listing)))
+    monkeypatch.setattr(main, "_FILE_NAMES", main.OrderedDict())
+    return calls, running
+
+
+def test_unknown_ids_are_retrieved_a_few_at_a_time(files):
+    calls, running = files
+    ids = {f"file-{i}" for i in range(10)}
+    citations = asyncio.run(main._resolve_citations(ids))
+    assert sorted(calls) == sorted(ids)
+    assert running["peak"] <= main.CITATION_LOOKUP_CONCURRENCY
+    assert {c["filename"] for c in citations} == {f"{fid}.md" for fid in ids}
+
+
+def test_known_and_missing_ids_are_not_looked_up_again(files):
+    calls, _ = files
+    main._remember_file_names([{"file_id": "file-known", "filename": "Known Guide.md"}])
+    asyncio.run(main._resolve_citations({"file-known", "file-gone-1"}))
+    assert calls == ["file-gone-1"]
+    citations = asyncio.run(main._resolve_citations({"file-known", "file-gone-1"}))
+    assert calls == ["file-gone-1"]
+    assert {c["filename"] for c in citations} == {"Known Guide.md", "file-gone-1"}
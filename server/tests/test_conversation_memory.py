@@ -0,0 +1,79 @@
+import main
+
+
+def _memory_with(turns, answer_chars=400):
+    memory = main.ConversationMemory(10)
+    for i in range(turns):
+        memory.record("t1", f"question {i}", "a" * answer_chars)
+    return memory
+
+
+def test_window_keeps_the_turns_that_fit(monkeypatch):
+    monkeypatch.setattr(main, "CONVERSATION_POLICY", "window")
+    monkeypatch.setattr(main, "CONVERSATION_WINDOW_TOKENS", 250)
+    # ~104 tokens a turn: two fit in the window
+    plan = _memory_with(5).plan("t1")
+    assert plan["rollover"] is False
+    assert plan["meta"]["context_turns"] == 2
+    assert plan["run"] == {"truncation_strategy": {"type": "last_messages", "last_messages": 5}}
+
+
+def test_window_always_keeps_the_last_turn(monkeypatch):
+    monkeypatch.setattr(main, "CONVERSATION_WINDOW_TOKENS", 10)
+    assert _memory_with(3).plan("t1")["meta"]["context_turns"] == 1
+
+
+def test_turns_policy_keeps_the_last_n(monkeypatch):
+    monkeypatch.setattr(main, "CONVERSATION_POLICY", "turns")
+    monkeypatch.setattr(main, "CONVERSATION_MAX_TURNS", 3)
+    plan = _memory_with(5).plan("t1")
+    assert plan["meta"]["context_turns"] == 3
+    assert plan["run"]["truncation_strategy"]["last_messages"] == 7
+
+
+def test_long_history_rolls_over_with_a_clipped_carry_over(monkeypatch):
+    monkeypatch.setattr(main, "CONVERSATION_ROLLOVER_TOKENS", 300)
+    monkeypatch.setattr(main, "CONVERSATION_CARRYOVER_TURNS", 2)
+    monkeypatch.setattr(main, "CONVERSATION_CARRYOVER_TOKENS", 50)
+    memory = _memory_with(4)
+    plan = memory.plan("t1")
+    assert plan["rollover"] is True and plan["run"] == {}
+    assert [m["role"] for m in plan["carry"]] == ["user", "assistant", "user", "assistant"]
+    assert plan["carry"][0]["content"] == "question 2"
+    assert all(len(m["content"]) <= 100 for m in plan["carry"])
+    assert plan["meta"]["previous_thread_id"] == "t1"
+
+    memory.rollover("t1", "t2", plan["meta"]["context_turns"])
+    assert not memory.known("t1")
+    assert [t["question"] for t in memory.threads["t2"]] == ["question 2", "question 3"]
+
+
+def test_history_is_loaded_from_thread_messages():
+    memory = main.ConversationMemory(10)
+    memory.load("t1", [("user", "q1"), ("assistant", "a1"), ("user", "q2"), ("user", "q3"), ("assistant", "a3")])
+    assert [(t["question"], t["answer"]) for t in memory.threads["t1"]] == [("q1", "a1"), ("q2", ""), ("q3", "a3")]
+
+
+def test_the_least_recently_used_threads_are_forgotten():
+    memory = main.ConversationMemory(2)
+    for thread_id in ("t1", "t2", "t1", "t3"):
+        memory.record(thread_id, "q", "a")
+    assert list(memory.threads) == ["t1", "t3"]
+
+
+def test_a_follow_up_reports_its_context(api, assistant_ready):
+    first = api.post("/ask", json={"question": "How do I post an invoice?"}).json()
+    assert first["meta"]["context_turns"] == 0
+    follow_up = api.post("/ask", json={"question": "And how do I void it?", "thread_id": first["thread_id"]}).json()
+    assert follow_up["thread_id"] == first["thread_id"]
+    assert follow_up["meta"]["context_turns"] == 1 and follow_up["meta"]["context_tokens"] > 0
+
+
+def test_an_unknown_thread_is_read_back_once(api, assistant_ready, openai_fake):
+    first = api.post("/ask", json={"question": "How do I post an invoice?"}).json()
+    main.MEMORY.threads.clear()
+    lists = openai_fake.CALLS["threads.messages.list"]
+    follow_up = api.post("/ask", json={"question": "And how do I void it?", "thread_id": first["thread_id"]}).json()
+    assert follow_up["meta"]["context_turns"] == 1
+    # One read to load the history, one for the new answer
+    assert openai_fake.CALLS["threads.messages.list"] == lists + 2
@@ -0,0 +1,73 @@
+from urllib.parse import quote
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def docs(docs_dir, monkeypatch):
+    store = main.DocsStore()
+    monkeypatch.setattr(main, "DOCS", store)
+    guide = docs_dir / "Guide - Testing.md"
+    guide.write_text("# How to test\n\nRun **pytest**.\n\n## Steps\n\n- one\n- two\n\n## Steps\n\n```\ncode <here>\n```\n"
+                     + "Filler paragraph for compression.\n" * 50, encoding="utf-8")
+    return guide
+
+
+def _url(name: str) -> str:
+    return "/docs/" + quote(name)
+
+
+def test_markdown_and_html_are_served(api, docs):
+    md = api.get(_url(docs.name), headers={"Accept-Encoding": "identity"})
+    assert md.status_code == 200
+    assert md.headers["content-type"] == "text/markdown; charset=utf-8"
+    assert md.text == docs.read_text(encoding="utf-8")
+    assert "max-age" in md.headers["cache-control"] and md.headers["vary"] == "Accept-Encoding"
+
+    page = api.get(_url("Guide - Testing.html")).text
+    assert '<h1 id="how-to-test">' in page
+    assert '<h2 id="steps">' in page and '<h2 id="steps-1">' in page
+    assert "<strong>pytest</strong>" in page and "<ul><li>" in page
+    assert "code &lt;here&gt;" in page
+    assert api.get(_url("missing.html")).status_code == 404
+
+
+def test_gzip_when_accepted(api, docs):
+    resp = api.get(_url(docs.name), headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.headers["etag"].endswith('-gzip"')
+    # httpx decodes the body
+    assert resp.text == docs.read_text(encoding="utf-8")
+    refused = api.get(_url(docs.name), headers={"Accept-Encoding": "gzip;q=0"})
+    assert "content-encoding" not in refused.headers
+
+
+def test_etag_revalidation_and_head(api, docs):
+    first = api.get(_url(docs.name), headers={"Accept-Encoding": "identity"})
+    etag = first.headers["etag"]
+    again = api.get(_url(docs.name), headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.content == b""
+    # Any encoding of the same content matches
+    gz_etag = etag[:-1] + '-gzip"'
+    assert api.get(_url(docs.name), headers={"If-None-Match": f"W/{gz_etag}"}).status_code == 304
+
+    head = api.head(_url(docs.name), headers={"Accept-Encoding": "identity"})
+    assert head.status_code == 200 and head.content == b""
+    assert head.headers["etag"] == etag
+
+
+def test_edited_guides_are_picked_up(api, docs, monkeypatch):
+    monkeypatch.setattr(main, "DOCS_RECHECK_SECONDS", 0.001)
+    etag = api.get(_url(docs.name)).headers["etag"]
+    docs.write_text("# Rewritten\n", encoding="utf-8")
+    main.DOCS.checked_at = 0.0
+    resp = api.get(_url(docs.name), headers={"Accept-Encoding": "identity"})
+    assert resp.text == "# Rewritten\n" and resp.headers["etag"] != etag
+
+
+def test_citation_urls_point_at_the_rendered_section():
+    assert main._doc_url("Guide - Testing.md", "steps-1") == "/docs/Guide - Testing.html#steps-1"
+    assert main._doc_url("file_123") == "/docs/file_123"
+    assert main._slugify("How to: create a BOM?") == "how-to-create-a-bom"
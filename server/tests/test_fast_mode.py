@@ -0,0 +1,54 @@
+import main
+
+
+def test_context_stays_within_the_token_budget(monkeypatch):
+    monkeypatch.setattr(main, "FAST_CONTEXT_TOKEN_BUDGET", 300)
+    context, sections = main._build_fast_context("How do I create a purchase order?")
+    assert sections
+    assert main._estimate_tokens(context) <= 300 + 10
+    assert context.startswith("[1] ")
+
+
+def test_citations_follow_the_numbered_excerpts():
+    sections = [
+        {"filename": "Guide.md", "heading": "Create", "anchor": "create"},
+        {"filename": "Guide.md", "heading": "Close", "anchor": "close"},
+    ]
+    cited = main._fast_citations("Open it [2], then save [2].", sections)
+    assert [c["section"] for c in cited] == ["Close"]
+    assert cited[0]["url"] == "/docs/Guide.html#close"
+    assert main._fast_citations("Open it.", sections)[0]["section"] == "Create"
+    assert main._fast_citations("Not covered in our docs.", sections) == []
+
+
+def test_fast_answer_is_one_chat_call_and_then_cached(api, openai_fake):
+    body = {"question": "How do I create a purchase order?", "mode": "fast"}
+    first = api.post("/ask", json=body)
+    assert first.status_code == 200
+    data = first.json()
+    assert data["answer"].startswith("Fake answer for: How do I create a purchase order?")
+    assert data["meta"]["mode"] == "fast"
+    assert data["citations"] and data["citations"][0]["url"].startswith("/docs/")
+    assert dict(openai_fake.CALLS) == {"chat.completions.create": 1}
+
+    again = api.post("/ask", json=body).json()
+    assert again["answer"] == data["answer"]
+    assert again["meta"]["cached"] is True
+    assert openai_fake.CALLS["chat.completions.create"] == 1
+
+
+def test_unexpected_failure_is_a_clean_error(api, monkeypatch):
+    async def broken(question):
+        raise ValueError("index exploded")
+        yield
+
+    monkeypatch.setattr(main, "_fast_answer_events", broken)
+    resp = api.post("/ask", json={"question": "How do I post an invoice?", "mode": "fast"})
+    assert resp.status_code == 500
+    assert resp.json()["detail"] == "index exploded"
+    stream = api.post("/ask/stream", json={"question": "How do I void an invoice?", "mode": "fast"})
+    assert stream.text.rstrip().endswith('data: {"status": "error", "message": "index exploded"}')
+
+
+def test_unknown_mode_is_refused(api):
+    assert api.post("/ask", json={"question": "x", "mode": "turbo"}).status_code == 400
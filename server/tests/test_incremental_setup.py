@@ -0,0 +1,37 @@
+def test_unchanged_docs_upload_nothing(api, openai_fake, docs_dir):
+    first = api.post("/setup", json={}).json()
+    assert first["files_indexed"] == 3
+    uploads = openai_fake.CALLS["files.create"]
+
+    again = api.post("/setup", json={"incremental": True}).json()
+    assert again["vector_store_id"] == first["vector_store_id"]
+    assert again["changes"]["unchanged"] == sorted(p.name for p in docs_dir.glob("*.md"))
+    assert again["changes"]["added"] == again["changes"]["changed"] == again["changes"]["removed"] == []
+    assert openai_fake.CALLS["files.create"] == uploads
+
+
+def test_only_edited_added_and_removed_guides_are_synced(api, openai_fake, docs_dir):
+    api.post("/setup", json={})
+    guides = sorted(docs_dir.glob("*.md"))
+    uploads = openai_fake.CALLS["files.create"]
+    guides[0].write_text(guides[0].read_text(encoding="utf-8") + "\n\nOne more step.\n", encoding="utf-8")
+    guides[1].unlink()
+    (docs_dir / "New Guide.md").write_text("# New guide\n\nHello.\n", encoding="utf-8")
+
+    resp = api.post("/setup", json={"incremental": True}).json()
+    assert resp["changes"]["changed"] == [guides[0].name]
+    assert resp["changes"]["removed"] == [guides[1].name]
+    assert resp["changes"]["added"] == ["New Guide.md"]
+    assert resp["changes"]["unchanged"] == [guides[2].name]
+    assert openai_fake.CALLS["files.create"] == uploads + 2
+    assert sorted(f["filename"] for f in resp["files"]) == sorted(["New Guide.md", guides[0].name, guides[2].name])
+
+
+def test_a_missing_store_falls_back_to_a_full_build(api, openai_fake, docs_dir):
+    first = api.post("/setup", json={}).json()
+    openai_fake.STORES.clear()
+    guide = sorted(docs_dir.glob("*.md"))[0]
+    guide.write_text(guide.read_text(encoding="utf-8") + "\n\nEdited.\n", encoding="utf-8")
+    resp = api.post("/setup", json={"incremental": True})
+    assert resp.status_code == 200
+    assert resp.json()["vector_store_id"] != first["vector_store_id"]
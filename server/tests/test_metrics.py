@@ -0,0 +1,49 @@
+import main
+
+
+def _sample(text: str, series: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"{series} not in /metrics")
+
+
+def test_metrics_exposition_format(api):
+    resp = api.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = resp.text
+    for name, kind in (("erp_stage_duration_seconds", "histogram"), ("erp_cache_entries", "gauge"),
+                       ("erp_admission_rejections_total", "counter"), ("erp_budget_stage", "gauge")):
+        assert f"# TYPE {name} {kind}" in text
+    assert text.endswith("\n")
+
+
+def test_answers_feed_the_stage_histograms(api, assistant_ready):
+    before = api.get("/metrics").text
+    api.post("/ask", json={"question": "How do I post an invoice?"})
+    after = api.get("/metrics").text
+    series = 'erp_stage_duration_seconds_count{stage="run_create"}'
+    assert _sample(after, series) == (_sample(before, series) if series in before else 0) + 1
+    assert _sample(after, 'erp_cache_lookups_total{result="misses"}') >= 1
+    assert 'erp_answer_duration_seconds_bucket{mode="assistant"' in after
+
+
+def test_timings_are_added_on_request(api, assistant_ready):
+    plain = api.post("/ask", json={"question": "How do I post an invoice?"}).json()
+    assert "timings" not in plain["meta"]
+    timed = api.post("/ask", json={"question": "What is a BOM?", "timings": True}).json()
+    timings = timed["meta"]["timings"]
+    assert {"cache_lookup", "run_create", "poll", "message_list"} <= set(timings)
+    assert all(ms >= 0 for ms in timings.values())
+
+
+def test_histogram_buckets_are_cumulative():
+    metric = main._Metric("t_seconds", "test", "histogram", ("stage",), (0.1, 1.0))
+    for seconds in (0.05, 0.5, 5.0):
+        metric.observe(seconds, stage="x")
+    lines = metric.render()
+    assert 't_seconds_bucket{stage="x",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{stage="x",le="1.0"} 2' in lines
+    assert 't_seconds_bucket{stage="x",le="+Inf"} 3' in lines
+    assert 't_seconds_count{stage="x"} 3' in lines
@@ -0,0 +1,104 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import APIStatusError
+
+import main
+
+
+def test_schedule_follows_observed_run_durations():
+    stats = main.RunDurationStats(window=100, min_samples=10)
+    for i in range(9):
+        stats.add(float(i))
+    assert stats.schedule() == []
+    for i in range(9, 100):
+        stats.add(float(i))
+    assert stats.schedule() == [10.0, 25.0, 50.0, 75.0, 90.0, 95.0]
+
+
+def _bad_request() -> APIStatusError:
+    request = httpx.Request("GET", "https://api.openai.com/v1/threads/t/runs/r")
+    return APIStatusError("bad", response=httpx.Response(400, request=request), body=None)
+
+
+@pytest.fixture
+def retrieves(monkeypatch):
+    """Scripted runs.retrieve: each call pops (delay_s, outcome) and records how it ended."""
+    script, ended = [], []
+
+    async def retrieve(thread_id, run_id):
+        delay, outcome = script.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            ended.append("cancelled")
+            raise
+        ended.append("done")
+        if isinstance(outcome, Exception):
+            raise outcome
+        return SimpleNamespace(status=outcome)
+
+    runs = SimpleNamespace(retrieve=retrieve)
+    monkeypatch.setattr(main, "client", SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs))))
+    monkeypatch.setattr(main, "BREAKER", main.CircuitBreaker(False, 30, 10, 0.5, 5, 15, 0))
+    monkeypatch.setattr(main, "POLL_HEDGE_AFTER_SECONDS", 0.02)
+    return script, ended
+
+
+def test_fast_retrieve_is_not_hedged(retrieves):
+    script, ended = retrieves
+    script.append((0.0, "completed"))
+    run, hedged = asyncio.run(main._hedged_retrieve("t", "r"))
+    assert (run.status, hedged) == ("completed", False)
+
+
+def test_slow_retrieve_is_raced_and_the_loser_cancelled(retrieves):
+    script, ended = retrieves
+    script.extend([(1.0, "in_progress"), (0.0, "completed")])
+    run, hedged = asyncio.run(main._hedged_retrieve("t", "r"))
+    assert (run.status, hedged) == ("completed", True)
+    assert ended == ["done", "cancelled"]
+
+
+def test_hedge_wins_when_the_first_retrieve_fails(retrieves):
+    script, ended = retrieves
+    script.extend([(0.03, _bad_request()), (0.05, "completed")])
+    run, hedged = asyncio.run(main._hedged_retrieve("t", "r"))
+    assert (run.status, hedged) == ("completed", True)
+
+
+def test_both_failing_raises(retrieves):
+    script, _ = retrieves
+    script.extend([(0.03, _bad_request()), (0.04, _bad_request())])
+    with pytest.raises(APIStatusError):
+        asyncio.run(main._hedged_retrieve("t", "r"))
+
+
+def test_cancelled_caller_leaves_no_retrieves_behind(retrieves):
+    script, ended = retrieves
+    script.extend([(1.0, "in_progress"), (1.0, "in_progress")])
+
+    async def run():
+        caller = asyncio.ensure_future(main._hedged_retrieve("t", "r"))
+        await asyncio.sleep(0.05)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0.01)
+        return list(ended)
+
+    assert asyncio.run(run()) == ["cancelled", "cancelled"]
+
+
+def test_poll_run_against_the_stand_in(openai_fake):
+    async def run():
+        thread = await main.client.beta.threads.create()
+        created = await main.client.beta.threads.runs.create(thread_id=thread.id, assistant_id="asst_x")
+        return await main._poll_run(thread.id, created.id, timeout_s=5)
+
+    result = asyncio.run(run())
+    assert result["status"] == "completed"
+    assert result["polls"] >= 1
+    assert result["wasted_ms"] >= 0
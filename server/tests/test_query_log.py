@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import cache_replay
+import main
+
+
+def test_answers_are_buffered_then_flushed(api, assistant_ready, tmp_path, monkeypatch):
+    path = tmp_path / "query_log.ndjson"
+    monkeypatch.setattr(main, "QUERY_LOG_PATH", str(path))
+    monkeypatch.setattr(main, "QUERY_LOG", main.QueryLog(str(path)))
+    api.post("/ask", json={"question": "How do I post an invoice?"})
+    api.post("/ask", json={"question": "how do I post an invoice?"})
+    assert not path.exists() and len(main.QUERY_LOG.pending) == 2
+
+    asyncio.run(main.QUERY_LOG.flush())
+    first, second = [json.loads(line) for line in path.read_text().splitlines()]
+    assert (first["endpoint"], first["cached"], second["cached"]) == ("ask", False, True)
+    assert second["cache_tier"] == "exact" and first["bytes"] > 0
+    assert main.QUERY_LOG.counters["lines"] == 2
+
+
+def test_a_failed_flush_keeps_the_lines(tmp_path):
+    log = main.QueryLog(str(tmp_path / "missing" / "log.ndjson"))
+    log.record({"question": "a"})
+
+    async def run():
+        await log.flush()
+        log.record({"question": "b"})
+        (tmp_path / "missing").mkdir()
+        await log.flush()
+
+    asyncio.run(run())
+    assert log.counters["errors"] == 1
+    lines = (tmp_path / "missing" / "log.ndjson").read_text().splitlines()
+    assert [json.loads(line)["question"] for line in lines] == ["a", "b"]
+
+
+def test_the_buffer_is_bounded(monkeypatch):
+    monkeypatch.setattr(main.QueryLog, "MAX_PENDING", 3)
+    log = main.QueryLog("unused")
+    for i in range(5):
+        log.record({"question": str(i)})
+    assert [json.loads(line)["question"] for line in log.pending] == ["2", "3", "4"]
+    assert log.counters["dropped"] == 2
+
+
+def test_logging_never_fails_a_request(monkeypatch):
+    monkeypatch.setattr(main, "QUERY_LOG_PATH", "log.ndjson")
+    main._log_query("ask", "q", "assistant", {"answer": object()})
+
+
+def test_replay_counts_hits_and_savings(tmp_path):
+    path = tmp_path / "log.ndjson"
+    rows = [
+        {"ts": 0, "question": "How do I post an invoice?", "mode": "assistant", "cost_usd": 0.01, "bytes": 800},
+        {"ts": 60, "question": "how do i post an invoice?", "mode": "assistant", "cached": True, "cost_usd": 0.0},
+        {"ts": 120, "question": "What is a BOM?", "mode": "assistant", "cost_usd": 0.02, "bytes": 900},
+        {"ts": 7200, "question": "What is a BOM?", "mode": "assistant", "cached": True},
+    ]
+    path.write_text("\n".join(json.dumps(r) for r in rows) + "\nnot json\n")
+    events = cache_replay.load_log([str(path)])
+    assert len(events) == 4
+    per_key, summary = cache_replay.measure(events, 0.0005, 1500)
+    assert summary["measured_costs"] == 2
+
+    short = cache_replay.simulate(events, per_key, 100, 3600, "cost", 0, 0, 2)
+    assert (short["hits"], short["misses"]) == (1, 3)
+    assert short["saved_usd"] == 0.01
+    long = cache_replay.simulate(events, per_key, 100, 86400, "cost", 0, 0, 2)
+    assert (long["hits"], long["misses"]) == (2, 2)
+    assert long["cost_usd"] == 0.03 and long["uncached_cost_usd"] == 0.06
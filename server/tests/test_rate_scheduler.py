@@ -0,0 +1,108 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def _drained(rpm: int, tpm: int) -> main.RateScheduler:
+    rate = main.RateScheduler(rpm, tpm)
+    rate.requests = 0.0
+    rate.updated = time.monotonic()
+    return rate
+
+
+def test_unlimited_scheduler_does_not_wait():
+    async def run():
+        rate = main.RateScheduler(0, 0)
+        await rate.acquire(10_000)
+        return rate
+
+    assert asyncio.run(run()).counters["waits"] == 0
+
+
+def test_takes_a_request_and_its_tokens():
+    async def run():
+        rate = main.RateScheduler(60, 1000)
+        await rate.acquire(400)
+        return rate
+
+    rate = asyncio.run(run())
+    assert rate.requests == pytest.approx(59, abs=0.1)
+    assert rate.tokens == pytest.approx(600, abs=5)
+
+
+def test_waiters_are_served_by_priority():
+    order = []
+
+    async def caller(name: str, priority: int, rate: main.RateScheduler):
+        main._PRIORITY.set(priority)
+        await rate.acquire(0)
+        order.append(name)
+
+    async def run():
+        # One request every 10 ms
+        rate = _drained(6000, 0)
+        await asyncio.gather(
+            caller("batch", main.RateScheduler.BACKGROUND, rate),
+            caller("ask", main.RateScheduler.NORMAL, rate),
+            caller("stream", main.RateScheduler.INTERACTIVE, rate),
+        )
+
+    asyncio.run(run())
+    assert order == ["stream", "ask", "batch"]
+
+
+def test_grant_to_a_cancelled_waiter_is_refunded():
+    async def run():
+        rate = main.RateScheduler(60, 1000)
+        rate.requests = 0.0
+        rate.updated = time.monotonic()
+        waiter = asyncio.ensure_future(rate.acquire(400))
+        await asyncio.sleep(0)
+        # The bucket refills and _pump grants the waiter, which is cancelled before it runs
+        rate.requests = 1.0
+        rate._pump()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return rate
+
+    rate = asyncio.run(run())
+    assert rate.requests == pytest.approx(1.0, abs=0.05)
+    assert rate.tokens == pytest.approx(1000, abs=5)
+
+
+def test_settle_charges_the_difference():
+    rate = main.RateScheduler(60, 10_000)
+    rate.tokens = 5000.0
+    rate.updated = time.monotonic()
+    usage = SimpleNamespace(prompt_tokens=1500, completion_tokens=500, total_tokens=2000)
+    rate.settle("chat", visible=1000, estimated=1500, usage=usage)
+    assert rate.tokens == pytest.approx(4500, abs=5)
+    assert rate.overhead["chat"] == pytest.approx(0.8 * 500 + 0.2 * 1000)
+
+
+def test_pause_holds_every_caller():
+    async def run():
+        rate = main.RateScheduler(6000, 0)
+        rate.pause(0.05)
+        start = time.monotonic()
+        await rate.acquire(0)
+        return time.monotonic() - start, rate
+
+    waited, rate = asyncio.run(run())
+    assert waited >= 0.04
+    assert rate.counters["throttled"] == 1
+
+
+def test_stats_report_the_refill_without_applying_it():
+    rate = main.RateScheduler(60, 6000)
+    rate.requests, rate.tokens = 0.0, 0.0
+    rate.updated = time.monotonic() - 30
+    stats = rate.stats()
+    assert stats["requests_available"] == pytest.approx(30, abs=0.5)
+    assert stats["tokens_available"] == pytest.approx(3000, abs=50)
+    assert (rate.requests, rate.tokens) == (0.0, 0.0)
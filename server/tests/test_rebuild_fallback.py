@@ -0,0 +1,29 @@
+import asyncio
+
+import main
+
+
+def test_fallback_answers_are_cached_under_the_fast_key(monkeypatch):
+    seen = []
+
+    async def fast_run_events(data, state, cache_key, start_ts):
+        seen.append(cache_key)
+        yield "result", {"answer": "from the local index", "citations": [], "meta": {}}
+
+    monkeypatch.setattr(main.STATE, "rebuilding", lambda: True)
+    monkeypatch.setattr(main, "_fast_run_events", fast_run_events)
+    monkeypatch.setattr(main, "_fast_cache_scope", lambda: "local-test")
+    data = main.AskRequest(question="How do I post an invoice?")
+    assistant_key = main._cache_key(data.question, main.MODEL, "vs_1")
+
+    resp = asyncio.run(main._ask_assistant_run(data, {"vector_store_id": "vs_1"}, assistant_key, 0.0))
+    events = asyncio.run(_collect(main._assistant_run_events(data, {"vector_store_id": "vs_1"}, assistant_key, 0.0)))
+
+    fast_key = main._cache_key(data.question, main.MODEL, "local-test")
+    assert seen == [fast_key, fast_key]
+    assert resp["meta"]["fallback"] == "rebuilding"
+    assert events[-1][1]["meta"]["fallback"] == "rebuilding"
+
+
+async def _collect(gen):
+    return [e async for e in gen]
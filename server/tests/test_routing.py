@@ -0,0 +1,72 @@
+import main
+
+
+class FakeIndex:
+    def __init__(self, hits):
+        self.hits = hits
+
+    def search(self, question, k=5):
+        return [{"filename": f"Cetec Guides - {module}.md", "score": score} for module, score in self.hits]
+
+
+def _route_with(monkeypatch, hits):
+    monkeypatch.setattr(main, "_get_search_index", lambda rebuild=False: FakeIndex(hits))
+    return main._route_modules("anything")
+
+
+def test_module_groups_and_names(monkeypatch):
+    groups = main._parse_module_groups("Finance=AP, AR;Make=Production;broken")
+    assert groups == {"ap": "Finance", "ar": "Finance", "production": "Make"}
+    monkeypatch.setattr(main, "_MODULE_GROUPS", groups)
+    assert main._module_name("Cetec Guides - AR.md") == "Finance"
+    assert main._module_name("Cetec Guides - Sales.md") == "Sales"
+
+
+def test_a_dominant_module_is_picked(monkeypatch):
+    assert _route_with(monkeypatch, [("AP", 10.0), ("AP", 6.0), ("AR", 4.0)]) == (["AP"], 0.8)
+
+
+def test_two_close_modules_are_both_searched(monkeypatch):
+    modules, share = _route_with(monkeypatch, [("AP", 8.0), ("AR", 7.0), ("Sales", 3.0), ("Quality", 2.0)])
+    assert modules == ["AP", "AR"] and share == 0.75
+
+
+def test_unsure_or_weak_matches_use_the_combined_store(monkeypatch):
+    assert _route_with(monkeypatch, [("AP", 3.0), ("AR", 3.0), ("Sales", 3.0)])[0] == []
+    assert _route_with(monkeypatch, [("AP", 2.0)]) == ([], 1.0)
+    assert _route_with(monkeypatch, []) == ([], 0.0)
+
+
+def _state():
+    return {"assistant_id": "asst_all", "vector_store_id": "vs_all",
+            "modules": {"AP": {"assistant_id": "asst_ap", "vector_store_id": "vs_ap"},
+                        "AR": {"assistant_id": "asst_ar", "vector_store_id": "vs_ar"}}}
+
+
+def test_a_routed_question_runs_on_its_module_assistant(monkeypatch):
+    monkeypatch.setattr(main, "_route_modules", lambda q: (["AP", "AR"], 0.9))
+    route = main._assistant_route(main.AskRequest(question="q"), _state())
+    assert route["assistant_id"] == "asst_ap"
+    assert route["meta"] == {"stores": ["vs_ap", "vs_ar"], "modules": ["AP", "AR"], "route_confidence": 0.9}
+    assert route["thread"] == {"tool_resources": {"file_search": {"vector_store_ids": ["vs_ar"]}}}
+
+
+def test_follow_ups_and_missing_modules_use_the_combined_store(monkeypatch):
+    monkeypatch.setattr(main, "_route_modules", lambda q: (["AP"], 0.9))
+    follow_up = main._assistant_route(main.AskRequest(question="q", thread_id="thread_1"), _state())
+    assert follow_up["assistant_id"] == "asst_all" and follow_up["meta"]["modules"] == []
+    monkeypatch.setattr(main.STATE, "missing_modules", {"AP"})
+    missing = main._assistant_route(main.AskRequest(question="q"), _state())
+    assert missing["assistant_id"] == "asst_all" and missing["meta"]["stores"] == ["vs_all"]
+
+
+def test_setup_builds_a_store_per_module(api, openai_fake, docs_dir):
+    resp = api.post("/setup", json={"modules": True}).json()
+    names = sorted(main._module_name(p.name) for p in docs_dir.glob("*.md"))
+    assert sorted(resp["modules"]) == names
+    state = main.STATE.get()
+    assert sorted(state["modules"]) == names
+    assert all(m["vector_store_id"] in openai_fake.STORES for m in state["modules"].values())
+
+    api.post("/setup", json={"modules": False})
+    assert "modules" not in main.STATE.get()
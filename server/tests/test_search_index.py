@@ -0,0 +1,69 @@
+import main
+
+GUIDE = """Intro text before any heading.
+
+# How to create a BOM
+
+Open Engineering and choose New BOM.
+
+## For revisions
+
+Revise an existing BOM by copying it to a new revision.
+
+# How to close a work order
+
+Work orders are closed from the Production screen.
+
+## For revisions
+
+Closed work orders keep their revision history.
+"""
+
+
+def _index(tmp_path):
+    path = tmp_path / "Guide.md"
+    path.write_text(GUIDE, encoding="utf-8")
+    return main.SearchIndex.build([path])
+
+
+def test_sections_follow_headings(tmp_path):
+    index = _index(tmp_path)
+    assert [s["heading"] for s in index.sections] == [
+        "", "How to create a BOM", "For revisions", "How to close a work order", "For revisions",
+    ]
+    assert index.sections[2]["trail"] == ["How to create a BOM", "For revisions"]
+    # Repeated headings get GitHub-style anchors
+    assert [s["anchor"] for s in index.sections[2:]] == [
+        "for-revisions", "how-to-close-a-work-order", "for-revisions-1",
+    ]
+
+
+def test_search_ranks_by_bm25_with_the_heading_trail(tmp_path):
+    index = _index(tmp_path)
+    hits = index.search("revise a BOM", k=2)
+    assert hits[0]["anchor"] == "for-revisions"
+    assert hits[0]["score"] >= hits[1]["score"]
+    assert index.search("close work order", k=1)[0]["anchor"] == "how-to-close-a-work-order"
+    assert index.search("payroll") == []
+
+
+def test_search_can_be_limited_to_files(tmp_path):
+    index = _index(tmp_path)
+    assert index.search("BOM", filenames={"Other.md"}) == []
+    assert index.search("BOM", filenames={"Guide.md"})
+
+
+def test_index_round_trips_through_json(tmp_path):
+    index = _index(tmp_path)
+    loaded = main.SearchIndex.from_dict(index.to_dict())
+    assert loaded.search("revise a BOM", k=3) == index.search("revise a BOM", k=3)
+
+
+def test_search_endpoint(api):
+    resp = api.get("/search", params={"q": "create a purchase order", "k": 3})
+    assert resp.status_code == 200
+    body = resp.json()
+    assert 1 <= len(body["results"]) <= 3
+    assert body["results"][0]["url"].startswith("/docs/")
+    assert body["meta"]["sections_indexed"] > 0
+    assert api.get("/search", params={"q": "  "}).status_code == 400
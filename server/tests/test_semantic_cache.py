@@ -0,0 +1,74 @@
+import pytest
+
+import main
+
+
+def _key(question: str, model: str = "gpt-4o-mini", store: str = "vs_1") -> str:
+    return main._cache_key(question, model, store)
+
+
+@pytest.fixture
+def semantic():
+    cache = main.SemanticCache(0.9, 1000)
+    for q in (
+        "How do I create a purchase order?",
+        "How do I move inventory from WIP to stock?",
+        "create a sales order from a PO",
+        "How do I import BOMs?",
+        "Where is report 1099 configured?",
+        "How do I reconcile a bank account?",
+    ):
+        cache.add(_key(q))
+    return cache
+
+
+def test_rephrasings_match(semantic):
+    match = semantic.nearest(_key("how to create a purchase order"))
+    assert match is not None
+    key, similarity = match
+    assert key == _key("How do I create a purchase order?")
+    assert similarity >= 0.9
+
+
+def test_plurals_share_a_stem(semantic):
+    assert main._stem("boms") == main._stem("bom")
+    assert main._stem("invoices") == main._stem("invoice")
+    assert main._stem("ordering") == main._stem("ordered") == main._stem("orders")
+    assert semantic.nearest(_key("how do I import a BOM")) is not None
+
+
+@pytest.mark.parametrize("question", [
+    "How do I move inventory from stock to WIP?",
+    "create a PO from a sales order",
+])
+def test_reversed_procedures_do_not_match(semantic, question):
+    # Same words, opposite direction: even the budget's lower threshold must not reuse the answer
+    assert semantic.nearest(_key(question)) is None
+    assert semantic.nearest(_key(question), threshold=0.5) is None
+
+
+def test_different_numbers_do_not_match(semantic):
+    assert semantic.nearest(_key("Where is report 1098 configured?"), threshold=0.5) is None
+
+
+def test_unrelated_question_misses(semantic):
+    assert semantic.nearest(_key("How do I print shipping labels?")) is None
+
+
+def test_lookups_stay_within_model_and_store(semantic):
+    question = "how to create a purchase order"
+    assert semantic.nearest(_key(question, store="vs_2")) is None
+    assert semantic.nearest(_key(question, model="gpt-4o")) is None
+
+
+def test_remove_and_capacity():
+    cache = main.SemanticCache(0.9, 2)
+    cache.add(_key("How do I create a purchase order?"))
+    cache.add(_key("How do I close a work order?"))
+    cache.add(_key("How do I void an invoice?"))
+    assert len(cache.vectors) == 2
+    assert cache.nearest(_key("how to create a purchase order")) is None
+    cache.remove(_key("How do I void an invoice?"))
+    assert cache.nearest(_key("how to void an invoice")) is None
+    assert sum(len(p) for scope in cache.postings.values() for p in scope.values()) == len(
+        cache.vectors[_key("How do I close a work order?")][1])
@@ -0,0 +1,106 @@
+import asyncio
+
+from fastapi import HTTPException
+
+import main
+
+
+def _result(answer: str = "answer"):
+    return {
+        "answer": answer, "citations": [], "thread_id": "thread_1", "run_id": "run_1",
+        "assistant_id": "asst_1", "meta": {},
+    }
+
+
+def test_concurrent_duplicates_share_one_run():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return _result()
+
+    async def run():
+        data = main.AskRequest(question="How do I post an invoice?")
+        return await asyncio.gather(*(
+            main._answer_json("k-share", data, 0.0, "assistant", work) for _ in range(5)
+        ))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(r["answer"] == "answer" for r in results)
+    assert [r["thread_id"] for r in results].count("coalesced") == 4
+    assert results[0]["meta"]["coalesced_followers"] == 4
+    assert "k-share" not in main.IN_FLIGHT.flights
+
+
+def test_followers_see_the_leaders_error():
+    async def work():
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=502, detail="OpenAI API error: boom")
+
+    async def run():
+        data = main.AskRequest(question="How do I post an invoice?")
+        return await asyncio.gather(*(
+            main._answer_json("k-fail", data, 0.0, "assistant", work) for _ in range(3)
+        ), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, HTTPException) and r.status_code == 502 for r in results)
+    assert "k-fail" not in main.IN_FLIGHT.flights
+
+
+def test_thread_follow_ups_are_never_shared():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return _result()
+
+    async def run():
+        data = main.AskRequest(question="And then?", thread_id="thread_1")
+        await asyncio.gather(*(main._answer_json("k-thread", data, 0.0, "assistant", work) for _ in range(3)))
+
+    asyncio.run(run())
+    assert len(calls) == 3
+
+
+def test_subscribers_replay_published_frames():
+    async def run():
+        flight = main._Flight()
+        flight.publish("delta", {"text": "Hel"})
+
+        async def leader():
+            await asyncio.sleep(0.01)
+            flight.publish("delta", {"text": "lo"})
+            flight.finish(_result("Hello"))
+
+        asyncio.ensure_future(leader())
+        return [e async for e in flight.subscribe(1.0)], flight
+
+    events, flight = asyncio.run(run())
+    assert [p["text"] for _, p in events] == ["Hel", "lo"]
+    assert flight.result["answer"] == "Hello"
+
+
+def test_a_finished_flight_is_not_joined():
+    flights = main.SingleFlight()
+    flight, leader = flights.join("k")
+    assert leader
+    assert flights.join("k") == (flight, False)
+    flight.finish(_result())
+    _, leader = flights.join("k")
+    assert leader
+
+
+def test_placeholder_thread_ids_start_a_new_thread():
+    for placeholder in ("coalesced", "cached", "fast"):
+        assert main.AskRequest(question="And then?", thread_id=placeholder).thread_id is None
+    assert main.AskRequest(question="And then?", thread_id="thread_abc").thread_id == "thread_abc"
+
+
+def test_follow_up_on_a_coalesced_answer(api, assistant_ready, openai_fake):
+    resp = api.post("/ask", json={"question": "And how do I approve it?", "thread_id": "coalesced"})
+    assert resp.status_code == 200
+    assert resp.json()["thread_id"].startswith("thread_")
@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def state_file(tmp_path, monkeypatch):
+    path = tmp_path / "assistant_state.json"
+    monkeypatch.setattr(main, "STATE_FILE", path)
+    return path
+
+
+def _write(path, **state):
+    path.write_text(json.dumps(state), encoding="utf-8")
+
+
+def test_state_is_served_from_memory(state_file, monkeypatch):
+    _write(state_file, assistant_id="asst_1", vector_store_id="vs_1")
+    manager = main.StateManager(state_file, revalidate_s=3600)
+    reads = []
+    load = main._load_state
+    monkeypatch.setattr(main, "_load_state", lambda: reads.append(1) or load())
+    for _ in range(50):
+        assert manager.get()["vector_store_id"] == "vs_1"
+    assert len(reads) == 1
+
+
+def test_get_returns_a_copy(state_file):
+    _write(state_file, assistant_id="asst_1", vector_store_id="vs_1")
+    manager = main.StateManager(state_file, revalidate_s=3600)
+    manager.get()["vector_store_id"] = "changed"
+    assert manager.get()["vector_store_id"] == "vs_1"
+
+
+def test_another_workers_setup_is_picked_up(state_file):
+    _write(state_file, assistant_id="asst_1", vector_store_id="vs_1")
+    manager = main.StateManager(state_file, revalidate_s=3600)
+    manager.get()
+    _write(state_file, assistant_id="asst_2", vector_store_id="vs_2")
+    # mtime is only checked once per second
+    manager._checked_at = 0.0
+    assert manager.get()["vector_store_id"] == "vs_2"
+
+
+def test_save_writes_through(state_file):
+    manager = main.StateManager(state_file, revalidate_s=3600)
+    manager.save({"assistant_id": "asst_1", "vector_store_id": "vs_1"})
+    assert json.loads(state_file.read_text())["vector_store_id"] == "vs_1"
+    assert manager.get()["assistant_id"] == "asst_1"
+
+
+def test_revalidation_runs_in_the_background(api, assistant_ready, openai_fake, state_file):
+    main._save_state({"assistant_id": assistant_ready["assistant_id"],
+                      "vector_store_id": assistant_ready["vector_store_id"]})
+    manager = main.StateManager(state_file, revalidate_s=0.0)
+    retrieves = openai_fake.CALLS["vector_stores.retrieve"]
+
+    async def run():
+        manager.get()
+        await manager._revalidation
+        healthy = manager.stats()["missing"]
+        openai_fake.STORES.pop(assistant_ready["vector_store_id"])
+        manager._validated_at = 0.0
+        manager.get()
+        await manager._revalidation
+        return healthy, manager.stats()["missing"]
+
+    assert asyncio.run(run()) == (False, True)
+    assert openai_fake.CALLS["vector_stores.retrieve"] == retrieves + 2
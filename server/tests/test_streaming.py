@@ -0,0 +1,36 @@
+import main
+from conftest import sse_frames
+
+
+def test_stream_emits_tokens_as_the_run_writes_them(api, assistant_ready, openai_fake):
+    resp = api.post("/ask/stream", json={"question": "How do I create a BOM?"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    frames = sse_frames(resp.text)
+    events = [e for e, _ in frames]
+    assert events[0] == "start" and events[-1] == "done"
+    deltas = [d["text"] for e, d in frames if e == "delta"]
+    assert len(deltas) > 1
+    assert "".join(deltas).startswith("Fake answer for: How do I create a BOM?")
+    done = frames[-1][1]
+    assert done["citations"] and done["thread_id"].startswith("thread_")
+    # Streamed run: no polling
+    assert "threads.runs.retrieve" not in openai_fake.CALLS
+
+
+def test_ask_can_collect_a_streamed_run(api, assistant_ready, openai_fake, monkeypatch):
+    monkeypatch.setattr(main, "RUN_TRANSPORT", "stream")
+    data = api.post("/ask", json={"question": "How do I close a work order?"}).json()
+    assert data["answer"].startswith("Fake answer for: How do I close a work order?")
+    assert data["meta"]["transport"] == "stream" and data["meta"]["polls"] == 0
+    assert "threads.runs.retrieve" not in openai_fake.CALLS
+
+
+def test_a_cached_answer_streams_as_one_delta(api, assistant_ready, openai_fake):
+    body = {"question": "How do I receive a purchase order?"}
+    api.post("/ask/stream", json=body)
+    runs = openai_fake.CALLS["threads.runs.create"]
+    frames = sse_frames(api.post("/ask/stream", json=body).text)
+    assert [e for e, _ in frames] == ["start", "delta", "done"]
+    assert frames[-1][1]["meta"]["cached"] is True
+    assert openai_fake.CALLS["threads.runs.create"] == runs
@@ -0,0 +1,40 @@
+import main
+
+
+def test_questions_file_skips_comments_blanks_and_repeats(tmp_path):
+    path = tmp_path / "questions.txt"
+    path.write_text("# canonical questions\nHow do I post an invoice?\n\n  how do I post an INVOICE? \nWhat is a BOM?\n")
+    assert main._load_warmup_questions(path) == ["How do I post an invoice?", "What is a BOM?"]
+    assert main._load_warmup_questions(tmp_path / "missing.txt") == []
+
+
+def test_warmup_answers_into_the_cache(api, assistant_ready, openai_fake):
+    questions = ["How do I post an invoice?", "What is a BOM?"]
+    report = api.post("/warmup", json={"questions": questions, "wait": True}).json()
+    assert (report["status"], report["answered"], report["already_cached"]) == ("done", 2, 0)
+    assert report["tokens"]["total"] > 0
+    assert api.get("/warmup").json()["status"] == "done"
+
+    runs = openai_fake.CALLS["threads.runs.create"] + openai_fake.CALLS["threads.create_and_run"]
+    resp = api.post("/ask", json={"question": "What is a BOM?"}).json()
+    assert resp["meta"]["cached"] is True
+    again = api.post("/warmup", json={"questions": questions, "wait": True}).json()
+    assert (again["answered"], again["already_cached"]) == (0, 2)
+    assert openai_fake.CALLS["threads.runs.create"] + openai_fake.CALLS["threads.create_and_run"] == runs
+
+
+def test_force_re_answers_cached_questions(api, assistant_ready):
+    api.post("/warmup", json={"questions": ["What is a BOM?"], "wait": True})
+    report = api.post("/warmup", json={"questions": ["What is a BOM?"], "wait": True, "force": True}).json()
+    assert (report["answered"], report["already_cached"]) == (1, 0)
+
+
+def test_a_tight_budget_skips_the_warmup(api, assistant_ready, monkeypatch):
+    monkeypatch.setattr(main.BUDGET, "stage", lambda: 1)
+    report = api.post("/warmup", json={"questions": ["What is a BOM?"], "wait": True}).json()
+    assert (report["answered"], report["skipped_budget"]) == (0, 1)
+
+
+def test_warmup_needs_setup(api, monkeypatch):
+    monkeypatch.setattr(main.STATE, "get", lambda: {})
+    assert api.post("/warmup", json={"questions": ["x"], "mode": "assistant"}).status_code == 400
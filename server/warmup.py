@@ -0,0 +1,68 @@
+"""
+Answer the warm-up questions into the answer cache from the command line.
+
+Meant for a deploy step: run it against the persistent (sqlite) cache before the
+API workers start, or after a reindex, so users' first questions are cache hits.
+It uses the same state, cache and configuration as the server (.env), answers
+only the questions that are not cached yet (unless --force), and prints how long
+it took and what it cost.
+
+    python server/warmup.py                      # questions from WARMUP_QUESTIONS_FILE
+    python server/warmup.py --file faq.txt --concurrency 8 --mode fast
+    python server/warmup.py -q "How do I receive inventory?" -q "Enter an AP invoice"
+"""
+
+import sys
+import json
+import asyncio
+import argparse
+from pathlib import Path
+from typing import Dict, Any, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import main  # noqa: E402
+
+
+async def _run(questions: List[str], mode: str, concurrency: int, force: bool) -> Dict[str, Any]:
+    # Read the spend so far for the budget, and book this run's spend in the usage ledger
+    await main.LEDGER.flush()
+    try:
+        return await main._warm_cache(questions, mode, concurrency, force)
+    finally:
+        await main.LEDGER.flush()
+        await main.client.close()
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Pre-answer canonical questions into the answer cache")
+    parser.add_argument("--file", default=None, help=f"one question per line (default {main.WARMUP_QUESTIONS_FILE})")
+    parser.add_argument("-q", "--question", action="append", default=[], help="a question (repeatable)")
+    parser.add_argument("--mode", choices=["assistant", "fast"], default=main.ANSWER_MODE)
+    parser.add_argument("--concurrency", type=int, default=main.WARMUP_CONCURRENCY)
+    parser.add_argument("--force", action="store_true", help="re-answer questions that are already cached")
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    args = parser.parse_args()
+
+    if main.ANSWER_CACHE_BACKEND != "sqlite":
+        sys.exit("ANSWER_CACHE_BACKEND is not sqlite: answers cached here would be lost when this exits. "
+                 "Use POST /warmup on the running server instead.")
+    questions = list(args.question) or main._load_warmup_questions(Path(args.file) if args.file else None)
+    if not questions:
+        sys.exit("No questions to warm up.")
+
+    report = asyncio.run(_run(questions, args.mode, args.concurrency, args.force))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        skipped = f", {report['skipped_budget']} skipped (budget)" if report["skipped_budget"] else ""
+        print(f"{report['answered']} answered, {report['already_cached']} already cached{skipped}, "
+              f"{report['errors']} failed of {report['questions']} in {report['duration_ms'] / 1000:.1f}s; "
+              f"tokens {report['tokens']['total']}, cost ${report['cost_usd']:.6f} (scope {report['scope']})")
+        for item in report["failed"]:
+            print(f"  failed: {item['question']}: {item['error']}")
+    sys.exit(1 if report["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main_cli()